@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_KEY = "__background__"
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class RateLimitedError(AdmissionRejected):
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionRejected):
+    def __init__(self, queue_length: int):
+        super().__init__(f"admission queue full ({queue_length} waiting)")
+        self.queue_length = queue_length
+
+
+class QueueTimeoutError(AdmissionRejected):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def try_consume(self) -> float:
+        # صفر یعنی توکن برداشته شد؛ در غیر این صورت چند ثانیه تا توکن بعدی مانده است
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 50, rate_per_minute: float = 6.0, burst: int = 3,
+                 queue_timeout: float = 60.0, max_tracked_users: int = 50000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.max_tracked_users = max_tracked_users
+        self._active = 0
+        self._queued = 0
+        # هر کاربر صف خودش را دارد؛ ترتیب کلیدها نوبت round-robin را مشخص می‌کند
+        self._waiting: OrderedDict[str, deque] = OrderedDict()
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.admitted = 0
+        self.queued_total = 0
+        self.rate_limited = 0
+        self.rejected_full = 0
+        self.timed_out = 0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _check_rate(self, user_id: str) -> None:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_per_second, self.burst)
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > self.max_tracked_users: self._buckets.popitem(last=False)
+        else: self._buckets.move_to_end(user_id)
+        retry_after = bucket.try_consume()
+        if retry_after > 0:
+            self.rate_limited += 1
+            raise RateLimitedError(retry_after)
+
+    def _position(self, key: str) -> int:
+        # در round-robin هر کاربر دیگر حداکثر به اندازه درخواست‌های این کاربر جلوتر از او نوبت می‌گیرد
+        own = len(self._waiting[key])
+        return sum(min(len(waiters), own) for waiters in self._waiting.values())
+
+    def _remove_waiter(self, key: str, future: asyncio.Future) -> None:
+        waiters = self._waiting.get(key)
+        if waiters is None or future not in waiters: return
+        waiters.remove(future)
+        self._queued -= 1
+        if not waiters: del self._waiting[key]
+
+    async def acquire(self, user_id: str | None, on_queued=None) -> None:
+        # on_queued: async (position) -> None، فقط وقتی درخواست باید منتظر بماند صدا زده می‌شود
+        if user_id is not None: self._check_rate(user_id)
+        if self._active < self.max_concurrent and not self._queued:
+            self._active += 1
+            self.admitted += 1
+            return
+        if self._queued >= self.max_queue:
+            self.rejected_full += 1
+            raise QueueFullError(self._queued)
+        key = user_id if user_id is not None else BACKGROUND_KEY
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(key, deque()).append(future)
+        self._queued += 1
+        self.queued_total += 1
+        position = self._position(key)
+        logger.info(f"Admission: درخواست {key} در صف قرار گرفت (نوبت {position}، فعال: {self._active}).")
+        try:
+            if on_queued is not None:
+                try: await on_queued(position)
+                except Exception as e: logger.warning(f"Admission: خطا در اطلاع‌رسانی نوبت به {key}: {e}")
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # نوبت همزمان با لغو رسیده بود؛ جایگاه آزاد می‌شود تا نفر بعدی از دست نرود
+                self.release()
+            else: self._remove_waiter(key, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise QueueTimeoutError(f"waited more than {self.queue_timeout}s in admission queue") from None
+            raise
+        self.admitted += 1
+
+    def release(self) -> None:
+        while self._waiting:
+            key, waiters = self._waiting.popitem(last=False)
+            future = waiters.popleft()
+            self._queued -= 1
+            if waiters: self._waiting[key] = waiters # کاربر به انتهای نوبت می‌رود
+            if not future.done():
+                # جایگاه مستقیماً به درخواست بعدی منتقل می‌شود و _active تغییر نمی‌کند
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def slot(self, user_id: str | None, on_queued=None) -> "_AdmissionSlot":
+        return _AdmissionSlot(self, user_id, on_queued)
+
+    def stats(self) -> dict:
+        return {"active": self._active, "queued": self._queued, "admitted": self.admitted, "queued_total": self.queued_total,
+                "rate_limited": self.rate_limited, "rejected_full": self.rejected_full, "timed_out": self.timed_out}
+
+
+class _AdmissionSlot:
+    def __init__(self, controller: AdmissionController, user_id: str | None, on_queued):
+        self.controller = controller
+        self.user_id = user_id
+        self.on_queued = on_queued
+
+    async def __aenter__(self) -> None:
+        await self.controller.acquire(self.user_id, self.on_queued)
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.controller.release()
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_ARABIC_DIACRITICS_RE = re.compile(r"[ً-ٰٟـ]")
+_PUNCTUATION_RE = re.compile(r"[\W_]+", re.UNICODE)
+_CHAR_MAP = str.maketrans({"ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+                           "‌": "", "‍": "", "‏": "", "‎": "",
+                           **{chr(0x06F0 + i): str(i) for i in range(10)}, **{chr(0x0660 + i): str(i) for i in range(10)}})
+AGE_BUCKETS = ((12, "0-12"), (17, "13-17"), (29, "18-29"), (44, "30-44"), (59, "45-59"))
+
+
+def normalize_question(text: str) -> str:
+    text = _ARABIC_DIACRITICS_RE.sub("", (text or "").translate(_CHAR_MAP)).lower()
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split())
+
+
+def age_bucket(age) -> str:
+    try: age = int(age)
+    except (TypeError, ValueError): return "unknown"
+    for upper, label in AGE_BUCKETS:
+        if age <= upper: return label
+    return "60+"
+
+
+def make_cache_key(question: str, age, gender: str, model: str) -> str | None:
+    normalized = normalize_question(question)
+    if not normalized: return None
+    return hashlib.sha256(f"{model}|{gender}|{age_bucket(age)}|{normalized}".encode("utf-8")).hexdigest()
+
+
+class DoctorAnswerCache:
+    def __init__(self, path: str, max_entries: int = 5000, ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, question TEXT NOT NULL, answer TEXT NOT NULL, "
+                           "created_at REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _get_sync(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT answer, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None: self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def _put_sync(self, key: str, question: str, answer: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO answers (key, question, answer, created_at, last_access, hits) VALUES (?, ?, ?, ?, ?, 0)", (key, question, answer, now, now))
+                # حذف LRU: قدیمی‌ترین دسترسی‌ها بیرون می‌روند، همراه با ورودی‌های منقضی
+                expired = self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+                excess = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._conn.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)", (excess,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.stores += 1
+            self.evictions += max(excess, 0) + expired
+
+    async def get(self, key: str) -> str | None:
+        try: return await asyncio.to_thread(self._get_sync, key)
+        except sqlite3.Error as e:
+            logger.error(f"کش پاسخ دکتر: خطا در خواندن: {e}", exc_info=True)
+            return None
+
+    async def put(self, key: str, question: str, answer: str) -> None:
+        try: await asyncio.to_thread(self._put_sync, key, question, answer)
+        except sqlite3.Error as e: logger.error(f"کش پاسخ دکتر: خطا در ذخیره: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+    def close(self) -> None:
+        with self._lock: self._conn.close()
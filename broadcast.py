@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from admission import TokenBucket
+from checkpoint import clear_checkpoint, load_checkpoint, save_checkpoint
+
+logger = logging.getLogger(__name__)
+
+CLUB_MEMBER_FILTER = {"is_club_member": True}
+MAX_FLOOD_WAITS_PER_MESSAGE = 5
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class BroadcastInProgress(RuntimeError):
+    pass
+
+
+class Broadcaster:
+    # ارسال یک پیام به همه اعضای باشگاه: اعضا صفحه به صفحه از بک‌اند خوانده می‌شوند (صفحه بعد همزمان با ارسال صفحه فعلی)،
+    # چند worker با یک token bucket سراسری ارسال می‌کنند و RetryAfter همه workerها را تا پایان مهلت متوقف می‌کند.
+    # checkpoint شامل مرز آخرین صفحه کامل و کاربران ارسال‌شده صفحه جاری است و پس از هر ارسال ذخیره می‌شود؛ ادامه پس از قطعی فقط به پیام‌هایی
+    # که لحظه قطعی در حال ارسال بودند (حداکثر یکی به ازای هر worker) دوباره پیام می‌فرستد.
+    def __init__(self, bot, backend, checkpoint_path: str, rate_per_second: float = 25.0, burst: int = 5, per_chat_interval: float = 1.0,
+                 workers: int = 8, page_size: int = 200, max_attempts: int = 3):
+        self.bot = bot
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.state: dict | None = None
+        self._task: asyncio.Task | None = None
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._resume_at = 0.0
+        self._last_sent_at: dict[int, float] = {}
+        self._started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def pending(self) -> dict | None:
+        # broadcast نیمه‌تمام از اجرای قبلی (مثلاً پس از ری‌استارت)
+        state = load_checkpoint(self.checkpoint_path)
+        return state if state and not state.get("completed") else None
+
+    def start(self, text: str, parse_mode: str | None = None, requested_by: int | None = None) -> dict:
+        if self.running: raise BroadcastInProgress(self.state["id"])
+        state = {"id": uuid.uuid4().hex[:12], "text": text, "parse_mode": parse_mode, "requested_by": requested_by, "last_user_id": None,
+                 "page_done": [], "sent": 0, "blocked": 0, "failed": 0, "retries": 0, "flood_waits": 0, "elapsed": 0.0, "completed": False}
+        save_checkpoint(self.checkpoint_path, state)
+        return self._launch(state)
+
+    def resume(self) -> dict | None:
+        if self.running: raise BroadcastInProgress(self.state["id"])
+        state = self.pending()
+        if state is None: return None
+        logger.info(f"Broadcast {state['id']}: ادامه پس از کاربر {state['last_user_id']} ({state['sent']} ارسال قبلی).")
+        return self._launch(state)
+
+    def _launch(self, state: dict) -> dict:
+        self.state = state
+        self._task = asyncio.create_task(self._run(), name=f"broadcast-{state['id']}")
+        return state
+
+    async def cancel(self) -> None:
+        # توقف بدون حذف checkpoint؛ resume بعداً از همان نقطه ادامه می‌دهد
+        if not self.running: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+
+    async def wait(self) -> dict | None:
+        if self._task is not None: await asyncio.shield(self._task)
+        return self.state
+
+    def progress(self) -> dict | None:
+        if self.state is None: return None
+        keys = ("id", "sent", "blocked", "failed", "retries", "flood_waits", "completed")
+        report = {key: self.state[key] for key in keys}
+        elapsed = time.perf_counter() - self._started if self.running else self.state["elapsed"]
+        report["elapsed"] = round(elapsed, 1)
+        report["rate"] = round(self.state["sent"] / elapsed, 1) if elapsed else 0.0
+        report["running"] = self.running
+        return report
+
+    def _save(self) -> None:
+        save_checkpoint(self.checkpoint_path, self.state)
+
+    async def _throttle(self, chat_id: int) -> None:
+        while True:
+            now = time.monotonic()
+            wait = max(self._resume_at - now, self._last_sent_at.get(chat_id, 0.0) + self.per_chat_interval - now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            wait = self._bucket.try_consume()
+            if not wait: break
+            await asyncio.sleep(wait)
+        self._last_sent_at[chat_id] = time.monotonic()
+
+    async def _send(self, user_id: str) -> str:
+        chat_id = int(user_id) # چت خصوصی: chat_id همان user_id است
+        attempt, flood_waits = 0, 0
+        while True:
+            await self._throttle(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.state["text"], parse_mode=self.state["parse_mode"])
+                return "sent"
+            except RetryAfter as e:
+                # محدودیت flood سراسری است: همه workerها تا پایان مهلت صبر می‌کنند و این تلاش جزو max_attempts شمرده نمی‌شود
+                delay = _retry_after_seconds(e)
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                self.state["flood_waits"] += 1
+                flood_waits += 1
+                logger.warning(f"Broadcast {self.state['id']}: RetryAfter {delay} ثانیه؛ ارسال همه workerها متوقف شد.")
+                if flood_waits > MAX_FLOOD_WAITS_PER_MESSAGE: return "failed"
+            except Forbidden: return "blocked" # کاربر ربات را مسدود کرده است
+            except BadRequest as e:
+                logger.warning(f"Broadcast {self.state['id']}: ارسال به {user_id} رد شد: {e}")
+                return "failed"
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    logger.warning(f"Broadcast {self.state['id']}: ارسال به {user_id} پس از {attempt} تلاش ناموفق بود: {e}")
+                    return "failed"
+                self.state["retries"] += 1
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def _worker(self, queue: asyncio.Queue, page_done: set) -> None:
+        while True:
+            user_id = await queue.get()
+            try:
+                try: outcome = await self._send(user_id)
+                except Exception as e:
+                    logger.error(f"Broadcast {self.state['id']}: خطای پیش‌بینی‌نشده در ارسال به {user_id}: {e}", exc_info=True)
+                    outcome = "failed"
+                self.state[outcome] += 1
+                page_done.add(user_id)
+                self.state["page_done"] = sorted(page_done)
+                # فایل کوچک است (حداکثر page_size شناسه)؛ ذخیره پس از هر ارسال یعنی قطعی فقط ارسال‌های در جریان را تکرار می‌کند
+                self._save()
+            finally: queue.task_done()
+
+    async def _send_page(self, page: list[tuple[str, dict]]) -> None:
+        page_done = set(self.state["page_done"])
+        queue: asyncio.Queue = asyncio.Queue()
+        for user_id, _ in page:
+            if user_id not in page_done: queue.put_nowait(user_id)
+        workers = [asyncio.create_task(self._worker(queue, page_done)) for _ in range(min(self.workers, queue.qsize()))]
+        try: await queue.join()
+        finally:
+            for worker in workers: worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _run(self) -> None:
+        state = self.state
+        started = self._started = time.perf_counter() - state["elapsed"]
+        logger.info(f"Broadcast {state['id']}: شروع ارسال به اعضای باشگاه ({self.workers} worker، {self.rate_per_second} پیام در ثانیه).")
+        try:
+            next_page = asyncio.create_task(self.backend.list_page(self.page_size, state["last_user_id"], CLUB_MEMBER_FILTER))
+            while True:
+                page = await next_page
+                if not page: break
+                next_page = asyncio.create_task(self.backend.list_page(self.page_size, page[-1][0], CLUB_MEMBER_FILTER))
+                await self._send_page(page)
+                state["last_user_id"], state["page_done"] = page[-1][0], []
+                state["elapsed"] = time.perf_counter() - started
+                self._last_sent_at.clear()
+                self._save()
+                logger.info(f"Broadcast {state['id']}: {self.progress()}")
+            state["completed"] = True
+        except asyncio.CancelledError:
+            logger.warning(f"Broadcast {state['id']}: متوقف شد؛ با resume ادامه می‌یابد.")
+            raise
+        except Exception as e: logger.error(f"Broadcast {state['id']}: خطا در خواندن اعضا: {e}", exc_info=True)
+        finally:
+            if not next_page.done(): next_page.cancel()
+            state["elapsed"] = time.perf_counter() - started
+            self._save()
+        # checkpoint ناتمام (خطای بک‌اند) حفظ می‌شود تا /broadcast_resume از همان‌جا ادامه دهد
+        logger.info(f"Broadcast {state['id']} {'پایان یافت' if state['completed'] else 'ناتمام ماند'}: {self.progress()}")
+        if state["requested_by"]:
+            title = "📣 گزارش ارسال همگانی" if state["completed"] else "⚠️ ارسال همگانی ناتمام ماند (/broadcast_resume)"
+            try: await self.bot.send_message(chat_id=state["requested_by"], text=f"{title}:\n{self._report_text()}")
+            except Exception as e: logger.warning(f"Broadcast {state['id']}: ارسال گزارش به {state['requested_by']} ناموفق بود: {e}")
+        if state["completed"]: clear_checkpoint(self.checkpoint_path)
+
+    def _report_text(self) -> str:
+        report = self.progress()
+        return (f"ارسال‌شده: {report['sent']}\nمسدودکرده ربات: {report['blocked']}\nناموفق: {report['failed']}\n"
+                f"تلاش مجدد: {report['retries']} | توقف flood: {report['flood_waits']}\nزمان: {report['elapsed']} ثانیه ({report['rate']} پیام در ثانیه)")
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+HISTORY_KEY = "doctor_chat_history"
+SUMMARY_KEY = "doctor_chat_summary"
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    # تخمین محافظه‌کارانه: متن فارسی در توکنایزرهای رایج تقریباً هر ۲.۵ تا ۳ کاراکتر یک توکن است
+    return MESSAGE_OVERHEAD_TOKENS + (len(text or "") * 2 + 4) // 5
+
+
+def estimate_messages_tokens(messages: list) -> int:
+    return sum(estimate_tokens(m.get("content", "")) for m in messages)
+
+
+def reset_history(user_data: dict) -> None:
+    user_data[HISTORY_KEY] = []
+    user_data.pop(SUMMARY_KEY, None)
+
+
+class DoctorHistoryManager:
+    def __init__(self, summarizer, token_budget: int = 3000, keep_recent_messages: int = 6):
+        # summarizer: async (previous_summary, messages) -> str | None
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.keep_recent_messages = keep_recent_messages
+        self._pending: dict[int, asyncio.Task] = {}
+
+    def summary_message(self, user_data: dict) -> dict | None:
+        summary = user_data.get(SUMMARY_KEY)
+        if not summary: return None
+        return {"role": "system", "content": f"خلاصه بخش‌های قبلی این گفتگو با کاربر: {summary}"}
+
+    def build_prompt_history(self, user_data: dict) -> list:
+        history = user_data.get(HISTORY_KEY, [])
+        summary_msg = self.summary_message(user_data)
+        budget = self.token_budget - (estimate_tokens(summary_msg["content"]) if summary_msg else 0)
+        # تا زمانی که خلاصه‌سازی پس‌زمینه آماده شود، قدیمی‌ترین پیام‌ها کنار گذاشته می‌شوند تا اندازه پرامپت ثابت بماند
+        selected, used = [], 0
+        for message in reversed(history):
+            cost = estimate_tokens(message.get("content", ""))
+            if selected and used + cost > budget: break
+            selected.append(message)
+            used += cost
+        selected.reverse()
+        if len(selected) < len(history):
+            logger.info(f"تاریخچه دکتر از {len(history)} به {len(selected)} پیام (~{used} توکن) محدود شد.")
+        return ([summary_msg] if summary_msg else []) + selected
+
+    def maybe_compact(self, user_id: int, user_data: dict) -> None:
+        history = user_data.get(HISTORY_KEY, [])
+        if user_id in self._pending and not self._pending[user_id].done(): return
+        if estimate_messages_tokens(history) <= self.token_budget: return
+        fold_count = len(history) - self.keep_recent_messages
+        if fold_count <= 0: return
+        task = asyncio.create_task(self._compact(user_id, user_data, history, fold_count), name=f"doctor-history-summary-{user_id}")
+        self._pending[user_id] = task
+        task.add_done_callback(lambda t: self._pending.pop(user_id, None) if self._pending.get(user_id) is t else None)
+
+    async def _compact(self, user_id: int, user_data: dict, history: list, fold_count: int) -> None:
+        to_fold = list(history[:fold_count])
+        previous_summary = user_data.get(SUMMARY_KEY)
+        try: summary = await self.summarizer(previous_summary, to_fold)
+        except Exception as e:
+            logger.error(f"خطا در خلاصه‌سازی تاریخچه دکتر برای {user_id}: {e}", exc_info=True)
+            return
+        if not summary:
+            logger.warning(f"خلاصه‌سازی تاریخچه دکتر برای {user_id} نتیجه‌ای نداشت؛ برش تاریخچه ادامه می‌یابد.")
+            return
+        # اگر در این فاصله کاربر گفتگو را از نو شروع کرده باشد، خلاصه دیگر معتبر نیست
+        if user_data.get(HISTORY_KEY) is not history or history[:fold_count] != to_fold:
+            logger.info(f"تاریخچه دکتر {user_id} در حین خلاصه‌سازی تغییر کرد؛ خلاصه کنار گذاشته شد.")
+            return
+        del history[:fold_count]
+        user_data[SUMMARY_KEY] = summary
+        logger.info(f"{fold_count} پیام قدیمی دکتر برای {user_id} در خلاصه ادغام شد (~{estimate_tokens(summary)} توکن).")
@@ -0,0 +1,18 @@
+import json
+import os
+
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path): return {}
+    with open(path, encoding="utf-8") as f: return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    # نوشتن اتمیک: قطع شدن وسط ذخیره فایل نیمه‌کاره باقی نمی‌گذارد
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f: json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def clear_checkpoint(path: str) -> None:
+    if os.path.exists(path): os.remove(path)
@@ -0,0 +1,43 @@
+class _Sentinel:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+# عملیات فیلد مستقل از بک‌اند؛ FirestoreBackend آن‌ها را به transformهای فایراستور تبدیل می‌کند و بقیه با apply_update اعمال می‌کنند
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+
+
+class Increment:
+    __slots__ = ("value",)
+
+    def __init__(self, value: int | float):
+        self.value = value
+
+    def __repr__(self) -> str:
+        return f"Increment({self.value!r})"
+
+
+class ArrayUnion:
+    __slots__ = ("values",)
+
+    def __init__(self, values: list):
+        self.values = list(values)
+
+    def __repr__(self) -> str:
+        return f"ArrayUnion({self.values!r})"
+
+
+class ArrayRemove:
+    __slots__ = ("values",)
+
+    def __init__(self, values: list):
+        self.values = list(values)
+
+    def __repr__(self) -> str:
+        return f"ArrayRemove({self.values!r})"
@@ -0,0 +1,111 @@
+import bisect
+import logging
+
+import field_ops
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    # اندیس رتبه اعضای باشگاه در حافظه: لیست مرتب (-points, user_id) با bisect؛ رتبه و top-K بدون اسکن کالکشن
+    # رتبه‌بندی رقابتی است: امتیاز برابر = رتبه برابر (۱، ۲، ۲، ۴)
+    def __init__(self, top_k: int = 10):
+        self.top_k = top_k
+        self._points: dict[str, int] = {}
+        self._names: dict[str, str] = {}
+        self._ordered: list[tuple[int, str]] = []
+        self._touched: set[str] | None = None # کاربرانی که حین بازسازی تغییر کرده‌اند؛ داده اسکن برای آن‌ها کهنه است
+        self.ready = False
+        self.updates = 0
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _discard(self, user_id: str) -> None:
+        points = self._points.pop(user_id, None)
+        if points is None: return
+        index = bisect.bisect_left(self._ordered, (-points, user_id))
+        if index < len(self._ordered) and self._ordered[index] == (-points, user_id): del self._ordered[index]
+
+    def set(self, user_id: str, points: int, name: str | None = None) -> None:
+        if self._touched is not None: self._touched.add(user_id)
+        if name: self._names[user_id] = name
+        if self._points.get(user_id) == points: return
+        self._discard(user_id)
+        self._points[user_id] = points
+        bisect.insort(self._ordered, (-points, user_id))
+        self.updates += 1
+
+    def remove(self, user_id: str) -> None:
+        if self._touched is not None: self._touched.add(user_id)
+        self._discard(user_id)
+        self._names.pop(user_id, None)
+
+    def rank(self, user_id: str) -> int | None:
+        points = self._points.get(user_id)
+        if points is None: return None
+        # (-points,) از هر (-points, user_id) کوچک‌تر است، پس bisect_left تعداد اعضای با امتیاز بیشتر را می‌دهد
+        return bisect.bisect_left(self._ordered, (-points,)) + 1
+
+    def points(self, user_id: str) -> int | None:
+        return self._points.get(user_id)
+
+    def top(self, k: int | None = None) -> list[tuple[int, str, str | None, int]]:
+        rows, rank = [], 0
+        for index, (negative_points, user_id) in enumerate(self._ordered[:k or self.top_k]):
+            if index == 0 or negative_points != self._ordered[index - 1][0]: rank = index + 1
+            rows.append((rank, user_id, self._names.get(user_id), -negative_points))
+        return rows
+
+    @staticmethod
+    def display_name(profile: dict) -> str | None:
+        return profile.get('name_first_db') or profile.get('first_name')
+
+    def observe(self, user_id: str, changes: dict, profile: dict | None = None) -> None:
+        # شنونده تغییرات profile_store؛ اگر پروفایل کامل پس از تغییر در دسترس باشد از آن استفاده می‌شود، وگرنه از خود تغییرات
+        if profile is not None:
+            if profile.get('is_club_member'): self.set(user_id, int(profile.get('points') or 0), self.display_name(profile))
+            else: self.remove(user_id)
+            return
+        if changes.get('is_club_member') is False:
+            self.remove(user_id)
+            return
+        points = changes.get('points')
+        if isinstance(points, field_ops.Increment):
+            current = self._points.get(user_id)
+            if current is not None: self.set(user_id, current + int(points.value))
+        elif isinstance(points, int) and (user_id in self._points or changes.get('is_club_member') is True):
+            self.set(user_id, points, self.display_name(changes))
+        elif 'name_first_db' in changes and user_id in self._points and changes['name_first_db']:
+            self._names[user_id] = changes['name_first_db']
+
+    async def rebuild(self, backend, page_size: int = 500) -> None:
+        # اسکن صفحه‌ای پروفایل‌های عضو در شروع؛ تغییرات همزمان مستقیم اعمال می‌شوند و بر داده اسکن اولویت دارند
+        # در حالت sharded دوره‌ای هم اجرا می‌شود تا تغییرات workerهای دیگر دیده شود؛ عضوی که در اسکن نیامده حذف می‌شود
+        self._touched = set()
+        scanned = 0
+        seen: set[str] = set()
+        try:
+            start_after = None
+            while True:
+                page = await backend.list_page(page_size, start_after, {"is_club_member": True})
+                if not page: break
+                for user_id, profile in page:
+                    seen.add(user_id)
+                    if user_id in self._touched or not profile or not profile.get('is_club_member'): continue
+                    self._discard(user_id)
+                    self._points[user_id] = int(profile.get('points') or 0)
+                    bisect.insort(self._ordered, (-self._points[user_id], user_id))
+                    name = self.display_name(profile)
+                    if name: self._names[user_id] = name
+                scanned += len(page)
+                start_after = page[-1][0]
+            for user_id in set(self._points) - seen - self._touched:
+                self._discard(user_id)
+                self._names.pop(user_id, None)
+        finally: self._touched = None
+        self.ready = True
+        logger.info(f"جدول امتیازات از {scanned} پروفایل عضو بازسازی شد ({len(self)} عضو باشگاه).")
+
+    def stats(self) -> dict:
+        return {"members": len(self), "updates": self.updates, "ready": self.ready}
@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import ContextTypes, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+# تست بار کاملاً آفلاین است: پیش از import کردن main، همه وابستگی‌های بیرونی با نسخه‌های محلی جایگزین می‌شوند
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("OPENROUTER_API_KEY", "loadtest")
+os.environ.setdefault("PERSISTENCE_ENABLED", "false")
+os.environ.setdefault("DOCTOR_ANSWER_CACHE_ENABLED", "false")
+os.environ.setdefault("LLM_USER_RATE_PER_MINUTE", "600")
+os.environ.setdefault("LLM_USER_BURST", "20")
+
+import main  # noqa: E402
+import profile_store  # noqa: E402
+from profile_cache import apply_update  # noqa: E402
+from storage import DocumentNotFound, ProfileBackend, SqliteBackend  # noqa: E402
+from write_behind import WriteBehindBuffer  # noqa: E402
+
+logger = logging.getLogger("loadtest")
+
+
+class LatencyModel:
+    def __init__(self, mean: float, jitter: float = 0.3, error_rate: float = 0.0):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def sample(self) -> float:
+        if self.mean <= 0: return 0.0
+        return max(0.0, random.uniform(self.mean * (1 - self.jitter), self.mean * (1 + self.jitter)))
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeTelegramRequest(BaseRequest):
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.calls = Counter()
+        self.errors = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict, **extra) -> dict:
+        self._message_id += 1
+        chat_id = params.get("chat_id", 0)
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        await asyncio.sleep(self.latency.sample())
+        if api_method != "getMe" and self.latency.should_fail():
+            self.errors += 1
+            return 502, json.dumps({"ok": False, "error_code": 502, "description": "Bad Gateway"}).encode()
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Tafteh", "username": "tafteh_loadtest_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            result = self._message(params, text=params.get("text", ""))
+        elif api_method == "sendPhoto":
+            result = self._message(params, caption=params.get("caption"), photo=[{"file_id": "loadtest-photo", "file_unique_id": "lt", "width": 600, "height": 600}])
+        else: result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeBackend(ProfileBackend):
+    # بک‌اند حافظه‌ای با تاخیر شبکه شبیه‌سازی‌شده؛ مثل Firestore async حلقه رویداد را مسدود نمی‌کند
+    name = "fake"
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.errors = 0
+        self._docs: dict[str, dict] = {}
+
+    async def _roundtrip(self, op: str) -> None:
+        await asyncio.sleep(self.latency.sample())
+        if self.latency.should_fail():
+            self.errors += 1
+            raise RuntimeError(f"loadtest: خطای تزریقی در {op}")
+
+    async def get(self, user_id: str) -> dict | None:
+        await self._roundtrip("get")
+        return dict(self._docs[user_id]) if user_id in self._docs else None
+
+    async def create(self, user_id: str, data: dict) -> None:
+        await self._roundtrip("create")
+        self._docs[user_id] = apply_update({}, data)
+
+    async def update(self, user_id: str, data: dict) -> None:
+        await self._roundtrip("update")
+        if user_id not in self._docs: raise DocumentNotFound(user_id)
+        self._docs[user_id] = apply_update(self._docs[user_id], data)
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        await self._roundtrip("update_many")
+        for user_id, data in updates.items(): self._docs[user_id] = apply_update(self._docs.get(user_id, {}), data)
+
+    async def run_transaction(self, user_id: str, build):
+        await self._roundtrip("transaction")
+        existing = self._docs.get(user_id)
+        write_data, is_create, result = build(dict(existing) if existing is not None else None)
+        if is_create: self._docs[user_id] = apply_update({}, write_data)
+        elif write_data: self._docs[user_id] = apply_update(existing, write_data)
+        return result
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        await self._roundtrip("list_page")
+        user_ids = sorted(u for u, doc in self._docs.items() if (start_after is None or u > start_after)
+                          and all(doc.get(field) == value for field, value in (where or {}).items()))[:limit]
+        return [(user_id, dict(self._docs[user_id])) for user_id in user_ids]
+
+
+class CountingBackend(ProfileBackend):
+    def __init__(self, inner: ProfileBackend):
+        self.inner = inner
+        self.name = inner.name
+        self.calls = Counter()
+
+    async def get(self, user_id: str) -> dict | None:
+        self.calls["get"] += 1
+        return await self.inner.get(user_id)
+
+    async def create(self, user_id: str, data: dict) -> None:
+        self.calls["create"] += 1
+        await self.inner.create(user_id, data)
+
+    async def update(self, user_id: str, data: dict) -> None:
+        self.calls["update"] += 1
+        await self.inner.update(user_id, data)
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        self.calls["update_many"] += 1
+        await self.inner.update_many(updates)
+
+    async def run_transaction(self, user_id: str, build):
+        self.calls["transaction"] += 1
+        return await self.inner.run_transaction(user_id, build)
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        self.calls["list_page"] += 1
+        return await self.inner.list_page(limit, start_after, where)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+class FakeOpenRouterTransport(httpx.AsyncBaseTransport):
+    ANSWER = "این یک پاسخ آزمایشی از دکتر تافته است. برای تشخیص قطعی حتماً به پزشک مراجعه کنید. " * 3
+
+    def __init__(self, latency: LatencyModel, stream_chunks: int = 12):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = Counter()
+        self.errors = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            self.calls["warm_up"] += 1
+            return httpx.Response(200, json={"data": {"label": "loadtest"}})
+        body = json.loads(request.content)
+        streaming = bool(body.get("stream"))
+        self.calls["stream" if streaming else "completion"] += 1
+        if self.latency.should_fail():
+            self.errors += 1
+            await asyncio.sleep(self.latency.sample() / 4)
+            return httpx.Response(503, json={"error": {"message": "loadtest: خطای تزریقی"}})
+        usage = {"prompt_tokens": sum(len(m.get("content", "")) for m in body.get("messages", [])) // 3, "completion_tokens": len(self.ANSWER) // 3}
+        if not streaming:
+            await asyncio.sleep(self.latency.sample())
+            content = "\n".join(f"نکته سلامتی آزمایشی شماره {random.randrange(10 ** 6)} برای تست بار" for _ in range(10)) if "نکته سلامتی" in str(body) else self.ANSWER
+            return httpx.Response(200, json={"choices": [{"message": {"content": content}}], "usage": usage})
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, stream=_SseStream(self._sse_lines(usage)))
+
+    async def _sse_lines(self, usage: dict):
+        total = self.latency.sample()
+        step = max(1, len(self.ANSWER) // self.stream_chunks)
+        for i in range(0, len(self.ANSWER), step):
+            await asyncio.sleep(total / self.stream_chunks)
+            yield f"data: {json.dumps({'choices': [{'delta': {'content': self.ANSWER[i:i + step]}}]})}\n\n".encode()
+        yield f"data: {json.dumps({'choices': [{'delta': {}}], 'usage': usage})}\n\ndata: [DONE]\n\n".encode()
+
+
+class _SseStream(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    async def __aiter__(self):
+        async for chunk in self._chunks: yield chunk
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.handler_seconds: dict[str, list[float]] = defaultdict(list)
+        self.handler_errors = Counter()
+
+    def wrap(self, callback, name: str):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try: return await callback(update, context)
+            except BaseException:
+                self.handler_errors[name] += 1
+                raise
+            finally: self.handler_seconds[name].append(time.perf_counter() - started)
+        return wrapper
+
+
+def user_script(questions: int, tips: int) -> list[str]:
+    return (["/start", "👨‍⚕️ دکتر تافته", "آزمون", "کاربر بار", str(random.randint(18, 70)), random.choice(["زن", "مرد"])]
+            + [f"سوال آزمایشی {i} درباره سردرد و خستگی مداوم؟" for i in range(questions)]
+            + ["🔙 بازگشت به منوی اصلی", "⭐ عضویت در باشگاه تافته", "✅ بله، عضو می‌شوم"]
+            + ["📣 نکته سلامتی باشگاه"] * tips + ["/leaderboard"])
+
+
+def make_update(update_id: int, user_id: int, text: str, bot) -> Update:
+    user = User(id=user_id, first_name=f"LoadUser{user_id}", is_bot=False, username=f"load_{user_id}")
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text))] if text.startswith("/") else None
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text=text, entities=entities)
+    message.set_bot(bot)
+    update = Update(update_id=update_id, message=message)
+    update.set_bot(bot)
+    return update
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(values: list[float]) -> dict:
+    return {"count": len(values), "mean_ms": round(statistics.fmean(values) * 1000, 3) if values else 0.0,
+            **{f"p{p}_ms": round(percentile(values, p) * 1000, 3) for p in (50, 95, 99)}, "max_ms": round(max(values, default=0.0) * 1000, 3)}
+
+
+def _git_revision() -> str | None:
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception: return None
+
+
+async def run_load_test(args) -> dict:
+    random.seed(args.seed)
+    telegram_request = FakeTelegramRequest(LatencyModel(args.telegram_latency, error_rate=args.telegram_error_rate))
+    media_dir = tempfile.TemporaryDirectory(prefix="tafteh-loadtest-media-")
+    sqlite_dir = tempfile.TemporaryDirectory(prefix="tafteh-loadtest-") if args.store == "sqlite" else None
+    store_backend = SqliteBackend(os.path.join(sqlite_dir.name, "profiles.sqlite3")) if sqlite_dir else FakeBackend(LatencyModel(args.store_latency, error_rate=args.store_error_rate))
+    store = CountingBackend(store_backend)
+    llm = FakeOpenRouterTransport(LatencyModel(args.llm_latency, error_rate=args.llm_error_rate), stream_chunks=args.stream_chunks)
+    recorder = LatencyRecorder()
+
+    application = main.build_application(request=telegram_request, concurrent_updates=args.concurrent_updates)
+    main._instrument_handlers(application.handlers[0], recorder.wrap)
+    scripts = {100000 + i: user_script(args.questions, args.tips) for i in range(args.users)}
+    total_updates = sum(len(s) for s in scripts.values())
+    enqueued_at: dict[int, float] = {}
+    update_seconds: list[float] = []
+    last_completed: dict[int, int] = {}
+    ordering_violations = 0
+    done = asyncio.Event()
+
+    async def record_completion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        nonlocal ordering_violations
+        update_seconds.append(time.perf_counter() - enqueued_at.pop(update.update_id))
+        # شناسه آپدیت‌های هر کاربر صعودی وارد صف می‌شود؛ پایان خارج از ترتیب یعنی نقض ترتیب هر کاربر
+        if update.update_id < last_completed.get(update.effective_user.id, 0): ordering_violations += 1
+        last_completed[update.effective_user.id] = update.update_id
+        if len(update_seconds) >= total_updates: done.set()
+
+    # گروه بعد از همه هندلرها اجرا می‌شود و پایان پردازش هر آپدیت را ثبت می‌کند
+    application.add_handler(TypeHandler(Update, record_completion), group=1000)
+
+    # کلاینت OpenRouter پیش از post_init جایگزین می‌شود تا گرم کردن اتصال هم به transport محلی برود
+    main.openrouter_client._client = httpx.AsyncClient(transport=llm, timeout=main.openrouter_client._timeout)
+    # تصویر خوش‌آمد از سایت دانلود نمی‌شود و file_id در فایل موقت ثبت می‌شود
+    main.media_registry._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=b"loadtest-image")))
+    main.media_registry.path = os.path.join(media_dir.name, "media_registry.json")
+    main.media_registry._entries = {}
+    async with application:
+        await main._post_init(application)
+        write_behind = WriteBehindBuffer(store, interval=main.WRITE_BEHIND_INTERVAL_SECONDS, max_batch=main.WRITE_BEHIND_MAX_BATCH) if args.write_behind else None
+        profile_store.configure(store, cache=main.profile_cache, write_behind=write_behind)
+        await main.leaderboard.rebuild(store)
+        main.profile_cache.clear()
+        try:
+            await application.start()
+            started = time.perf_counter()
+            update_id = 0
+            # پیام‌های کاربران به صورت نوبتی وارد صف می‌شوند تا ترتیب هر کاربر حفظ شود و کاربران در هم تنیده باشند
+            for step in range(max(len(s) for s in scripts.values())):
+                for user_id, script in scripts.items():
+                    if step >= len(script): continue
+                    update_id += 1
+                    enqueued_at[update_id] = time.perf_counter()
+                    await application.update_queue.put(make_update(update_id, user_id, script[step], application.bot))
+                if args.arrival_interval: await asyncio.sleep(args.arrival_interval)
+            try: await asyncio.wait_for(done.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError: logger.error(f"تست بار پس از {args.timeout} ثانیه تمام نشد؛ {len(update_seconds)}/{total_updates} آپدیت پردازش شد.")
+            elapsed = time.perf_counter() - started
+        finally:
+            if application.running: await application.stop()
+            await main._post_shutdown(application)
+            if sqlite_dir: sqlite_dir.cleanup()
+            media_dir.cleanup()
+
+    processed = len(update_seconds)
+    backend_calls = {"telegram": dict(telegram_request.calls), "store": dict(store.calls), "llm": dict(llm.calls)}
+    return {
+        "meta": {"started_at": datetime.now(timezone.utc).isoformat(), "git_revision": _git_revision(), "python": platform.python_version(),
+                 "config": vars(args)},
+        "totals": {"updates": total_updates, "processed": processed, "elapsed_seconds": round(elapsed, 3),
+                   "throughput_updates_per_second": round(processed / elapsed, 2) if elapsed else 0.0,
+                   "concurrent_updates": args.concurrent_updates, "per_user_ordering_violations": ordering_violations},
+        "update_latency": summarize(update_seconds),
+        "handlers": {name: {**summarize(values), "errors": recorder.handler_errors[name]} for name, values in sorted(recorder.handler_seconds.items())},
+        "backend_calls": backend_calls,
+        "backend_calls_per_update": {backend: round(sum(calls.values()) / processed, 3) if processed else 0.0 for backend, calls in backend_calls.items()},
+        "backend_errors_injected": {"telegram": telegram_request.errors, "store": getattr(store_backend, "errors", 0), "llm": llm.errors},
+        "profile_cache": main.profile_cache.stats(),
+        "llm_admission": main.llm_admission.stats(),
+        "media_registry": main.media_registry.stats(),
+        "write_behind": write_behind.stats() if write_behind else None,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="تست بار آفلاین ربات تافته با کاربران مصنوعی و بک‌اندهای شبیه‌سازی‌شده")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=2, help="تعداد سوال از دکتر برای هر کاربر")
+    parser.add_argument("--tips", type=int, default=2, help="تعداد درخواست نکته سلامتی برای هر کاربر")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--store", choices=("fake", "sqlite"), default="fake", help="fake: حافظه با تاخیر شبیه‌سازی‌شده، sqlite: بک‌اند واقعی SQLite")
+    parser.add_argument("--store-latency", type=float, default=0.03)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="زمان کل تولید پاسخ LLM به ثانیه")
+    parser.add_argument("--stream-chunks", type=int, default=12)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--store-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--arrival-interval", type=float, default=0.0, help="فاصله بین هر دور ورود پیام کاربران")
+    parser.add_argument("--concurrent-updates", type=int, default=main.CONCURRENT_UPDATES, help="۱ = پردازش ترتیبی آپدیت‌ها (رفتار پیش‌فرض PTB)")
+    parser.add_argument("--write-behind", action="store_true", default=main.WRITE_BEHIND_ENABLED, help="ادغام و نوشتن دسته‌ای آپدیت‌های پروفایل")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="مسیر فایل JSON نتایج (پیش‌فرض: loadtest-results/<زمان>.json)")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None) -> None:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.log_level.upper())
+    results = asyncio.run(run_load_test(args))
+    output = args.output or os.path.join("loadtest-results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    totals, latency = results["totals"], results["update_latency"]
+    print(f"{totals['processed']}/{totals['updates']} آپدیت در {totals['elapsed_seconds']} ثانیه ({totals['throughput_updates_per_second']} آپدیت/ثانیه، همزمانی {totals['concurrent_updates']}، نقض ترتیب کاربر: {totals['per_user_ordering_violations']})")
+    print(f"تاخیر آپدیت: p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms")
+    for name, stats in results["handlers"].items():
+        print(f"  {name:40s} n={stats['count']:6d} p50={stats['p50_ms']:9.1f}ms p95={stats['p95_ms']:9.1f}ms p99={stats['p99_ms']:9.1f}ms err={stats['errors']}")
+    print(f"فراخوانی بک‌اند به ازای هر آپدیت: {results['backend_calls_per_update']}")
+    print(f"نتایج در {output} ذخیره شد.")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,17 +1,41 @@
+import time
+_IMPORT_STARTED_AT = time.perf_counter()
 import logging
-import httpx
 import os
 from enum import Enum
 from dotenv import load_dotenv
-import threading
-from flask import Flask
 import asyncio
 import random
+import hashlib
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+# firebase_admin عمداً اینجا import نمی‌شود؛ فقط اگر بک‌اند فایراستور انتخاب شود در post_init بارگذاری می‌شود
+from openrouter_client import OpenRouterClient, CircuitBreaker, CircuitOpenError, ClientBusyError
+import metrics
+import tracing
+from tracing import TracingRateLimiter, UpdateTracer
+from admission import AdmissionController, RateLimitedError, QueueFullError, QueueTimeoutError
+from model_router import ModelRouter
+from leaderboard import Leaderboard
+from broadcast import Broadcaster, BroadcastInProgress
+from outbound import OutboundQueue
+from media_registry import MediaRegistry
+from update_processor import UserOrderedUpdateProcessor
 
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram_streaming import ProgressiveMessage, send_markdown_reply
+from answer_cache import DoctorAnswerCache, make_cache_key
+from persistence import SqlitePersistence
+from chat_history import DoctorHistoryManager, reset_history
+from tip_pool import HealthTipPool, parse_tip_lines
+from web_server import build_web_app, build_server
+from sharding import LocalWorkerPool, ShardDispatcher, WorkerHandoff, build_dispatcher_app, worker_routes
+import sharding
+from profile_cache import ProfileCache
+import profile_store
+from write_behind import WriteBehindBuffer
+from storage import ProfileBackend, FirestoreBackend, FirestoreSyncBackend, SqliteBackend, init_firebase
+import rewards
+
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -19,54 +43,107 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
     Application
 )
+from telegram.request import BaseRequest
 
 load_dotenv()
-db = None
-_initial_fb_logger = logging.getLogger("FIREBASE_INIT_LOGGER_V4") 
-_initial_fb_logger.propagate = False 
-_initial_fb_logger.setLevel(logging.INFO)
-if not _initial_fb_logger.hasHandlers():
-    _fb_handler = logging.StreamHandler()
-    _fb_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    _fb_handler.setFormatter(_fb_formatter)
-    _initial_fb_logger.addHandler(_fb_handler)
-try:
-    cred_path_render = os.getenv("FIREBASE_CREDENTIALS_PATH", "/etc/secrets/firebase-service-account-key.json")
-    cred_path_local = "firebase-service-account-key.json"
-    cred_path = cred_path_render if os.path.exists(cred_path_render) else cred_path_local
-    if not os.path.exists(cred_path):
-        _initial_fb_logger.warning(f"فایل کلید Firebase در مسیر '{cred_path}' یافت نشد.")
-    else:
-        cred = credentials.Certificate(cred_path)
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(cred)
-        db = firestore.client()
-        _initial_fb_logger.info("Firebase Admin SDK با موفقیت مقداردهی اولیه شد.")
-except Exception as e:
-    _initial_fb_logger.error(f"خطای بحرانی در مقداردهی اولیه Firebase: {e}", exc_info=True)
-
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO, handlers=[logging.StreamHandler()], force=True
 )
 logger = logging.getLogger(__name__)
 logger.info("اسکریپت main.py شروع به کار کرد...")
+db = None # کلاینت sync فایراستور؛ در post_init و فقط برای بک‌اند firestore ساخته می‌شود
 
 TELEGRAM_TOKEN = os.getenv("BOT_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL_NAME = os.getenv("OPENROUTER_MODEL_NAME", "openai/gpt-3.5-turbo")
+# فهرست مرتب مدل‌ها برای مسیریاب (اولی ترجیح پیش‌فرض است)؛ خالی = فقط OPENROUTER_MODEL_NAME
+OPENROUTER_MODEL_NAMES = [m.strip() for m in os.getenv("OPENROUTER_MODEL_NAMES", OPENROUTER_MODEL_NAME).split(",") if m.strip()] or [OPENROUTER_MODEL_NAME]
 WELCOME_IMAGE_URL = os.getenv("WELCOME_IMAGE_URL", "https://tafteh.ir/wp-content/uploads/2024/12/navar-nehdashti2-600x600.jpg")
 URL_TAFTEH_WEBSITE = "https://tafteh.ir/"
+MEDIA_REGISTRY_PATH = os.getenv("MEDIA_REGISTRY_PATH", "media_registry.json")
+MEDIA_UPLOAD_CHAT_ID = int(os.getenv("MEDIA_UPLOAD_CHAT_ID")) if os.getenv("MEDIA_UPLOAD_CHAT_ID") else None # خالی = آپلود در اولین /start
 
-POINTS_FOR_JOINING_CLUB = 50
-POINTS_FOR_FULL_PROFILE_COMPLETION = 35 # امتیاز برای تکمیل نام، نام خانوادگی، سن و جنسیت
-# POINTS_FOR_CLUB_TIP حذف شد
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "8"))
+OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
+OPENROUTER_REQUEST_TIMEOUT = float(os.getenv("OPENROUTER_REQUEST_TIMEOUT", "45"))
+OPENROUTER_QUEUE_TIMEOUT = float(os.getenv("OPENROUTER_QUEUE_TIMEOUT", "20"))
+OPENROUTER_BREAKER_THRESHOLD = int(os.getenv("OPENROUTER_BREAKER_THRESHOLD", "5"))
+OPENROUTER_BREAKER_RESET_SECONDS = float(os.getenv("OPENROUTER_BREAKER_RESET_SECONDS", "30"))
+OPENROUTER_HEDGE_AFTER_SECONDS = float(os.getenv("OPENROUTER_HEDGE_AFTER_SECONDS", "0")) # 0 = بدون درخواست موازی
+OPENROUTER_ROUTER_WINDOW = int(os.getenv("OPENROUTER_ROUTER_WINDOW", "50"))
+OPENROUTER_ROUTER_MAX_ERROR_RATE = float(os.getenv("OPENROUTER_ROUTER_MAX_ERROR_RATE", "0.5"))
+OPENROUTER_ROUTER_COOLDOWN_SECONDS = float(os.getenv("OPENROUTER_ROUTER_COOLDOWN_SECONDS", "60"))
+LLM_ADMISSION_MAX_CONCURRENT = int(os.getenv("LLM_ADMISSION_MAX_CONCURRENT", str(OPENROUTER_MAX_CONCURRENCY)))
+LLM_ADMISSION_MAX_QUEUE = int(os.getenv("LLM_ADMISSION_MAX_QUEUE", "50"))
+LLM_ADMISSION_QUEUE_TIMEOUT = float(os.getenv("LLM_ADMISSION_QUEUE_TIMEOUT", "60"))
+LLM_USER_RATE_PER_MINUTE = float(os.getenv("LLM_USER_RATE_PER_MINUTE", "6"))
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "3"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))
+PROFILE_CACHE_TTL_SECONDS = float(os.getenv("PROFILE_CACHE_TTL_SECONDS", "300"))
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes") # آپدیت‌های ساده پروفایل تا interval ثانیه در حافظه می‌مانند
+WRITE_BEHIND_INTERVAL_SECONDS = float(os.getenv("WRITE_BEHIND_INTERVAL_SECONDS", "1.0"))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200")) # batch فایراستور حداکثر ۵۰۰ نوشتن
+WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS", "30")) # مهلت تلاش دوباره در خاموشی
+WRITE_BEHIND_SPILL_PATH = os.getenv("WRITE_BEHIND_SPILL_PATH", "write_behind.spill.jsonl") # نوشتن‌های ثبت‌نشده برای اجرای بعدی
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore").lower() # firestore یا sqlite
+SQLITE_STORAGE_PATH = os.getenv("SQLITE_STORAGE_PATH", "tafteh_profiles.sqlite3")
+FIRESTORE_ASYNC_ENABLED = os.getenv("FIRESTORE_ASYNC_ENABLED", "true").lower() in ("1", "true", "yes")
+STARTUP_WARMUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", "10"))
+LEADERBOARD_TOP_K = int(os.getenv("LEADERBOARD_TOP_K", "10"))
+LEADERBOARD_REBUILD_PAGE_SIZE = int(os.getenv("LEADERBOARD_REBUILD_PAGE_SIZE", "500"))
+DOCTOR_STREAMING_ENABLED = os.getenv("DOCTOR_STREAMING_ENABLED", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.5"))
+DOCTOR_HISTORY_TOKEN_BUDGET = int(os.getenv("DOCTOR_HISTORY_TOKEN_BUDGET", "3000"))
+DOCTOR_HISTORY_KEEP_RECENT_MESSAGES = int(os.getenv("DOCTOR_HISTORY_KEEP_RECENT_MESSAGES", "6"))
+DOCTOR_SUMMARY_MODEL_NAME = os.getenv("DOCTOR_SUMMARY_MODEL_NAME") # خالی = همان مدل اصلی
+TIP_POOL_TARGET_SIZE = int(os.getenv("TIP_POOL_TARGET_SIZE", "40"))
+TIP_POOL_BATCH_SIZE = int(os.getenv("TIP_POOL_BATCH_SIZE", "10"))
+TIP_POOL_REFILL_INTERVAL_SECONDS = float(os.getenv("TIP_POOL_REFILL_INTERVAL_SECONDS", "300"))
+DOCTOR_ANSWER_CACHE_ENABLED = os.getenv("DOCTOR_ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+DOCTOR_ANSWER_CACHE_PATH = os.getenv("DOCTOR_ANSWER_CACHE_PATH", "doctor_answer_cache.sqlite3")
+DOCTOR_ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("DOCTOR_ANSWER_CACHE_MAX_ENTRIES", "5000"))
+DOCTOR_ANSWER_CACHE_TTL_SECONDS = float(os.getenv("DOCTOR_ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ADMIN_USER_IDS = [int(u) for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()] # مجاز به /broadcast
+BROADCAST_RATE_PER_SECOND = float(os.getenv("BROADCAST_RATE_PER_SECOND", "25")) # سقف سراسری تلگرام حدود ۳۰ پیام در ثانیه است
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_CHECKPOINT_PATH = os.getenv("BROADCAST_CHECKPOINT_PATH", "broadcast.checkpoint.json")
+BROADCAST_AUTO_RESUME = os.getenv("BROADCAST_AUTO_RESUME", "true").lower() in ("1", "true", "yes")
+OUTBOUND_COALESCE_WINDOW_SECONDS = float(os.getenv("OUTBOUND_COALESCE_WINDOW_SECONDS", "0.3")) # پیام‌های متنی یک چت در این بازه یک پیام می‌شوند
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "30"))
+OUTBOUND_PER_CHAT_RATE_PER_SECOND = float(os.getenv("OUTBOUND_PER_CHAT_RATE_PER_SECOND", "1"))
+OUTBOUND_PER_CHAT_BURST = int(os.getenv("OUTBOUND_PER_CHAT_BURST", "3"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32")) # 1 = پردازش ترتیبی پیش‌فرض PTB
+CONCURRENT_UPDATES_MAX_PENDING = int(os.getenv("CONCURRENT_UPDATES_MAX_PENDING", "1024"))
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_SLOW_UPDATE_SECONDS = float(os.getenv("TRACE_SLOW_UPDATE_SECONDS", "3")) # آپدیت کندتر با timeline کامل به صورت JSON لاگ می‌شود
+TRACE_PROFILE_SAMPLE_RATE = float(os.getenv("TRACE_PROFILE_SAMPLE_RATE", "0")) # سهم آپدیت‌هایی که با cProfile اجرا می‌شوند (0 = غیرفعال)
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", "profiles")
+TRACE_PROFILE_MAX_FILES = int(os.getenv("TRACE_PROFILE_MAX_FILES", "50"))
+PERSISTENCE_ENABLED = os.getenv("PERSISTENCE_ENABLED", "true").lower() in ("1", "true", "yes")
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_UPDATE_INTERVAL_SECONDS = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL_SECONDS", "5"))
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower() # polling، webhook یا worker (آپدیت‌ها از dispatcher می‌رسند)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", 8080))
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0")) # >0: این فرایند dispatcher است و این تعداد worker محلی می‌سازد
+SHARD_WORKER_URLS = [u.strip() for u in os.getenv("SHARD_WORKER_URLS", "").split(",") if u.strip()] # workerهای راه دور: name=url یا فقط url
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", str(WEB_PORT + 1))) # پورت worker محلی i برابر SHARD_BASE_PORT + i
+SHARD_SECRET = os.getenv("SHARD_SECRET")
+SHARD_STATE_PATH = os.getenv("SHARD_STATE_PATH", "shards.json")
+SHARD_WORKER_NAME = os.getenv("SHARD_WORKER_NAME", "worker")
+# در حالت sharded امتیازهای کاربران workerهای دیگر فقط با اسکن دوره‌ای به جدول امتیازات این فرایند می‌رسد (0 = غیرفعال)
+LEADERBOARD_RESYNC_INTERVAL_SECONDS = float(os.getenv("LEADERBOARD_RESYNC_INTERVAL_SECONDS", "300" if BOT_MODE == "worker" else "0"))
 
-BADGE_CLUB_MEMBER = "عضو باشگاه تافته 🏅"
-BADGE_FULL_PROFILE = "پروفایل طلایی ✨" 
-BADGE_HEALTH_EXPLORER = "کاشف سلامت 🧭" 
-CLUB_TIP_BADGE_THRESHOLD = 3 
+# ثابت‌های امتیاز و نشان‌ها به همراه قوانین اعطا در rewards.py تعریف شده‌اند
 
 if not TELEGRAM_TOKEN or not OPENROUTER_API_KEY:
     logger.error("!!! بحرانی: توکن‌های ضروری ربات یا API یافت نشدند.")
@@ -99,82 +176,110 @@ NAME_EDIT_BACK_KEYBOARD = ReplyKeyboardMarkup([["🔙 انصراف و بازگش
 HEALTH_TIPS_FOR_CLUB = [ "روزانه حداقل ۸ لیوان آب بنوشید.", "خواب کافی (۷-۸ ساعت) ضروری است.", "حداقل ۳۰ دقیقه فعالیت بدنی روزانه داشته باشید." ]
 
 # --- توابع دیتابیس ---
-def get_or_create_user_profile(user_id: str, username: str = None, first_name: str = None) -> dict:
-    if not db:
-        logger.warning(f"DB: Firestore client (db) is None. Profile for user {user_id} will be in-memory mock.")
-        return {"user_id": user_id, "username": username, "first_name": first_name, "age": None, "gender": None, "is_club_member": False, "points": 0, "badges": [], "club_tip_usage_count": 0, "club_join_date": None, "name_first_db": None, "name_last_db": None, "full_profile_completion_points_awarded": False}
+# کش پروفایل: همه خواندن‌ها و نوشتن‌های profile_store از این کش عبور می‌کنند؛ بک‌اند ذخیره‌سازی در post_init انتخاب می‌شود
+profile_cache = ProfileCache(max_entries=PROFILE_CACHE_MAX_ENTRIES, ttl_seconds=PROFILE_CACHE_TTL_SECONDS)
+# جدول امتیازات با هر نوشتن profile_store به‌روز می‌شود و در post_init یک بار از روی بک‌اند بازسازی می‌شود
+leaderboard = Leaderboard(top_k=LEADERBOARD_TOP_K)
+profile_store.add_listener(leaderboard.observe)
+leaderboard_rebuild_task = None
+# پیام‌های متنی هندلرها از این صف ارسال می‌شوند؛ bot در post_init تنظیم می‌شود
+outbound = OutboundQueue(coalesce_window=OUTBOUND_COALESCE_WINDOW_SECONDS, rate_per_second=OUTBOUND_RATE_PER_SECOND,
+                         per_chat_rate=OUTBOUND_PER_CHAT_RATE_PER_SECOND, per_chat_burst=OUTBOUND_PER_CHAT_BURST)
+# تصاویر ربات یک بار آپلود و با file_id دوباره ارسال می‌شوند
+media_registry = MediaRegistry(MEDIA_REGISTRY_PATH, {"welcome": WELCOME_IMAGE_URL}, upload_chat_id=MEDIA_UPLOAD_CHAT_ID)
+update_tracer = UpdateTracer(slow_seconds=TRACE_SLOW_UPDATE_SECONDS, profile_sample_rate=TRACE_PROFILE_SAMPLE_RATE, profile_dir=TRACE_PROFILE_DIR, max_profiles=TRACE_PROFILE_MAX_FILES)
+broadcaster = None # در post_init و فقط با بک‌اند فعال ساخته می‌شود
 
-    user_ref = db.collection('users').document(user_id)
-    try: user_doc = user_ref.get()
-    except Exception as e:
-        logger.error(f"DB: خطا هنگام get() برای کاربر {user_id}: {e}", exc_info=True)
-        return {"user_id": user_id, "username": username, "first_name": first_name, "age": None, "gender": None, "is_club_member": False, "points": 0, "badges": [], "club_tip_usage_count": 0, "club_join_date": None, "name_first_db": None, "name_last_db": None, "full_profile_completion_points_awarded": False}
-
-    default_fields = {'age': None, 'gender': None, 'is_club_member': False, 'points': 0, 'badges': [], 'club_tip_usage_count': 0, 'club_join_date': None, 'name_first_db': None, 'name_last_db': None, 'full_profile_completion_points_awarded': False}
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        needs_update_in_db = False
-        for key, val in default_fields.items():
-            if key not in user_data: user_data[key] = val; needs_update_in_db = True
-        if needs_update_in_db:
-             update_payload = {k:v for k,v in default_fields.items() if k not in user_doc.to_dict()}
-             if update_payload:
-                try: user_ref.update(update_payload)
-                except Exception as e_upd: logger.error(f"DB: خطا آپدیت فیلد پیش‌فرض برای کاربر {user_id}: {e_upd}")
-        return user_data
-    else:
-        user_data = {'user_id': user_id, 'username': username, 'first_name': first_name, 'registration_date': firestore.SERVER_TIMESTAMP, 'last_interaction_date': firestore.SERVER_TIMESTAMP}
-        for key, val in default_fields.items(): user_data[key] = val
-        try: user_ref.set(user_data)
-        except Exception as e_set: logger.error(f"DB: خطا ایجاد پروفایل جدید برای کاربر {user_id}: {e_set}")
-        return user_data
-
-def update_user_profile_data(user_id: str, data_to_update: dict) -> None:
-    if not db: return
-    user_ref = db.collection('users').document(user_id)
-    data_to_update['last_updated_date'] = firestore.SERVER_TIMESTAMP
-    try:
-        user_ref.update(data_to_update)
-        logger.info(f"DB: پروفایل {user_id} با {data_to_update} آپدیت شد.")
-    except Exception as e:
-        logger.error(f"DB: خطا آپدیت پروفایل {user_id} با {data_to_update}: {e}", exc_info=True)
+# --- توابع کمکی ربات ---
+openrouter_client = OpenRouterClient(
+    OPENROUTER_API_KEY, max_concurrency=OPENROUTER_MAX_CONCURRENCY, max_retries=OPENROUTER_MAX_RETRIES,
+    request_timeout=OPENROUTER_REQUEST_TIMEOUT, queue_timeout=OPENROUTER_QUEUE_TIMEOUT,
+    breaker=CircuitBreaker(failure_threshold=OPENROUTER_BREAKER_THRESHOLD, reset_timeout=OPENROUTER_BREAKER_RESET_SECONDS),
+)
+
+# همه فراخوانی‌های LLM از این دروازه می‌گذرند؛ فراخوانی‌های پس‌زمینه (user_id=None) محدودیت نرخ کاربر ندارند
+llm_admission = AdmissionController(
+    max_concurrent=LLM_ADMISSION_MAX_CONCURRENT, max_queue=LLM_ADMISSION_MAX_QUEUE, rate_per_minute=LLM_USER_RATE_PER_MINUTE,
+    burst=LLM_USER_BURST, queue_timeout=LLM_ADMISSION_QUEUE_TIMEOUT,
+)
+
+# مسیریاب مدل: سریع‌ترین مدل سالم بر اساس p95 اخیر انتخاب می‌شود و در صورت کندی، درخواست موازی به مدل بعدی می‌رود
+model_router = ModelRouter(
+    OPENROUTER_MODEL_NAMES, window=OPENROUTER_ROUTER_WINDOW, max_error_rate=OPENROUTER_ROUTER_MAX_ERROR_RATE,
+    hedge_after_seconds=OPENROUTER_HEDGE_AFTER_SECONDS, cooldown_seconds=OPENROUTER_ROUTER_COOLDOWN_SECONDS,
+)
+
+metrics.LLM_IN_FLIGHT.set_function(lambda: openrouter_client.in_flight)
+metrics.LLM_ADMISSION_ACTIVE.set_function(lambda: llm_admission.active)
+metrics.LLM_ADMISSION_QUEUED.set_function(lambda: llm_admission.queued)
+event_loop_lag_monitor = metrics.EventLoopLagMonitor(EVENT_LOOP_LAG_INTERVAL_SECONDS)
 
-def get_user_profile_data(user_id: str) -> dict | None:
-    if not db: return None
-    user_ref = db.collection('users').document(user_id)
+async def ask_openrouter(system_prompt: str, chat_history: list, model_override: str = None, on_partial=None, user_id: str = None, on_queued=None) -> tuple[str, str | None]:
+    # خروجی: (متن پاسخ، مدلی که پاسخ داده)؛ برای پیام‌های خطا مدل None است
     try:
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            defaults = {'is_club_member': False, 'points': 0, 'badges': [], 'club_tip_usage_count': 0, 'club_join_date': None, 'age': None, 'gender': None, 'name_first_db': None, 'name_last_db': None, 'full_profile_completion_points_awarded': False}
-            for key, val in defaults.items():
-                if key not in user_data: user_data[key] = val
-            return user_data
-    except Exception as e:
-        logger.error(f"DB: خطا خواندن پروفایل {user_id}: {e}", exc_info=True)
-    return None
+        # فاصله دو span زمان انتظار در صف پذیرش LLM است
+        with tracing.span("llm.ask_openrouter", streaming=on_partial is not None):
+            async with llm_admission.slot(user_id, on_queued=on_queued):
+                with tracing.span("llm.request"): return await _ask_openrouter_admitted(system_prompt, chat_history, model_override, on_partial)
+    except RateLimitedError as e:
+        logger.info(f"Admission: کاربر {user_id} به محدودیت نرخ رسید (تلاش مجدد پس از {e.retry_after:.0f} ثانیه).")
+        return f"❌ سوالات شما پشت سر هم ارسال شده‌اند. لطفاً {max(1, round(e.retry_after))} ثانیه دیگر دوباره بپرسید.", None
+    except QueueFullError as e:
+        logger.warning(f"Admission: صف LLM پر است ({e.queue_length} در انتظار)؛ درخواست {user_id} رد شد.")
+        return f"❌ سرویس در حال حاضر بسیار شلوغ است و {e.queue_length} نفر در صف هستند. لطفاً چند دقیقه بعد دوباره تلاش کنید.", None
+    except QueueTimeoutError:
+        logger.warning(f"Admission: انتظار درخواست {user_id} در صف LLM طولانی شد.")
+        return "❌ سرویس هوش مصنوعی در حال حاضر شلوغ است. لطفاً کمی بعد دوباره تلاش کنید.", None
 
-# --- توابع کمکی ربات ---
-async def ask_openrouter(system_prompt: str, chat_history: list, model_override: str = None) -> str:
-    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
+async def _open_stream(body: dict):
+    # تا رسیدن اولین توکن منتظر می‌ماند تا مسیریاب زمان اولین توکن را بسنجد و بین درخواست‌های موازی برنده را انتخاب کند
+    stream = openrouter_client.stream_chat_completion(body)
+    try: return stream, await stream.__anext__()
+    except StopAsyncIteration: return stream, ""
+
+async def _discard_stream(opened) -> None:
+    await opened[0].aclose()
+
+async def _ask_openrouter_admitted(system_prompt: str, chat_history: list, model_override: str = None, on_partial=None) -> tuple[str, str | None]:
     messages_payload = [{"role": "system", "content": system_prompt}] + chat_history
-    current_model = model_override if model_override else OPENROUTER_MODEL_NAME
-    body = {"model": current_model, "messages": messages_payload, "temperature": 0.5}
-    logger.info(f"آماده‌سازی درخواست OpenRouter. مدل: {current_model}, تاریخچه: {len(chat_history)}.")
-    async with httpx.AsyncClient(timeout=90.0) as client:
-        try:
-            resp = await client.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=body)
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("choices") and data["choices"][0].get("message") and data["choices"][0]["message"].get("content"):
-                llm_response_content = data["choices"][0]["message"]["content"].strip()
-                logger.info(f"پاسخ LLM ({current_model}): '{llm_response_content}'")
-                return llm_response_content
-            logger.error(f"ساختار پاسخ OpenRouter ({current_model}) نامعتبر: {data}")
-            return "❌ مشکلی در پردازش پاسخ از سرویس هوش مصنوعی رخ داد."
-        except Exception as e:
-            logger.error(f"خطا در ارتباط OpenRouter ({current_model}): {e}", exc_info=True)
-            return "❌ بروز خطا در ارتباط با سرویس هوش مصنوعی."
+    streaming = on_partial is not None
+    logger.info(f"آماده‌سازی درخواست OpenRouter. مدل: {model_override or model_router.models[0]}, تاریخچه: {len(chat_history)}, استریم: {streaming}.")
+    body_for = lambda model: {"model": model, "messages": messages_payload, "temperature": 0.5}
+    current_model = model_override or "router"
+    try:
+        if streaming:
+            # حالت استریم: on_partial با متن تجمعی پس از هر توکن فراخوانی می‌شود
+            current_model, (stream, llm_response_content) = await model_router.run(
+                lambda model: _open_stream(body_for(model)), streaming=True, model_override=model_override, discard=_discard_stream)
+            if llm_response_content: await on_partial(llm_response_content)
+            try:
+                async for delta in stream:
+                    llm_response_content += delta
+                    await on_partial(llm_response_content)
+            except Exception:
+                # مسیریاب این فراخوانی را در اولین توکن موفق ثبت کرده است
+                model_router.record_failure(current_model, streaming=True)
+                raise
+            llm_response_content = llm_response_content.strip()
+            if llm_response_content:
+                logger.info(f"پاسخ استریم LLM ({current_model}): '{llm_response_content}'")
+                return llm_response_content, current_model
+            model_router.record_failure(current_model, streaming=True)
+            logger.error(f"استریم OpenRouter ({current_model}) بدون محتوا پایان یافت.")
+            return "❌ مشکلی در پردازش پاسخ از سرویس هوش مصنوعی رخ داد.", None
+        current_model, data = await model_router.run(lambda model: openrouter_client.chat_completion(body_for(model)), model_override=model_override)
+        if data.get("choices") and data["choices"][0].get("message") and data["choices"][0]["message"].get("content"):
+            llm_response_content = data["choices"][0]["message"]["content"].strip()
+            logger.info(f"پاسخ LLM ({current_model}): '{llm_response_content}'")
+            return llm_response_content, current_model
+        logger.error(f"ساختار پاسخ OpenRouter ({current_model}) نامعتبر: {data}")
+        return "❌ مشکلی در پردازش پاسخ از سرویس هوش مصنوعی رخ داد.", None
+    except (CircuitOpenError, ClientBusyError) as e:
+        logger.warning(f"OpenRouter ({current_model}) موقتاً در دسترس نیست: {e}")
+        return "❌ سرویس هوش مصنوعی در حال حاضر شلوغ یا در دسترس نیست. لطفاً کمی بعد دوباره تلاش کنید.", None
+    except Exception as e:
+        logger.error(f"خطا در ارتباط OpenRouter ({current_model}): {e}", exc_info=True)
+        return "❌ بروز خطا در ارتباط با سرویس هوش مصنوعی.", None
 
 def _prepare_doctor_system_prompt(age: int, gender: str) -> str:
     # پرامپت اصلاح شده و کوتاه‌تر برای دکتر تافته
@@ -189,37 +294,59 @@ def _prepare_doctor_system_prompt(age: int, gender: str) -> str:
         "لحن شما باید حرفه‌ای، همدلانه و محترمانه باشد، اما از عبارات بیش از حد احساسی یا شعاری خودداری کنید."
     )
 
-async def notify_points_awarded(bot: Application.bot, chat_id: int, user_id_str: str, points_awarded: int, reason: str):
-    if not db: return
-    try:
-        await asyncio.to_thread(get_or_create_user_profile, user_id_str) 
-        user_profile_updated = await asyncio.to_thread(get_user_profile_data, user_id_str)
-        total_points = user_profile_updated.get('points', 0) if user_profile_updated else points_awarded
-        message = f"✨ شما {points_awarded} امتیاز برای '{reason}' دریافت کردید!\nمجموع امتیاز شما اکنون: {total_points} است. 🌟"
-        await bot.send_message(chat_id=chat_id, text=message)
-        logger.info(f"اطلاع‌رسانی امتیاز به {user_id_str} برای '{reason}'. امتیاز: {points_awarded}, مجموع: {total_points}")
-    except Exception as e:
-        logger.error(f"خطا در اطلاع‌رسانی امتیاز به {user_id_str}: {e}", exc_info=True)
+async def _summarize_doctor_history(previous_summary: str | None, messages: list) -> str | None:
+    summary_system_prompt = ("شما دستیار خلاصه‌ساز یک گفتگوی پزشکی هستید. خلاصه‌ای فشرده (حداکثر ۸ جمله) به فارسی بنویسید که علائم، سوابق، "
+                             "پاسخ‌های کاربر به سوالات پزشک و توصیه‌های داده‌شده را حفظ کند. فقط خود خلاصه را بنویسید.")
+    transcript = "\n".join(f"{'کاربر' if m['role'] == 'user' else 'دکتر'}: {m['content']}" for m in messages)
+    if previous_summary: transcript = f"خلاصه قبلی: {previous_summary}\n\n{transcript}"
+    summary, _ = await ask_openrouter(summary_system_prompt, [{"role": "user", "content": transcript}], model_override=DOCTOR_SUMMARY_MODEL_NAME)
+    return None if summary.startswith("❌") else summary
 
-async def award_badge_if_not_already_awarded(bot: Application.bot, chat_id: int, user_id_str: str, badge_name: str):
-    if not db: return
-    try:
-        user_profile = await asyncio.to_thread(get_user_profile_data, user_id_str)
-        if user_profile:
-            current_badges = user_profile.get('badges', [])
-            if badge_name not in current_badges:
-                await asyncio.to_thread(update_user_profile_data, user_id_str, {'badges': firestore.ArrayUnion([badge_name])})
-                await bot.send_message(chat_id=chat_id, text=f"🏆 تبریک! شما نشان '{badge_name}' را دریافت کردید!")
-                logger.info(f"نشان '{badge_name}' به کاربر {user_id_str} اعطا شد.")
-    except Exception as e:
-        logger.error(f"خطا در اعطای نشان '{badge_name}' به {user_id_str}: {e}", exc_info=True)
+doctor_history = DoctorHistoryManager(_summarize_doctor_history, token_budget=DOCTOR_HISTORY_TOKEN_BUDGET, keep_recent_messages=DOCTOR_HISTORY_KEEP_RECENT_MESSAGES)
+
+async def _generate_health_tips(count: int) -> list[str]:
+    tip_system_prompt = (f"شما یک متخصص سلامت هستید. {count} نکته سلامتی کوتاه (هر کدام ۱-۲ جمله)، مفید، علمی و کاربردی و متنوع به فارسی ارائه دهید. "
+                         "نکات عمومی باشند و موضوع تکراری نداشته باشند. هر نکته را در یک خط جداگانه بنویسید، بدون شماره، عنوان یا مقدمه.")
+    raw_tips, _ = await ask_openrouter(tip_system_prompt, [{"role": "user", "content": f"{count} نکته سلامتی"}])
+    if raw_tips.startswith("❌"): return []
+    return parse_tip_lines(raw_tips)
+
+tip_pool = HealthTipPool(_generate_health_tips, HEALTH_TIPS_FOR_CLUB, target_size=TIP_POOL_TARGET_SIZE, batch_size=TIP_POOL_BATCH_SIZE)
+
+async def refill_tip_pool_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await tip_pool.rotate()
+
+doctor_answer_cache = None # در post_init ساخته می‌شود (opt-in)
+
+def _start_doctor_session(context: ContextTypes.DEFAULT_TYPE, age: int, gender: str) -> None:
+    context.user_data["system_prompt_for_doctor"] = _prepare_doctor_system_prompt(age, gender)
+    context.user_data["doctor_age"] = age
+    context.user_data["doctor_gender"] = gender
+
+def notify_points_awarded(chat_id: int, user_id_str: str, points_awarded: int, reason: str, total_points: int):
+    message = f"✨ شما {points_awarded} امتیاز برای '{reason}' دریافت کردید!\nمجموع امتیاز شما اکنون: {total_points} است. 🌟"
+    outbound.send(chat_id, message)
+    logger.info(f"اطلاع‌رسانی امتیاز به {user_id_str} برای '{reason}'. امتیاز: {points_awarded}, مجموع: {total_points}")
+
+def notify_badge_awarded(chat_id: int, user_id_str: str, badge_name: str):
+    outbound.send(chat_id, f"🏆 تبریک! شما نشان '{badge_name}' را دریافت کردید!")
+    logger.info(f"نشان '{badge_name}' به کاربر {user_id_str} اعطا شد.")
+
+def notify_rewards(chat_id: int, user_id_str: str, reward_result: rewards.RewardResult | None):
+    # نتیجه تراکنش شامل مجموع امتیاز و نشان‌های جدید است، پس برای اطلاع‌رسانی خواندن دوباره لازم نیست
+    # پیام‌ها از صف ارسال می‌روند و با پیام‌های قبل و بعد همین هندلر در یک پیام ادغام می‌شوند
+    if not reward_result: return
+    for points_awarded, reason in reward_result.points_awarded:
+        notify_points_awarded(chat_id, user_id_str, points_awarded, reason, reward_result.total_points)
+    for badge_name in reward_result.badges_awarded:
+        notify_badge_awarded(chat_id, user_id_str, badge_name)
 
 async def get_dynamic_main_menu_keyboard(context: ContextTypes.DEFAULT_TYPE, user_id_str: str) -> ReplyKeyboardMarkup:
     is_member = False
     if 'is_club_member_cached' in context.user_data: del context.user_data['is_club_member_cached']
-    if db:
+    if profile_store.is_enabled():
         try:
-            user_profile = await asyncio.to_thread(get_user_profile_data, user_id_str)
+            user_profile = await profile_store.get_user_profile_data(user_id_str)
             is_member = user_profile.get('is_club_member', False) if user_profile else False
             context.user_data['is_club_member_cached'] = is_member
         except Exception as e: logger.error(f"خطا خواندن وضعیت عضویت {user_id_str}: {e}"); is_member = False
@@ -236,14 +363,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
     message_prefix = "درخواست لغو شما انجام شد. " if context.user_data.get('_is_cancel_flow', False) else ""
     if context.user_data.get('_is_cancel_flow', False): del context.user_data['_is_cancel_flow']
     logger.info(f"کاربر {user_id_str} ({user.full_name or user.username}) /start یا بازگشت/لغو به منوی اصلی.")
-    keys_to_clear = ["doctor_chat_history", "system_prompt_for_doctor", "age_temp", "is_club_member_cached", 
+    keys_to_clear = ["doctor_chat_history", "doctor_chat_summary", "system_prompt_for_doctor", "doctor_age", "doctor_gender", "age_temp", "is_club_member_cached", 
                      "awaiting_field_to_edit", "temp_first_name", "profile_completion_flow_active", 
                      "club_join_after_profile_flow", "temp_profile_first_name", "temp_profile_last_name", "temp_profile_age"]
     for key in keys_to_clear:
         if key in context.user_data: del context.user_data[key]
     logger.info(f"اطلاعات جلسه برای {user_id_str} پاکسازی شد.")
-    if db: 
-        try: await asyncio.to_thread(get_or_create_user_profile, user_id_str, user.username, user.first_name)
+    if profile_store.is_enabled(): 
+        try: await profile_store.get_or_create_user_profile(user_id_str, user.username, user.first_name)
         except Exception as e: logger.error(f"خطا get_or_create_user_profile (start) برای {user_id_str}: {e}", exc_info=True)
     
     dynamic_main_menu = await get_dynamic_main_menu_keyboard(context, user_id_str)
@@ -255,19 +382,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         is_direct_start = update.message and update.message.text == "/start"
         is_photo_present = hasattr(update.message, 'photo') and update.message.photo
         if is_direct_start and not is_photo_present : 
-            await context.bot.send_photo(chat_id=effective_chat_id, photo=WELCOME_IMAGE_URL, caption=welcome_text, reply_markup=dynamic_main_menu)
+            await outbound.flush(effective_chat_id)
+            await media_registry.send_photo(context.bot, "welcome", chat_id=effective_chat_id, caption=welcome_text, reply_markup=dynamic_main_menu)
         else: 
-            await context.bot.send_message(chat_id=effective_chat_id, text=welcome_text, reply_markup=dynamic_main_menu)
+            outbound.send(effective_chat_id, welcome_text, reply_markup=dynamic_main_menu)
     except Exception as e:
         logger.error(f"خطا ارسال خوش‌آمدگویی برای {user_id_str}: {e}", exc_info=True)
-        await context.bot.send_message(chat_id=effective_chat_id, text=welcome_text, reply_markup=dynamic_main_menu)
+        outbound.send(effective_chat_id, welcome_text, reply_markup=dynamic_main_menu)
     return States.MAIN_MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
     user = update.effective_user; user_id = user.id if user else "Unknown"
     logger.info(f"User {user_id} called /cancel. Delegating to start handler.")
     context.user_data['_is_cancel_flow'] = True
-    if update.effective_chat: await context.bot.send_message(chat_id=update.effective_chat.id, text="درخواست شما لغو شد.", reply_markup=ReplyKeyboardRemove())
+    if update.effective_chat: outbound.reply(update, "درخواست شما لغو شد.", reply_markup=ReplyKeyboardRemove())
     return await start(update, context)
 
 async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
@@ -282,14 +410,13 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data['club_join_after_profile_flow'] = False 
         
         age, gender, name_first, name_last = None, None, None, None
-        if db:
-            user_profile = await asyncio.to_thread(get_user_profile_data, user_id_str)
+        if profile_store.is_enabled():
+            user_profile = await profile_store.get_user_profile_data(user_id_str)
             if user_profile: age, gender, name_first, name_last = user_profile.get("age"), user_profile.get("gender"), user_profile.get("name_first_db"), user_profile.get("name_last_db")
         
         if age and gender and name_first and name_last: 
-            system_prompt = _prepare_doctor_system_prompt(age, gender)
-            context.user_data["system_prompt_for_doctor"] = system_prompt
-            context.user_data["doctor_chat_history"] = []
+            _start_doctor_session(context, age, gender)
+            reset_history(context.user_data)
             await update.message.reply_text(f"مشخصات شما (نام: {name_first} {name_last}, سن: {age}، جنسیت: {gender}) موجود است.\nسوال پزشکی خود را بپرسید.", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
             return States.DOCTOR_CONVERSATION
         else: 
@@ -303,8 +430,8 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     elif text == "⭐ عضویت در باشگاه تافته": 
         age, gender, name_first, name_last = None, None, None, None
-        if db:
-            user_profile = await asyncio.to_thread(get_user_profile_data, user_id_str)
+        if profile_store.is_enabled():
+            user_profile = await profile_store.get_user_profile_data(user_id_str)
             if user_profile: age, gender, name_first, name_last = user_profile.get("age"), user_profile.get("gender"), user_profile.get("name_first_db"), user_profile.get("name_last_db")
         
         if not (age and gender and name_first and name_last): 
@@ -374,39 +501,31 @@ async def awaiting_profile_gender_handler(update: Update, context: ContextTypes.
     
     if not (first_name and last_name and age and gender_input in ["زن", "مرد"]):
         logger.error(f"خطا: اطلاعات ناقص پروفایل برای {user_id_str} در مرحله نهایی.")
-        await update.message.reply_text("مشکلی پیش آمد، از ابتدا تلاش کنید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+        outbound.reply(update, "مشکلی پیش آمد، از ابتدا تلاش کنید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
         for key_to_del in ['profile_completion_flow_active', 'club_join_after_profile_flow']: context.user_data.pop(key_to_del, None)
         return await start(update, context)
     
     gender = gender_input
-    awarded_full_profile_badge_and_points = False
-    if db:
+    reward_result = None
+    if profile_store.is_enabled():
         try:
-            user_profile_before = await asyncio.to_thread(get_user_profile_data, user_id_str)
-            update_payload = {"name_first_db": first_name, "name_last_db": last_name, "age": age, "gender": gender}
-            if user_profile_before and not user_profile_before.get('full_profile_completion_points_awarded', False):
-                update_payload["points"] = firestore.Increment(POINTS_FOR_FULL_PROFILE_COMPLETION)
-                update_payload["full_profile_completion_points_awarded"] = True
-                awarded_full_profile_badge_and_points = True
-            await asyncio.to_thread(update_user_profile_data, user_id_str, update_payload)
+            profile_fields = {"name_first_db": first_name, "name_last_db": last_name, "age": age, "gender": gender}
+            reward_result = await rewards.apply_event(user_id_str, rewards.EVENT_PROFILE_COMPLETED, profile_fields, create_fields={"username": user.username, "first_name": user.first_name})
             logger.info(f"پروفایل کامل {user_id_str} در DB ذخیره شد.")
-            if awarded_full_profile_badge_and_points: logger.info(f"کاربر {user_id_str} واجد شرایط امتیاز و نشان پروفایل کامل است.")
+            if reward_result and reward_result.points_awarded: logger.info(f"کاربر {user_id_str} واجد شرایط امتیاز و نشان پروفایل کامل است.")
         except Exception as e: logger.error(f"خطا ذخیره پروفایل کامل برای {user_id_str}: {e}", exc_info=True)
 
-    await update.message.reply_text(f"✅ پروفایل شما تکمیل شد:\nنام: {first_name} {last_name}\nسن: {age}\nجنسیت: {gender}", reply_markup=ReplyKeyboardRemove())
-    if awarded_full_profile_badge_and_points:
-        await notify_points_awarded(update.get_bot(), update.effective_chat.id, user_id_str, POINTS_FOR_FULL_PROFILE_COMPLETION, "تکمیل پروفایل (نام، سن و جنسیت)")
-        await award_badge_if_not_already_awarded(update.get_bot(), update.effective_chat.id, user_id_str, BADGE_FULL_PROFILE)
+    outbound.reply(update, f"✅ پروفایل شما تکمیل شد:\nنام: {first_name} {last_name}\nسن: {age}\nجنسیت: {gender}", reply_markup=ReplyKeyboardRemove())
+    notify_rewards(update.effective_chat.id, user_id_str, reward_result)
 
     if context.user_data.pop('club_join_after_profile_flow', False):
         logger.info(f"کاربر {user_id_str} پروفایل را تکمیل کرد، هدایت به تایید عضویت باشگاه.")
-        await update.message.reply_text("برای عضویت در باشگاه مشتریان تایید نهایی را انجام دهید:", reply_markup=CLUB_JOIN_CONFIRMATION_KEYBOARD)
+        outbound.reply(update, "برای عضویت در باشگاه مشتریان تایید نهایی را انجام دهید:", reply_markup=CLUB_JOIN_CONFIRMATION_KEYBOARD)
         return States.AWAITING_CLUB_JOIN_CONFIRMATION
     elif context.user_data.pop('profile_completion_flow_active', False): # اگر از مسیر دکتر تافته آمده بود
-        system_prompt = _prepare_doctor_system_prompt(age, gender)
-        context.user_data["system_prompt_for_doctor"] = system_prompt
-        context.user_data["doctor_chat_history"] = []
-        await update.message.reply_text("اکنون سوال پزشکی خود را از دکتر تافته بپرسید.", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+        _start_doctor_session(context, age, gender)
+        reset_history(context.user_data)
+        outbound.reply(update, "اکنون سوال پزشکی خود را از دکتر تافته بپرسید.", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
         return States.DOCTOR_CONVERSATION
     return await start(update, context)
 
@@ -414,40 +533,38 @@ async def handle_club_join_confirmation(update: Update, context: ContextTypes.DE
     user = update.effective_user; user_id_str = str(user.id); text = update.message.text
     logger.info(f"کاربر {user_id_str} به عضویت باشگاه پاسخ داد: '{text}'")
     if text == "✅ بله، عضو می‌شوم":
-        if not db:
-            await update.message.reply_text("سیستم باشگاه در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+        if not profile_store.is_enabled():
+            outbound.reply(update, "سیستم باشگاه در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
             return await start(update, context)
         try:
-            await asyncio.to_thread(get_or_create_user_profile, user_id_str, user.username, user.first_name)
-            await asyncio.to_thread(update_user_profile_data, user_id_str, {"is_club_member": True, "points": firestore.Increment(POINTS_FOR_JOINING_CLUB), "club_join_date": firestore.SERVER_TIMESTAMP})
+            reward_result = await rewards.apply_event(user_id_str, rewards.EVENT_CLUB_JOINED, create_fields={"username": user.username, "first_name": user.first_name})
             context.user_data['is_club_member_cached'] = True
-            await update.message.reply_text(f"عضویت شما در باشگاه تافته انجام شد! ✨", reply_markup=ReplyKeyboardRemove())
-            await notify_points_awarded(update.get_bot(), update.effective_chat.id, user_id_str, POINTS_FOR_JOINING_CLUB, "عضویت در باشگاه مشتریان")
-            await award_badge_if_not_already_awarded(update.get_bot(), update.effective_chat.id, user_id_str, BADGE_CLUB_MEMBER)
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="به منوی اصلی بازگشتید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+            outbound.reply(update, f"عضویت شما در باشگاه تافته انجام شد! ✨", reply_markup=ReplyKeyboardRemove())
+            notify_rewards(update.effective_chat.id, user_id_str, reward_result)
+            outbound.reply(update, "به منوی اصلی بازگشتید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
             return States.MAIN_MENU
         except Exception as e: logger.error(f"خطا در عضویت باشگاه برای {user_id_str}: {e}", exc_info=True)
     elif text == "❌ خیر، فعلاً نه":
-        await update.message.reply_text("متوجه شدم.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+        outbound.reply(update, "متوجه شدم.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
     else:
-        await update.message.reply_text("گزینه نامعتبر.", reply_markup=CLUB_JOIN_CONFIRMATION_KEYBOARD)
+        outbound.reply(update, "گزینه نامعتبر.", reply_markup=CLUB_JOIN_CONFIRMATION_KEYBOARD)
         return States.AWAITING_CLUB_JOIN_CONFIRMATION
     return await start(update, context)
 
 async def doctor_conversation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
     logger.info(f"--- DCH Entered --- User: {update.effective_user.id}, Text: '{update.message.text}', History: {len(context.user_data.get('doctor_chat_history', []))}")
     user_question = update.message.text; user = update.effective_user; user_id_str = str(user.id)
-    chat_history = context.user_data.get("doctor_chat_history", [])
+    chat_history = context.user_data.setdefault("doctor_chat_history", [])
     system_prompt = context.user_data.get("system_prompt_for_doctor")
     if not system_prompt:
         logger.warning(f"DCH: پرامپت دکتر برای {user_id_str} یافت نشد! بازسازی...")
         age_db, gender_db, name_f, name_l = None, None, None, None
-        if db:
-            profile_db = await asyncio.to_thread(get_user_profile_data, user_id_str)
+        if profile_store.is_enabled():
+            profile_db = await profile_store.get_user_profile_data(user_id_str)
             if profile_db: age_db, gender_db, name_f, name_l = profile_db.get("age"), profile_db.get("gender"), profile_db.get("name_first_db"), profile_db.get("name_last_db")
         if age_db and gender_db and name_f and name_l:
-            system_prompt = _prepare_doctor_system_prompt(age_db, gender_db)
-            context.user_data["system_prompt_for_doctor"] = system_prompt
+            _start_doctor_session(context, age_db, gender_db)
+            system_prompt = context.user_data["system_prompt_for_doctor"]
             logger.info(f"DCH: پرامپت دکتر برای {user_id_str} بازسازی شد.")
         else:
             logger.error(f"DCH: عدم امکان بازسازی پرامپت دکتر برای {user_id_str}. پروفایل ناقص. هدایت به تکمیل پروفایل.")
@@ -456,33 +573,68 @@ async def doctor_conversation_handler(update: Update, context: ContextTypes.DEFA
             return States.AWAITING_PROFILE_FIRST_NAME
     if user_question == "🔙 بازگشت به منوی اصلی": return await start(update, context)
     elif user_question == "❓ سوال جدید از دکتر":
-        context.user_data["doctor_chat_history"] = []
+        reset_history(context.user_data)
         await update.message.reply_text("تاریخچه پاک شد. سوال جدید:", reply_markup=DOCTOR_CONVERSATION_KEYBOARD); return States.DOCTOR_CONVERSATION
     chat_history.append({"role": "user", "content": user_question})
-    await update.message.reply_text("⏳ دکتر تافته در حال بررسی...")
-    assistant_response = await ask_openrouter(system_prompt, chat_history)
-    chat_history.append({"role": "assistant", "content": assistant_response})
-    await update.message.reply_text(assistant_response, parse_mode="Markdown", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+    # فقط اولین سوال هر گفتگو کش می‌شود؛ پاسخ آن تنها به سوال، گروه سنی، جنسیت و مدلی که واقعاً پاسخ داده وابسته است.
+    # مسیریاب ممکن است با هر مدل فهرست پاسخ دهد، پس جستجو به ترتیب رتبه فعلی مدل‌ها انجام می‌شود
+    cache_keys = {}
+    doctor_age, doctor_gender = context.user_data.get("doctor_age"), context.user_data.get("doctor_gender")
+    if doctor_answer_cache and len(chat_history) == 1 and doctor_age and doctor_gender:
+        cached_answer = None
+        for model in model_router.ranked(DOCTOR_STREAMING_ENABLED):
+            cache_key = make_cache_key(user_question, doctor_age, doctor_gender, model)
+            if cache_key is None: break
+            cache_keys[model] = cache_key
+            cached_answer = await doctor_answer_cache.get(cache_key)
+            if cached_answer: break
+        if cached_answer:
+            logger.info(f"DCH: پاسخ کش‌شده برای سوال اول کاربر {user_id_str} استفاده شد.")
+            chat_history.append({"role": "assistant", "content": cached_answer})
+            await send_markdown_reply(update.message, cached_answer, reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+            return States.DOCTOR_CONVERSATION
+    prompt_history = doctor_history.build_prompt_history(context.user_data)
+    if DOCTOR_STREAMING_ENABLED:
+        placeholder = await update.message.reply_text("⏳ دکتر تافته در حال بررسی...", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+        progressive = ProgressiveMessage(placeholder, min_interval=STREAM_EDIT_INTERVAL_SECONDS)
+        async def notify_queued(position: int) -> None:
+            await placeholder.edit_text(f"⏳ سرویس شلوغ است؛ نوبت شما در صف: {position}. لطفاً منتظر بمانید...")
+        assistant_response, answered_by = await ask_openrouter(system_prompt, prompt_history, on_partial=progressive.update, user_id=user_id_str, on_queued=notify_queued)
+        chat_history.append({"role": "assistant", "content": assistant_response})
+        doctor_history.maybe_compact(user.id, context.user_data)
+        await progressive.finalize(assistant_response, reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+    else:
+        await update.message.reply_text("⏳ دکتر تافته در حال بررسی...")
+        async def notify_queued(position: int) -> None:
+            await update.message.reply_text(f"⏳ سرویس شلوغ است؛ نوبت شما در صف: {position}. لطفاً منتظر بمانید...")
+        assistant_response, answered_by = await ask_openrouter(system_prompt, prompt_history, user_id=user_id_str, on_queued=notify_queued)
+        chat_history.append({"role": "assistant", "content": assistant_response})
+        doctor_history.maybe_compact(user.id, context.user_data)
+        await update.message.reply_text(assistant_response, parse_mode="Markdown", reply_markup=DOCTOR_CONVERSATION_KEYBOARD)
+    if answered_by in cache_keys and not assistant_response.startswith("❌"):
+        await doctor_answer_cache.put(cache_keys[answered_by], user_question, assistant_response)
     return States.DOCTOR_CONVERSATION
 
 async def my_profile_info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
     user = update.effective_user; user_id_str = str(user.id)
     logger.info(f"کاربر {user_id_str} /myprofile یا دکمه پروفایل.")
-    if not db:
-        await update.message.reply_text("سیستم پروفایل در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+    if not profile_store.is_enabled():
+        outbound.reply(update, "سیستم پروفایل در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
         return States.MAIN_MENU
     try:
-        profile = await asyncio.to_thread(get_or_create_user_profile, user_id_str, user.username, user.first_name)
+        profile = await profile_store.get_or_create_user_profile(user_id_str, user.username, user.first_name)
         msg = f"👤 **پروفایل شما** 👤\n\nنام: {profile.get('name_first_db') or profile.get('first_name') or ''} {profile.get('name_last_db','')}\nسن: {profile.get('age') or 'ثبت نشده'}\nجنسیت: {profile.get('gender') or 'ثبت نشده'}\n\n"
         if profile.get('is_club_member'):
             msg += f"عضویت باشگاه: ✅ فعال\nامتیاز: {profile.get('points',0)} 🌟\n"
+            rank = leaderboard.rank(user_id_str) if leaderboard.ready else None
+            if rank: msg += f"رتبه در باشگاه: {rank} از {len(leaderboard)} 🏆\n"
             badges = profile.get('badges', [])
             if badges: msg += "نشان‌ها:\n" + "".join([f"  - {b}\n" for b in badges])
             else: msg += "هنوز نشانی ندارید.\n"
-            await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=PROFILE_VIEW_KEYBOARD)
+            outbound.reply(update, msg, parse_mode="Markdown", reply_markup=PROFILE_VIEW_KEYBOARD)
             return States.PROFILE_VIEW
         else:
-            await update.message.reply_text("شما عضو باشگاه نیستید. برای مشاهده پروفایل، ابتدا از منو عضو شوید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+            outbound.reply(update, "شما عضو باشگاه نیستید. برای مشاهده پروفایل، ابتدا از منو عضو شوید.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
             return States.MAIN_MENU
     except Exception as e: logger.error(f"خطا نمایش پروفایل {user_id_str}: {e}", exc_info=True)
     return States.MAIN_MENU
@@ -504,20 +656,20 @@ async def handle_cancel_membership_confirmation(update: Update, context: Context
     user = update.effective_user; user_id_str = str(user.id); text = update.message.text
     logger.info(f"کاربر {user_id_str} به لغو عضویت پاسخ داد: '{text}'.")
     if text == "✅ بله، عضویتم لغو شود":
-        if not db:
-            await update.message.reply_text("سیستم باشگاه در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
+        if not profile_store.is_enabled():
+            outbound.reply(update, "سیستم باشگاه در دسترس نیست.", reply_markup=await get_dynamic_main_menu_keyboard(context, user_id_str))
             return await start(update, context)
         try:
             payload = {"is_club_member": False, "points": 0, "badges": [], "club_join_date": None, "club_tip_usage_count": 0, "age": None, "gender": None, "name_first_db": None, "name_last_db": None, "profile_completion_points_awarded": False, "full_profile_completion_points_awarded": False}
-            await asyncio.to_thread(update_user_profile_data, user_id_str, payload)
+            await profile_store.update_user_profile_data(user_id_str, payload)
             context.user_data['is_club_member_cached'] = False
-            await update.message.reply_text("عضویت شما لغو و اطلاعات پروفایل ریست شد.")
+            outbound.reply(update, "عضویت شما لغو و اطلاعات پروفایل ریست شد.")
         except Exception as e: logger.error(f"خطا لغو عضویت {user_id_str}: {e}", exc_info=True)
     elif text == "❌ خیر، منصرف شدم":
-        await update.message.reply_text("خوشحالیم که در باشگاه باقی می‌مانید!")
+        outbound.reply(update, "خوشحالیم که در باشگاه باقی می‌مانید!")
         return await my_profile_info_handler(update, context)
     else:
-        await update.message.reply_text("گزینه نامعتبر.", reply_markup=CANCEL_MEMBERSHIP_CONFIRMATION_KEYBOARD)
+        outbound.reply(update, "گزینه نامعتبر.", reply_markup=CANCEL_MEMBERSHIP_CONFIRMATION_KEYBOARD)
         return States.AWAITING_CANCEL_MEMBERSHIP_CONFIRMATION
     return await start(update, context)
 
@@ -536,55 +688,91 @@ async def edit_last_name_handler(update: Update, context: ContextTypes.DEFAULT_T
         if 'temp_edit_first_name' in context.user_data: del context.user_data['temp_edit_first_name']
         return await my_profile_info_handler(update, context)
     if not last_name_text or len(last_name_text) < 2 or len(last_name_text) > 50:
-        await update.message.reply_text("نام خانوادگی معتبر نیست.", reply_markup=NAME_EDIT_BACK_KEYBOARD); return States.AWAITING_EDIT_LAST_NAME
+        outbound.reply(update, "نام خانوادگی معتبر نیست.", reply_markup=NAME_EDIT_BACK_KEYBOARD); return States.AWAITING_EDIT_LAST_NAME
     first_name = context.user_data.pop('temp_edit_first_name', None)
     if not first_name: return await my_profile_info_handler(update, context)
     
-    awarded_full_profile_badge_on_edit = False
-    if db:
+    if profile_store.is_enabled():
         try:
-            user_profile_before = await asyncio.to_thread(get_user_profile_data, user_id_str)
-            update_payload = {"name_first_db": first_name, "name_last_db": last_name_text}
-            if user_profile_before and \
-               not user_profile_before.get('full_profile_completion_points_awarded', False) and \
-               first_name and last_name_text and \
-               user_profile_before.get('age') and user_profile_before.get('gender'):
-                update_payload["points"] = firestore.Increment(POINTS_FOR_FULL_PROFILE_COMPLETION)
-                update_payload["full_profile_completion_points_awarded"] = True
-                awarded_full_profile_badge_on_edit = True
-            
-            await asyncio.to_thread(update_user_profile_data, user_id_str, update_payload)
-            await update.message.reply_text(f"نام شما به '{first_name} {last_name_text}' به‌روز شد.")
-            if awarded_full_profile_badge_on_edit:
-                await notify_points_awarded(update.get_bot(), update.effective_chat.id, user_id_str, POINTS_FOR_FULL_PROFILE_COMPLETION, "تکمیل پروفایل (نام، سن و جنسیت)")
-                await award_badge_if_not_already_awarded(update.get_bot(), update.effective_chat.id, user_id_str, BADGE_FULL_PROFILE)
+            reward_result = await rewards.apply_event(user_id_str, rewards.EVENT_NAME_EDITED, {"name_first_db": first_name, "name_last_db": last_name_text})
+            outbound.reply(update, f"نام شما به '{first_name} {last_name_text}' به‌روز شد.")
+            notify_rewards(update.effective_chat.id, user_id_str, reward_result)
         except Exception as e: logger.error(f"خطا در ذخیره نام برای {user_id_str}: {e}", exc_info=True)
-    else: await update.message.reply_text(f"نام شما '{first_name} {last_name_text}' تنظیم شد (DB غیرفعال).")
+    else: outbound.reply(update, f"نام شما '{first_name} {last_name_text}' تنظیم شد (DB غیرفعال).")
     return await my_profile_info_handler(update, context)
 
 async def health_tip_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
     user = update.effective_user; user_id_str = str(user.id)
     logger.info(f"کاربر {user_id_str} درخواست نکته سلامتی.")
     dynamic_main_menu = await get_dynamic_main_menu_keyboard(context, user_id_str)
-    if not db:
-        await update.message.reply_text("سیستم باشگاه در دسترس نیست.", reply_markup=dynamic_main_menu); return States.MAIN_MENU
+    if not profile_store.is_enabled():
+        outbound.reply(update, "سیستم باشگاه در دسترس نیست.", reply_markup=dynamic_main_menu); return States.MAIN_MENU
     try:
-        user_profile = await asyncio.to_thread(get_user_profile_data, user_id_str)
+        user_profile = await profile_store.get_user_profile_data(user_id_str)
         if user_profile and user_profile.get('is_club_member'):
-            tip_system_prompt = ("شما یک متخصص سلامت هستید. یک نکته سلامتی کوتاه (۱-۲ جمله)، مفید، علمی و کاربردی به فارسی ارائه دهید. "
-                                 "نکته عمومی باشد. پاسخ فقط خود نکته باشد، بدون مقدمه.")
-            health_tip = await ask_openrouter(tip_system_prompt, [{"role": "user", "content": "یک نکته سلامتی"}])
-            if health_tip.startswith("❌"):
-                 await update.message.reply_text("قادر به ارائه نکته نیستم.", reply_markup=dynamic_main_menu); return States.MAIN_MENU
-            await update.message.reply_text(f"⚕️ **نکته سلامتی اعضا:**\n\n_{health_tip}_", parse_mode="Markdown", reply_markup=dynamic_main_menu)
-            new_tip_usage_count = user_profile.get('club_tip_usage_count', 0) + 1
-            await asyncio.to_thread(update_user_profile_data, user_id_str, {"club_tip_usage_count": new_tip_usage_count})
-            if new_tip_usage_count >= CLUB_TIP_BADGE_THRESHOLD:
-                await award_badge_if_not_already_awarded(update.get_bot(), update.effective_chat.id, user_id_str, BADGE_HEALTH_EXPLORER)
-        else: await update.message.reply_text("این بخش مخصوص اعضای باشگاه است.", reply_markup=dynamic_main_menu)
+            health_tip = await tip_pool.get_tip(user_id_str)
+            outbound.reply(update, f"⚕️ **نکته سلامتی اعضا:**\n\n_{health_tip}_", parse_mode="Markdown", reply_markup=dynamic_main_menu)
+            reward_result = await rewards.apply_event(user_id_str, rewards.EVENT_HEALTH_TIP_USED)
+            notify_rewards(update.effective_chat.id, user_id_str, reward_result)
+        else: outbound.reply(update, "این بخش مخصوص اعضای باشگاه است.", reply_markup=dynamic_main_menu)
     except Exception as e: logger.error(f"خطا ارسال نکته سلامتی برای {user_id_str}: {e}", exc_info=True)
     return States.MAIN_MENU
 
+async def leaderboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user; user_id_str = str(user.id)
+    logger.info(f"کاربر {user_id_str} /leaderboard.")
+    dynamic_main_menu = await get_dynamic_main_menu_keyboard(context, user_id_str)
+    if not profile_store.is_enabled() or not leaderboard.ready:
+        await update.message.reply_text("جدول امتیازات در حال حاضر در دسترس نیست. لطفاً کمی بعد دوباره تلاش کنید.", reply_markup=dynamic_main_menu); return
+    rows = leaderboard.top()
+    if not rows:
+        await update.message.reply_text("هنوز عضوی در جدول امتیازات باشگاه نیست.", reply_markup=dynamic_main_menu); return
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    lines = [f"{medals.get(rank, f'{rank}.')} {name or 'عضو باشگاه'}: {points} امتیاز{' (شما)' if uid == user_id_str else ''}" for rank, uid, name, points in rows]
+    rank = leaderboard.rank(user_id_str)
+    if rank and all(uid != user_id_str for _, uid, _, _ in rows): lines.append(f"\nرتبه شما: {rank} از {len(leaderboard)} با {leaderboard.points(user_id_str)} امتیاز")
+    # نام‌ها ورودی کاربر هستند، پس بدون parse_mode ارسال می‌شود
+    await update.message.reply_text("🏆 جدول امتیازات باشگاه تافته 🏆\n\n" + "\n".join(lines), reply_markup=dynamic_main_menu)
+
+async def broadcast_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /broadcast <متن> اطلاعیه می‌فرستد؛ /broadcast بدون متن یک نکته سلامتی از استخر نکات را برای همه اعضا می‌فرستد
+    user_id_str = str(update.effective_user.id)
+    if broadcaster is None:
+        await update.message.reply_text("ارسال همگانی در دسترس نیست (دیتابیس فعال نیست)."); return
+    text = update.message.text.partition(" ")[2].strip()
+    if text: parse_mode = None
+    else: text, parse_mode = f"⚕️ **نکته سلامتی اعضا:**\n\n_{await tip_pool.get_tip(user_id_str)}_", "Markdown"
+    try: state = broadcaster.start(text, parse_mode=parse_mode, requested_by=update.effective_chat.id)
+    except BroadcastInProgress as e:
+        await update.message.reply_text(f"ارسال همگانی {e} در حال اجراست. وضعیت: /broadcast_status"); return
+    logger.info(f"ادمین {user_id_str} ارسال همگانی {state['id']} را شروع کرد.")
+    await update.message.reply_text(f"📣 ارسال همگانی {state['id']} شروع شد. وضعیت: /broadcast_status | توقف: /broadcast_cancel")
+
+async def broadcast_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    progress = broadcaster.progress() if broadcaster else None
+    pending = broadcaster.pending() if broadcaster and not broadcaster.running else None
+    if progress: await update.message.reply_text(f"وضعیت ارسال همگانی: {progress}")
+    elif pending: await update.message.reply_text(f"ارسال همگانی ناتمام {pending['id']} ({pending['sent']} ارسال). ادامه: /broadcast_resume")
+    else: await update.message.reply_text("ارسال همگانی در جریان نیست.")
+
+async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if broadcaster is None or not broadcaster.running:
+        await update.message.reply_text("ارسال همگانی در جریان نیست."); return
+    await broadcaster.cancel()
+    await update.message.reply_text(f"ارسال همگانی متوقف شد: {broadcaster.progress()}\nادامه: /broadcast_resume")
+
+async def broadcast_resume_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if broadcaster is None:
+        await update.message.reply_text("ارسال همگانی در دسترس نیست (دیتابیس فعال نیست)."); return
+    try: state = broadcaster.resume()
+    except BroadcastInProgress as e:
+        await update.message.reply_text(f"ارسال همگانی {e} در حال اجراست."); return
+    await update.message.reply_text(f"ادامه ارسال همگانی {state['id']}." if state else "ارسال همگانی ناتمامی وجود ندارد.")
+
+async def outbound_ordering_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # پیام‌های صف‌شده آپدیت قبلی همین چت پیش از پاسخ‌های مستقیم آپدیت جدید (مثل پیام در حال استریم دکتر) ارسال می‌شوند
+    if update.effective_chat: await outbound.flush(update.effective_chat.id)
+
 async def fallback_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user; user_id_str = str(user.id) if user else "UnknownUser"
     dynamic_main_menu = await get_dynamic_main_menu_keyboard(context, user_id_str)
@@ -593,26 +781,126 @@ async def fallback_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await context.bot.send_message(chat_id=update.effective_chat.id, text="متاسفم، متوجه نشدم. لطفاً از منو انتخاب کنید یا /start را بزنید.", reply_markup=dynamic_main_menu)
     else: logger.error(f"Fallback: no effective_chat for {user_id_str}")
 
-# --- Flask App & Main Execution ---
-flask_app = Flask(__name__)
-@flask_app.route('/')
-def health_check(): return 'ربات تلگرام تافته فعال است!', 200
+# --- Web Server & Main Execution ---
+async def _create_storage_backend() -> ProfileBackend | None:
+    global db
+    if STORAGE_BACKEND == "sqlite":
+        try: return SqliteBackend(SQLITE_STORAGE_PATH)
+        except Exception as e: logger.error(f"خطا در راه‌اندازی بک‌اند SQLite در '{SQLITE_STORAGE_PATH}': {e}", exc_info=True)
+        return None
+    with metrics.startup_phase("firebase_init"): db = await asyncio.to_thread(init_firebase)
+    if db is None:
+        logger.warning("*"*65 + "\n* دیتابیس Firestore مقداردهی اولیه نشده! ربات با قابلیت محدود اجرا می‌شود. *\n" + "*"*65)
+        return None
+    if FIRESTORE_ASYNC_ENABLED:
+        from firebase_admin import firestore_async
+        try: return FirestoreBackend(firestore_async.client())
+        except Exception as e: logger.error(f"خطا در ساخت کلاینت async فایراستور، استفاده از مسیر sync: {e}", exc_info=True)
+    return FirestoreSyncBackend(db)
 
-def run_flask_app():
-    port = int(os.environ.get('PORT', 8080))
-    logger.info(f"ترد Flask: شروع وب سرور روی 0.0.0.0:{port}")
-    try: flask_app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
-    except Exception as e: logger.error(f"ترد Flask: خطا در اجرا: {e}", exc_info=True)
+async def _warm_up(tasks: dict) -> None:
+    # شکست یا کندی گرم کردن مانع شروع ربات نمی‌شود؛ فقط هزینه اتصال به اولین کاربر منتقل می‌شود
+    done, pending = await asyncio.wait(tasks.values(), timeout=STARTUP_WARMUP_TIMEOUT_SECONDS)
+    for name, task in tasks.items():
+        if task in pending:
+            task.cancel()
+            logger.warning(f"گرم کردن '{name}' در {STARTUP_WARMUP_TIMEOUT_SECONDS} ثانیه تمام نشد و رها شد.")
+        elif task.exception() is not None: logger.warning(f"گرم کردن '{name}' ناموفق بود: {task.exception()}")
+        else: logger.info(f"گرم کردن '{name}' انجام شد.")
 
-if __name__ == '__main__':
-    logger.info("بلوک اصلی برنامه آغاز شد.")
-    if db is None: logger.warning("*"*65 + "\n* دیتابیس Firestore مقداردهی اولیه نشده! ربات با قابلیت محدود اجرا می‌شود. *\n" + "*"*65)
+async def _rebuild_leaderboard(backend: ProfileBackend) -> None:
+    try:
+        with metrics.startup_phase("leaderboard_rebuild"): await leaderboard.rebuild(backend, page_size=LEADERBOARD_REBUILD_PAGE_SIZE)
+    except Exception as e: logger.error(f"خطا در بازسازی جدول امتیازات: {e}", exc_info=True)
+
+async def resync_leaderboard_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if leaderboard_rebuild_task and not leaderboard_rebuild_task.done(): return
+    try: await leaderboard.rebuild(context.job.data, page_size=LEADERBOARD_REBUILD_PAGE_SIZE)
+    except Exception as e: logger.error(f"خطا در همگام‌سازی دوره‌ای جدول امتیازات: {e}", exc_info=True)
 
-    flask_thread = threading.Thread(target=run_flask_app, name="FlaskThread", daemon=True)
-    flask_thread.start()
-    logger.info("ترد Flask شروع به کار کرد.")
+async def _post_init(application: Application) -> None:
+    global doctor_answer_cache, leaderboard_rebuild_task, broadcaster
+    with metrics.startup_phase("post_init"):
+        await openrouter_client.start()
+        outbound.start(application.bot)
+        metrics.OUTBOUND_PENDING.set_function(lambda: outbound.pending)
+        # اتصال TLS/HTTP2 به OpenRouter همزمان با راه‌اندازی دیتابیس باز می‌شود
+        warm_up_tasks = {"openrouter": asyncio.create_task(openrouter_client.warm_up()), "media": asyncio.create_task(media_registry.warm_up(application.bot))}
+        if METRICS_ENABLED: event_loop_lag_monitor.start()
+        if DOCTOR_ANSWER_CACHE_ENABLED and doctor_answer_cache is None:
+            try:
+                doctor_answer_cache = DoctorAnswerCache(DOCTOR_ANSWER_CACHE_PATH, max_entries=DOCTOR_ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=DOCTOR_ANSWER_CACHE_TTL_SECONDS)
+                logger.info(f"کش پاسخ دکتر در '{DOCTOR_ANSWER_CACHE_PATH}' فعال شد.")
+            except Exception as e: logger.error(f"خطا در راه‌اندازی کش پاسخ دکتر: {e}", exc_info=True)
+        with metrics.startup_phase("storage_backend"): backend = await _create_storage_backend()
+        write_behind = None
+        if backend is not None and WRITE_BEHIND_ENABLED:
+            write_behind = WriteBehindBuffer(backend, interval=WRITE_BEHIND_INTERVAL_SECONDS, max_batch=WRITE_BEHIND_MAX_BATCH,
+                                             spill_path=WRITE_BEHIND_SPILL_PATH or None, drain_timeout=WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS)
+            metrics.WRITE_BEHIND_PENDING.set_function(lambda: write_behind.pending_users)
+        profile_store.configure(backend, cache=profile_cache, write_behind=write_behind)
+        if backend is not None: warm_up_tasks["storage"] = asyncio.create_task(backend.warm_up())
+        with metrics.startup_phase("warm_up"): await _warm_up(warm_up_tasks)
+        # اسکن کامل پروفایل‌ها شروع ربات را معطل نمی‌کند؛ تا پایان آن /leaderboard پیام «در دسترس نیست» می‌دهد
+        if backend is not None: leaderboard_rebuild_task = asyncio.create_task(_rebuild_leaderboard(backend))
+        if backend is not None:
+            broadcaster = Broadcaster(application.bot, backend, BROADCAST_CHECKPOINT_PATH, rate_per_second=BROADCAST_RATE_PER_SECOND,
+                                      workers=BROADCAST_WORKERS, page_size=BROADCAST_PAGE_SIZE)
+            if BROADCAST_AUTO_RESUME and broadcaster.pending(): broadcaster.resume()
+        if application.job_queue:
+            application.job_queue.run_repeating(refill_tip_pool_job, interval=TIP_POOL_REFILL_INTERVAL_SECONDS, first=1, name="tip_pool_refill")
+            if backend is not None and LEADERBOARD_RESYNC_INTERVAL_SECONDS > 0:
+                application.job_queue.run_repeating(resync_leaderboard_job, interval=LEADERBOARD_RESYNC_INTERVAL_SECONDS, first=LEADERBOARD_RESYNC_INTERVAL_SECONDS,
+                                                    data=backend, name="leaderboard_resync")
+        else: logger.warning("JobQueue در دسترس نیست (python-telegram-bot[job-queue])؛ استخر نکات فقط هنگام خالی شدن پر می‌شود.")
 
-    telegram_application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+async def _post_shutdown(application: Application) -> None:
+    if leaderboard_rebuild_task and not leaderboard_rebuild_task.done(): leaderboard_rebuild_task.cancel()
+    # checkpoint ارسال همگانی ذخیره می‌ماند و در اجرای بعدی ادامه می‌یابد
+    if broadcaster: await broadcaster.cancel()
+    await outbound.close()
+    await openrouter_client.close()
+    await media_registry.close()
+    logger.info(f"آمار تصاویر ربات: {media_registry.stats()}")
+    await event_loop_lag_monitor.stop()
+    logger.info(f"آمار کش پروفایل: {profile_cache.stats()}")
+    await profile_store.close()
+    logger.info(f"آمار استخر نکات سلامتی: {tip_pool.stats()}")
+    logger.info(f"آمار کنترل پذیرش LLM: {llm_admission.stats()}")
+    logger.info(f"آمار مسیریاب مدل: {model_router.stats()}")
+    logger.info(f"آمار جدول امتیازات: {leaderboard.stats()}")
+    if TRACING_ENABLED: logger.info(f"آمار ردیابی آپدیت‌ها: {update_tracer.stats()}")
+    if isinstance(application.update_processor, UserOrderedUpdateProcessor): logger.info(f"آمار پردازش همزمان آپدیت‌ها: {application.update_processor.stats()}")
+    if application.persistence: logger.info(f"آمار Persistence: {application.persistence.stats()}")
+    if doctor_answer_cache:
+        logger.info(f"آمار کش پاسخ دکتر: {doctor_answer_cache.stats()}")
+        doctor_answer_cache.close()
+
+def _instrument_handlers(handlers: list, wrap=metrics.instrument_handler) -> None:
+    # هر callback با نام تابع خودش اندازه‌گیری می‌شود؛ فراخوانی‌های تو در تو (مثل start از داخل هندلرها) جداگانه شمرده نمی‌شوند
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            _instrument_handlers(handler.entry_points + handler.fallbacks + [h for state_handlers in handler.states.values() for h in state_handlers], wrap)
+        elif hasattr(handler, "callback"):
+            name = getattr(handler.callback, "__name__", "unknown")
+            handler.callback = wrap(handler.callback, "inline_reply" if name == "<lambda>" else name)
+
+def build_application(request: BaseRequest | None = None, concurrent_updates: int | None = None) -> Application:
+    # request و concurrent_updates فقط برای تست بار (loadtest.py) جایگزین می‌شوند تا درخواست‌های Bot API به سرور واقعی نروند
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(_post_init).post_shutdown(_post_shutdown)
+    if request is not None: builder = builder.request(request)
+    concurrent_updates = CONCURRENT_UPDATES if concurrent_updates is None else concurrent_updates
+    if concurrent_updates > 1:
+        # کاربران مختلف موازی، آپدیت‌های هر کاربر به ترتیب؛ یک پاسخ کند LLM دیگر منوی بقیه را معطل نمی‌کند
+        update_processor = UserOrderedUpdateProcessor(concurrent_updates, max_pending_updates=CONCURRENT_UPDATES_MAX_PENDING)
+        builder = builder.concurrent_updates(update_processor)
+        metrics.UPDATES_ACTIVE.set_function(lambda: update_processor.active)
+        metrics.UPDATES_WAITING.set_function(lambda: update_processor.waiting)
+    # هر درخواست Bot API یک span در trace آپدیت جاری است
+    if TRACING_ENABLED: builder = builder.rate_limiter(TracingRateLimiter())
+    if PERSISTENCE_ENABLED:
+        builder = builder.persistence(SqlitePersistence(PERSISTENCE_PATH, state_enum=States, update_interval=PERSISTENCE_UPDATE_INTERVAL_SECONDS))
+    telegram_application = builder.build()
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -629,16 +917,140 @@ if __name__ == '__main__':
             States.AWAITING_EDIT_LAST_NAME: [MessageHandler(filters.Regex("^🔙 انصراف و بازگشت به پروفایل$"), profile_view_handler), MessageHandler(filters.TEXT & ~filters.COMMAND, edit_last_name_handler)],
         },
         fallbacks=[CommandHandler("cancel", cancel), CommandHandler("start", start), MessageHandler(filters.Regex("^🔙 بازگشت به منوی اصلی$"), start)],
-        persistent=False, name="main_conversation", allow_reentry=True # allow_reentry اضافه شده
+        persistent=PERSISTENCE_ENABLED, name="main_conversation", allow_reentry=True # allow_reentry اضافه شده
     )
-    telegram_application.add_handler(CommandHandler("myprofile", my_profile_info_handler))
-    telegram_application.add_handler(CommandHandler("clubtip", health_tip_command_handler))
-    telegram_application.add_handler(conv_handler)
-    telegram_application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_message))
-    logger.info("ربات تلگرام در حال شروع polling...")
+    admin_filter = filters.User(user_id=ADMIN_USER_IDS) # فهرست خالی = هیچ کاربری
+    handlers = [CommandHandler("myprofile", my_profile_info_handler), CommandHandler("clubtip", health_tip_command_handler),
+                CommandHandler("leaderboard", leaderboard_handler),
+                CommandHandler("broadcast", broadcast_command_handler, filters=admin_filter),
+                CommandHandler("broadcast_status", broadcast_status_handler, filters=admin_filter),
+                CommandHandler("broadcast_cancel", broadcast_cancel_handler, filters=admin_filter),
+                CommandHandler("broadcast_resume", broadcast_resume_handler, filters=admin_filter), conv_handler,
+                MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_message)]
+    if METRICS_ENABLED: _instrument_handlers(handlers)
+    if TRACING_ENABLED: _instrument_handlers(handlers, update_tracer.wrap)
+    for handler in handlers: telegram_application.add_handler(handler)
+    telegram_application.add_handler(TypeHandler(Update, outbound_ordering_guard), group=-1)
+    return telegram_application
+
+def _webhook_secret_token() -> str:
+    if WEBHOOK_SECRET_TOKEN: return WEBHOOK_SECRET_TOKEN
+    # تلگرام فقط کاراکترهای A-Z, a-z, 0-9, _ و - را می‌پذیرد؛ hex از توکن ربات مشتق می‌شود تا بدون تنظیم اضافه هم امن باشد
+    return hashlib.sha256(f"tafteh-webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+
+def _shard_secret() -> str:
+    if SHARD_SECRET: return SHARD_SECRET
+    return hashlib.sha256(f"tafteh-shard:{TELEGRAM_TOKEN}".encode()).hexdigest()
+
+def _worker_path(path: str, name: str) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+def _worker_env(name: str, index: int) -> dict:
+    # وضعیت گفتگو، checkpoint ارسال همگانی، فایل spill نوشتن‌های پروفایل و پروفایل‌های cProfile مال هر worker است؛ بک‌اند پروفایل‌ها، کش پاسخ دکتر و file_id تصاویر مشترک‌اند
+    return {"SHARD_WORKER_NAME": name, "SHARD_SECRET": _shard_secret(), "PERSISTENCE_PATH": _worker_path(PERSISTENCE_PATH, name),
+            "BROADCAST_CHECKPOINT_PATH": _worker_path(BROADCAST_CHECKPOINT_PATH, name), "TRACE_PROFILE_DIR": os.path.join(TRACE_PROFILE_DIR, name),
+            "WRITE_BEHIND_SPILL_PATH": _worker_path(WRITE_BEHIND_SPILL_PATH, name) if WRITE_BEHIND_SPILL_PATH else "",
+            # سقف سراسری ارسال تلگرام بین workerها تقسیم می‌شود
+            "OUTBOUND_RATE_PER_SECOND": str(OUTBOUND_RATE_PER_SECOND / max(SHARD_WORKERS, 1))}
+
+def _shard_nodes() -> dict:
+    if not SHARD_WORKER_URLS: return {f"w{i}": None for i in range(SHARD_WORKERS)}
+    nodes = {}
+    for i, entry in enumerate(SHARD_WORKER_URLS):
+        name, _, url = entry.partition("=")
+        if not url or "://" in name: name, url = f"w{i}", entry
+        nodes[name] = url
+    return nodes
+
+async def run_bot(mode: str) -> None:
+    telegram_application = build_application()
+    # worker: آپدیت‌ها را dispatcher با توکن مخفی shard به مسیر داخلی می‌فرستد؛ تلگرام این فرایند را نمی‌شناسد
+    secret_token = _webhook_secret_token() if mode == "webhook" else _shard_secret() if mode == "worker" else None
+    webhook_path = WEBHOOK_PATH if mode == "webhook" else sharding.UPDATE_PATH if mode == "worker" else None
+    extra_routes = None
+    if mode == "worker":
+        handoff = WorkerHandoff(telegram_application, state_enum=States, release_user=profile_store.release_user)
+        handoff.install()
+        extra_routes = worker_routes(handoff, _shard_secret())
+    readiness_checks = {"updater": lambda: telegram_application.updater.running} if mode == "polling" else {}
+    web_app = build_web_app(telegram_application, webhook_path=webhook_path, secret_token=secret_token, readiness_checks=readiness_checks,
+                            metrics_registry=metrics.REGISTRY if METRICS_ENABLED else None, extra_routes=extra_routes)
+    server = build_server(web_app, WEB_HOST, WEB_PORT)
+    async with telegram_application:
+        # post_init/post_shutdown فقط توسط run_polling/run_webhook خودکار صدا زده می‌شوند
+        await _post_init(telegram_application)
+        try:
+            await telegram_application.start()
+            if mode == "webhook":
+                if not WEBHOOK_BASE_URL: raise RuntimeError("برای حالت webhook متغیر WEBHOOK_URL (یا RENDER_EXTERNAL_URL) لازم است.")
+                webhook_url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+                await telegram_application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=secret_token)
+                logger.info(f"وب‌هوک تلگرام روی {webhook_url} تنظیم شد.")
+            elif mode == "polling":
+                await telegram_application.bot.delete_webhook()
+                await telegram_application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("ربات تلگرام در حال polling است.")
+            metrics.record_startup_phase("ready", time.perf_counter() - _IMPORT_STARTED_AT)
+            logger.info(f"وب سرور ASGI روی {WEB_HOST}:{WEB_PORT} (حالت: {mode}{f'، {SHARD_WORKER_NAME}' if mode == 'worker' else ''}) شروع به کار کرد.")
+            await server.serve()
+        finally:
+            if telegram_application.updater.running: await telegram_application.updater.stop()
+            if telegram_application.running: await telegram_application.stop()
+            await _post_shutdown(telegram_application)
+            if mode == "worker": logger.info(f"آمار انتقال کاربران ({SHARD_WORKER_NAME}): {handoff.stats()}")
+
+async def run_sharded(mode: str) -> None:
+    # این فرایند فقط آپدیت‌ها را می‌گیرد (وب‌هوک یا polling) و بر اساس hash کاربر بین workerها پخش می‌کند؛
+    # هر worker یک Application کامل است و user_data و وضعیت گفتگوی کاربرانش فقط در همان worker است
+    secret_token = _webhook_secret_token() if mode == "webhook" else None
+    pool = None if SHARD_WORKER_URLS else LocalWorkerPool(os.path.abspath(__file__), base_port=SHARD_BASE_PORT, env_for=_worker_env)
+    dispatcher = ShardDispatcher(_shard_secret(), state_path=SHARD_STATE_PATH, pool=pool)
+    web_app = build_dispatcher_app(dispatcher, webhook_path=WEBHOOK_PATH if mode == "webhook" else None, secret_token=secret_token,
+                                   metrics_registry=metrics.REGISTRY if METRICS_ENABLED else None)
+    server = build_server(web_app, WEB_HOST, WEB_PORT)
+    polling_task = None
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        try:
+            # file_id تصاویر یک بار اینجا ساخته می‌شود و workerها آن را از فایل مشترک می‌خوانند
+            if MEDIA_UPLOAD_CHAT_ID is not None:
+                try: await asyncio.wait_for(media_registry.warm_up(bot), timeout=STARTUP_WARMUP_TIMEOUT_SECONDS)
+                except Exception as e: logger.warning(f"گرم کردن 'media' در dispatcher ناموفق بود: {e}")
+            await dispatcher.start(_shard_nodes())
+            if mode == "webhook":
+                if not WEBHOOK_BASE_URL: raise RuntimeError("برای حالت webhook متغیر WEBHOOK_URL (یا RENDER_EXTERNAL_URL) لازم است.")
+                webhook_url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+                await bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=secret_token)
+                logger.info(f"وب‌هوک تلگرام روی {webhook_url} تنظیم شد.")
+            else:
+                await bot.delete_webhook()
+                polling_task = asyncio.create_task(dispatcher.poll(bot), name="shard-polling")
+                logger.info("dispatcher در حال polling است.")
+            metrics.record_startup_phase("ready", time.perf_counter() - _IMPORT_STARTED_AT)
+            logger.info(f"dispatcher روی {WEB_HOST}:{WEB_PORT} (حالت: {mode}) با {len(dispatcher.ring.nodes)} worker شروع به کار کرد.")
+            await server.serve()
+        finally:
+            if polling_task is not None:
+                polling_task.cancel()
+                try: await polling_task
+                except asyncio.CancelledError: pass
+            await dispatcher.close()
+            await media_registry.close()
+
+metrics.record_startup_phase("imports", time.perf_counter() - _IMPORT_STARTED_AT)
+
+if __name__ == '__main__':
+    logger.info("بلوک اصلی برنامه آغاز شد.")
+    if STORAGE_BACKEND not in ("firestore", "sqlite"):
+        logger.error(f"STORAGE_BACKEND نامعتبر: '{STORAGE_BACKEND}'. مقادیر مجاز: firestore یا sqlite.")
+        exit(1)
+    if BOT_MODE not in ("polling", "webhook", "worker"):
+        logger.error(f"BOT_MODE نامعتبر: '{BOT_MODE}'. مقادیر مجاز: polling، webhook یا worker.")
+        exit(1)
     try:
-        telegram_application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if BOT_MODE != "worker" and (SHARD_WORKERS > 0 or SHARD_WORKER_URLS): asyncio.run(run_sharded(BOT_MODE))
+        else: asyncio.run(run_bot(BOT_MODE))
     except Exception as e:
-        logger.critical(f"خطای مرگبار در run_polling: {e}", exc_info=True)
+        logger.critical(f"خطای مرگبار در اجرای ربات ({BOT_MODE}): {e}", exc_info=True)
     finally:
-        logger.info("برنامه در حال خاتمه است.")
\ No newline at end of file
+        logger.info("برنامه در حال خاتمه است.")
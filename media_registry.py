@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+import httpx
+from telegram.error import BadRequest
+
+from checkpoint import load_checkpoint, save_checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+class MediaRegistry:
+    # هر asset (نام -> URL) یک بار به تلگرام آپلود و file_id آن در فایل JSON محلی ذخیره می‌شود؛ ارسال‌های بعدی فقط file_id را می‌فرستند
+    # و به دسترس‌پذیری سایت وابسته نیستند. در شروع، محتوای URL دوباره دانلود و با sha256 ذخیره‌شده مقایسه می‌شود؛ اگر عوض شده باشد
+    # file_id کنار گذاشته می‌شود و بایت‌های جدید (نه URL) آپلود می‌شوند.
+    def __init__(self, path: str, assets: dict[str, str], upload_chat_id: int | None = None, fetch_timeout: float = 10.0):
+        self.path = path
+        self.assets = assets
+        self.upload_chat_id = upload_chat_id
+        self.fetch_timeout = fetch_timeout
+        try: self._entries: dict[str, dict] = load_checkpoint(path)
+        except Exception as e:
+            logger.warning(f"MediaRegistry: خواندن '{path}' ممکن نبود ({e})؛ همه assetها دوباره آپلود می‌شوند.")
+            self._entries = {}
+        self._content: dict[str, bytes] = {} # بایت‌های دانلودشده تا اولین آپلود
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._client: httpx.AsyncClient | None = None
+        self.hits = 0
+        self.uploads = 0
+        self.invalidations = 0
+
+    def file_id(self, name: str) -> str | None:
+        entry = self._entries.get(name)
+        if entry is None or entry.get("url") != self.assets.get(name): return None
+        return entry.get("file_id")
+
+    def _save(self) -> None:
+        try: save_checkpoint(self.path, self._entries)
+        except Exception as e: logger.warning(f"MediaRegistry: ذخیره '{self.path}' ناموفق بود: {e}")
+
+    def _forget(self, name: str, reason: str) -> None:
+        if self._entries.pop(name, None) is None: return
+        self.invalidations += 1
+        logger.info(f"MediaRegistry: file_id '{name}' کنار گذاشته شد ({reason}).")
+        self._save()
+
+    def _remember(self, name: str, message, digest: str | None) -> None:
+        if not message or not message.photo: return
+        # بزرگ‌ترین اندازه؛ تلگرام برای ارسال دوباره با file_id اندازه‌های کوچک‌تر را خودش می‌سازد
+        self._entries[name] = {"url": self.assets[name], "sha256": digest, "file_id": message.photo[-1].file_id, "uploaded_at": int(time.time())}
+        self._content.pop(name, None)
+        self.uploads += 1
+        self._save()
+        logger.info(f"MediaRegistry: '{name}' آپلود شد و file_id آن ذخیره شد.")
+
+    async def _fetch(self, url: str) -> bytes:
+        if self._client is None: self._client = httpx.AsyncClient(timeout=self.fetch_timeout, follow_redirects=True)
+        response = await self._client.get(url)
+        response.raise_for_status()
+        return response.content
+
+    async def warm_up(self, bot) -> None:
+        for name, url in self.assets.items():
+            entry = self._entries.get(name)
+            if entry is not None and entry.get("url") != url: self._forget(name, "URL تغییر کرده")
+            try: content = await self._fetch(url)
+            except Exception as e:
+                # file_id موجود همچنان معتبر است؛ سایت در دسترس نبودن فقط اولین آپلود را به URL وابسته می‌کند
+                logger.warning(f"MediaRegistry: دانلود '{name}' از {url} ناموفق بود: {e}")
+                continue
+            digest = hashlib.sha256(content).hexdigest()
+            if self.file_id(name):
+                if self._entries[name].get("sha256") in (None, digest):
+                    if self._entries[name].get("sha256") is None:
+                        self._entries[name]["sha256"] = digest
+                        self._save()
+                    continue
+                self._forget(name, "محتوا تغییر کرده")
+            self._content[name] = content
+            if self.upload_chat_id is not None: await self._upload_now(bot, name, digest)
+
+    async def _upload_now(self, bot, name: str, digest: str) -> None:
+        async with self._lock(name):
+            if self.file_id(name): return
+            message = await bot.send_photo(chat_id=self.upload_chat_id, photo=self._content[name], disable_notification=True)
+            self._remember(name, message, digest)
+        try: await bot.delete_message(chat_id=self.upload_chat_id, message_id=message.message_id)
+        except Exception as e: logger.debug(f"MediaRegistry: حذف پیام آپلود '{name}' ممکن نبود: {e}")
+
+    def _lock(self, name: str) -> asyncio.Lock:
+        lock = self._locks.get(name)
+        if lock is None: lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    async def send_photo(self, bot, name: str, chat_id: int, **kwargs):
+        file_id = self.file_id(name)
+        if file_id:
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+                self.hits += 1
+                return message
+            except BadRequest as e: self._forget(name, f"تلگرام file_id را نپذیرفت: {e}")
+        # اولین ارسال: فقط یک درخواست آپلود می‌کند و بقیه منتظر file_id آن می‌مانند و سپس بیرون از قفل، همزمان ارسال می‌کنند
+        async with self._lock(name):
+            file_id = self.file_id(name)
+            if not file_id:
+                content = self._content.get(name)
+                message = await bot.send_photo(chat_id=chat_id, photo=content if content is not None else self.assets[name], **kwargs)
+                self._remember(name, message, hashlib.sha256(content).hexdigest() if content is not None else None)
+                return message
+        self.hits += 1
+        return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+
+    async def close(self) -> None:
+        if self._client is not None: await self._client.aclose()
+        self._client = None
+
+    def stats(self) -> dict:
+        return {"assets": len(self.assets), "cached": sum(1 for name in self.assets if self.file_id(name)), "hits": self.hits,
+                "uploads": self.uploads, "invalidations": self.invalidations}
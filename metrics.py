@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# همه متریک‌ها فقط از داخل حلقه رویداد به‌روز می‌شوند، بنابراین قفل لازم نیست
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 200, 500)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)] + [f'{n}="{_escape_label(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf: return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names): raise ValueError(f"{self.name}: برچسب‌های {self.label_names} لازم است، {tuple(labels)} داده شد.")
+        return tuple(labels[n] for n in self.label_names)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        for key, value in self._values.items(): yield self.name, _format_labels(self.label_names, key), value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        super().__init__(name, documentation, labels)
+        self._function = function
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function) -> None:
+        # مقدار در لحظه خواندن /metrics از function گرفته می‌شود (فقط برای گیج بدون برچسب)
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try: yield self.name, "", float(self._function())
+            except Exception as e: logger.warning(f"متریک {self.name}: خطا در خواندن مقدار: {e}")
+            return
+        for key, value in self._values.items(): yield self.name, _format_labels(self.label_names, key), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", _format_labels(self.label_names, key, (("le", _format_value(upper)),)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.label_names, key), total
+            yield f"{self.name}_count", _format_labels(self.label_names, key), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics: raise ValueError(f"متریک {metric.name} قبلاً ثبت شده است.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values(): lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram("tafteh_handler_duration_seconds", "Telegram handler latency.", ("handler",)))
+HANDLER_ERRORS = REGISTRY.register(Counter("tafteh_handler_errors_total", "Telegram handler exceptions.", ("handler",)))
+STORAGE_SECONDS = REGISTRY.register(Histogram("tafteh_storage_duration_seconds", "Profile storage call latency (cache hits excluded).", ("backend", "op")))
+STORAGE_ERRORS = REGISTRY.register(Counter("tafteh_storage_errors_total", "Failed profile storage calls.", ("backend", "op")))
+LLM_REQUEST_SECONDS = REGISTRY.register(Histogram("tafteh_llm_request_duration_seconds", "OpenRouter request latency per attempt.", ("model", "status")))
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.register(Histogram("tafteh_llm_first_token_seconds", "Time to first streamed token.", ("model",)))
+LLM_TOKENS = REGISTRY.register(Counter("tafteh_llm_tokens_total", "Tokens reported by OpenRouter usage.", ("model", "kind")))
+WRITE_BEHIND_BATCH_SIZE = REGISTRY.register(Histogram("tafteh_write_behind_batch_size", "Profiles per write-behind flush.", buckets=BATCH_BUCKETS))
+WRITE_BEHIND_LAG_SECONDS = REGISTRY.register(Histogram("tafteh_write_behind_lag_seconds", "Age of the oldest buffered profile write at flush time."))
+WRITE_BEHIND_PENDING = REGISTRY.register(Gauge("tafteh_write_behind_pending_users", "Profiles with buffered writes not yet flushed."))
+LLM_ROUTED = REGISTRY.register(Counter("tafteh_llm_routed_total", "Successful LLM calls by the model that answered.", ("model",)))
+LLM_HEDGES = REGISTRY.register(Counter("tafteh_llm_hedges_total", "Hedged LLM requests launched and which side won.", ("result",)))
+LLM_IN_FLIGHT = REGISTRY.register(Gauge("tafteh_llm_in_flight", "OpenRouter HTTP requests currently in flight."))
+LLM_ADMISSION_ACTIVE = REGISTRY.register(Gauge("tafteh_llm_admission_active", "LLM calls holding an admission slot."))
+LLM_ADMISSION_QUEUED = REGISTRY.register(Gauge("tafteh_llm_admission_queued", "LLM calls waiting in the admission queue."))
+OUTBOUND_MESSAGES = REGISTRY.register(Counter("tafteh_outbound_messages_total", "Queued outbound Telegram messages by outcome (queued/merged/sent/failed/blocked).", ("result",)))
+OUTBOUND_PENDING = REGISTRY.register(Gauge("tafteh_outbound_pending", "Outbound messages waiting in per-chat queues."))
+UPDATES_ACTIVE = REGISTRY.register(Gauge("tafteh_updates_active", "Telegram updates currently being handled."))
+UPDATES_WAITING = REGISTRY.register(Gauge("tafteh_updates_waiting", "Telegram updates queued behind an earlier update from the same user."))
+EVENT_LOOP_LAG_SECONDS = REGISTRY.register(Histogram("tafteh_event_loop_lag_seconds", "Event loop scheduling delay.", buckets=LAG_BUCKETS))
+EVENT_LOOP_LAG_LAST = REGISTRY.register(Gauge("tafteh_event_loop_lag_last_seconds", "Most recent event loop lag sample."))
+SHARD_FORWARDS = REGISTRY.register(Counter("tafteh_shard_forwards_total", "Updates forwarded by the dispatcher to each worker.", ("node", "result")))
+SHARD_HANDOFFS = REGISTRY.register(Counter("tafteh_shard_handoffs_total", "Per-user state handoffs between workers.", ("result",)))
+STARTUP_PHASE_SECONDS = REGISTRY.register(Gauge("tafteh_startup_phase_seconds", "Duration of each startup phase.", ("phase",)))
+
+
+@contextmanager
+def storage_call(backend: str, op: str):
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"storage.{op}", backend=backend): yield
+    except BaseException:
+        STORAGE_ERRORS.inc(backend=backend, op=op)
+        raise
+    finally: STORAGE_SECONDS.observe(time.perf_counter() - started, backend=backend, op=op)
+
+
+def record_startup_phase(phase: str, seconds: float) -> None:
+    STARTUP_PHASE_SECONDS.set(seconds, phase=phase)
+    logger.info(f"راه‌اندازی: مرحله '{phase}' در {seconds * 1000:.0f} میلی‌ثانیه انجام شد.")
+
+
+@contextmanager
+def startup_phase(phase: str):
+    started = time.perf_counter()
+    try: yield
+    finally: record_startup_phase(phase, time.perf_counter() - started)
+
+
+def record_llm_usage(model: str, usage: dict | None) -> None:
+    if not usage: return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        tokens = usage.get(kind)
+        if tokens: LLM_TOKENS.inc(tokens, model=model, kind=kind.removesuffix("_tokens"))
+
+
+def instrument_handler(callback, name: str | None = None):
+    name = name or getattr(callback, "__name__", "unknown")
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try: return await callback(update, context)
+        except BaseException:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally: HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+class EventLoopLagMonitor:
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            EVENT_LOOP_LAG_LAST.set(lag)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="event-loop-lag-monitor")
+
+    async def stop(self) -> None:
+        if self._task is None: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
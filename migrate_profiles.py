@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+import profile_store
+from checkpoint import clear_checkpoint, load_checkpoint, save_checkpoint
+from storage import FirestoreBackend, ProfileBackend, SqliteBackend, init_firebase
+
+logger = logging.getLogger("migrate_profiles")
+
+
+async def create_backend(args) -> ProfileBackend:
+    if args.backend == "sqlite": return SqliteBackend(args.sqlite_path)
+    if await asyncio.to_thread(init_firebase) is None: raise SystemExit("Firebase مقداردهی اولیه نشد؛ مسیر FIREBASE_CREDENTIALS_PATH را بررسی کنید.")
+    from firebase_admin import firestore_async
+    return FirestoreBackend(firestore_async.client())
+
+
+def _upgrade_build(existing: dict | None):
+    # payload ارتقا از خواندن داخل تراکنش ساخته می‌شود، نه از خواندن صفحه؛ پس نوشتن همزمان ربات با پیش‌فرض‌ها بازنویسی نمی‌شود
+    # (فقط کلیدهای غایب اضافه می‌شوند و پروفایلی که در این فاصله ارتقا یافته یا حذف شده دست نمی‌خورد)
+    payload = profile_store.schema_upgrade_payload(existing) if existing is not None else {}
+    return payload, False, bool(payload)
+
+
+async def _upgrade_one(backend: ProfileBackend, user_id: str, semaphore: asyncio.Semaphore) -> bool | None:
+    # True: ارتقا نوشته شد، False: دیگر نیازی نبود، None: خطا (یک سند مشکل‌دار کل صفحه را متوقف نمی‌کند)
+    async with semaphore:
+        try: return await backend.run_transaction(user_id, _upgrade_build)
+        except Exception as e:
+            logger.error(f"ارتقای پروفایل {user_id} ناموفق بود: {e}")
+            return None
+
+
+async def migrate(backend: ProfileBackend, page_size: int = 300, checkpoint_path: str | None = None, dry_run: bool = False, max_pages: int | None = None, concurrency: int = 16) -> dict:
+    # پروفایل‌ها صفحه به صفحه (به ترتیب user_id) خوانده می‌شوند؛ خواندن صفحه فقط نامزدهای ارتقا را پیدا می‌کند و هر ارتقا در تراکنش خودش نوشته می‌شود.
+    # پس از هر صفحه checkpoint ذخیره می‌شود تا اجرای بعدی از همان‌جا ادامه دهد؛ پروفایل‌های ناموفق در failed_user_ids می‌مانند،
+    # در اجرای بعدی اول دوباره تلاش می‌شوند و تا وقتی باقی‌اند مهاجرت completed نمی‌شود
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else {}
+    if checkpoint.get("schema_version") not in (None, profile_store.PROFILE_SCHEMA_VERSION):
+        logger.warning(f"checkpoint برای نسخه {checkpoint['schema_version']} است؛ مهاجرت از ابتدا شروع می‌شود.")
+        checkpoint = {}
+    checkpoint.setdefault("schema_version", profile_store.PROFILE_SCHEMA_VERSION)
+    for key in ("scanned", "upgraded", "failed", "pages"): checkpoint.setdefault(key, 0)
+    if checkpoint["failed"] and "failed_user_ids" not in checkpoint:
+        logger.warning(f"checkpoint قدیمی {checkpoint['failed']} خطا دارد ولی شناسه‌ها را ندارد؛ برای تلاش دوباره آن‌ها با --reset اجرا کنید.")
+    failed_user_ids = checkpoint.setdefault("failed_user_ids", [])
+    checkpoint.pop("completed", None)
+    if checkpoint.get("last_user_id"): logger.info(f"ادامه مهاجرت پس از کاربر {checkpoint['last_user_id']} ({checkpoint['scanned']} پروفایل قبلاً بررسی شده).")
+    started = time.perf_counter()
+    pages = 0
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    if failed_user_ids and not dry_run:
+        logger.info(f"تلاش دوباره برای {len(failed_user_ids)} پروفایل ناموفق اجرای قبلی.")
+        retry, failed_user_ids[:] = list(failed_user_ids), []
+        results = await asyncio.gather(*(_upgrade_one(backend, user_id, semaphore) for user_id in retry))
+        checkpoint["upgraded"] += sum(1 for ok in results if ok)
+        failed_user_ids.extend(user_id for user_id, ok in zip(retry, results) if ok is None)
+        checkpoint["failed"] = len(failed_user_ids)
+        if checkpoint_path: save_checkpoint(checkpoint_path, checkpoint)
+    while max_pages is None or pages < max_pages:
+        page = await backend.list_page(page_size, checkpoint.get("last_user_id"))
+        if not page:
+            checkpoint["completed"] = not failed_user_ids
+            break
+        candidates = [user_id for user_id, data in page if profile_store.schema_upgrade_payload(data or {})]
+        upgraded = len(candidates)
+        if candidates and not dry_run:
+            results = await asyncio.gather(*(_upgrade_one(backend, user_id, semaphore) for user_id in candidates))
+            upgraded = sum(1 for ok in results if ok)
+            failed_user_ids.extend(user_id for user_id, ok in zip(candidates, results) if ok is None)
+            checkpoint["failed"] = len(failed_user_ids)
+        pages += 1
+        checkpoint["pages"] += 1
+        checkpoint["scanned"] += len(page)
+        checkpoint["upgraded"] += upgraded
+        checkpoint["last_user_id"] = page[-1][0]
+        if checkpoint_path and not dry_run: save_checkpoint(checkpoint_path, checkpoint)
+        rate = checkpoint["scanned"] / max(time.perf_counter() - started, 1e-9)
+        logger.info(f"صفحه {checkpoint['pages']}: {checkpoint['scanned']} بررسی، {checkpoint['upgraded']} ارتقا، {checkpoint['failed']} خطا "
+                    f"(آخرین: {checkpoint['last_user_id']}، {rate:.0f} پروفایل در ثانیه){' [dry-run]' if dry_run else ''}")
+    if checkpoint_path and not dry_run: save_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=f"ارتقای دسته‌ای پروفایل‌های کاربران به نسخه اسکیما {profile_store.PROFILE_SCHEMA_VERSION}")
+    parser.add_argument("--backend", choices=("firestore", "sqlite"), default=os.getenv("STORAGE_BACKEND", "firestore").lower())
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_STORAGE_PATH", "tafteh_profiles.sqlite3"))
+    parser.add_argument("--page-size", type=int, default=300, help="تعداد پروفایل در هر صفحه")
+    parser.add_argument("--checkpoint", default="migrate_profiles.checkpoint.json")
+    parser.add_argument("--reset", action="store_true", help="نادیده گرفتن checkpoint قبلی و شروع از ابتدا")
+    parser.add_argument("--dry-run", action="store_true", help="فقط شمارش پروفایل‌های نیازمند ارتقا، بدون نوشتن")
+    parser.add_argument("--concurrency", type=int, default=16, help="حداکثر تراکنش‌های ارتقای همزمان")
+    parser.add_argument("--max-pages", type=int, default=None)
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+async def run(args) -> dict:
+    if args.reset: clear_checkpoint(args.checkpoint)
+    backend = await create_backend(args)
+    try: return await migrate(backend, page_size=args.page_size, checkpoint_path=args.checkpoint, dry_run=args.dry_run, max_pages=args.max_pages, concurrency=args.concurrency)
+    finally: await backend.close()
+
+
+def main_cli(argv=None) -> None:
+    load_dotenv()
+    args = parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=args.log_level.upper())
+    result = asyncio.run(run(args))
+    logger.info(f"مهاجرت {'کامل شد' if result.get('completed') else 'متوقف شد (با اجرای دوباره ادامه می‌یابد)'}: {result}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+from openrouter_client import CircuitOpenError, ClientBusyError
+
+logger = logging.getLogger(__name__)
+
+# این خطاها به کل سرویس مربوط‌اند نه به یک مدل؛ رفتن سراغ مدل دیگر کمکی نمی‌کند
+NON_FAILOVER_ERRORS = (CircuitOpenError, ClientBusyError)
+
+
+class ModelStats:
+    def __init__(self, window: int = 50):
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.last_failure_at = 0.0
+
+    def record(self, latency: float | None, ok: bool) -> None:
+        self.outcomes.append(ok)
+        if not ok: self.last_failure_at = time.monotonic()
+        if ok and latency is not None: self.latencies.append(latency)
+
+    def fail_last_success(self) -> None:
+        # استریمی که پس از اولین توکن قطع شده: موفقیتِ ثبت‌شده در زمان اولین توکن به شکست تبدیل می‌شود
+        for i in range(len(self.outcomes) - 1, -1, -1):
+            if self.outcomes[i]:
+                self.outcomes[i] = False
+                break
+        else: self.outcomes.append(False)
+        self.last_failure_at = time.monotonic()
+
+    def percentile(self, pct: float) -> float | None:
+        if not self.latencies: return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+    def snapshot(self) -> dict:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {"samples": len(self.outcomes), "p50": round(p50, 3) if p50 is not None else None,
+                "p95": round(p95, 3) if p95 is not None else None, "error_rate": round(self.error_rate, 3)}
+
+
+class ModelRouter:
+    def __init__(self, models: list[str], window: int = 50, min_samples: int = 5, max_error_rate: float = 0.5,
+                 hedge_after_seconds: float = 0.0, cooldown_seconds: float = 60.0):
+        if not models: raise ValueError("حداقل یک مدل برای مسیریاب لازم است.")
+        self.models = list(dict.fromkeys(models))
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.hedge_after_seconds = hedge_after_seconds
+        self.cooldown_seconds = cooldown_seconds
+        # آمار استریم (زمان تا اولین توکن) و درخواست کامل (زمان کل) جدا نگه داشته می‌شوند چون قابل مقایسه نیستند
+        self._stats: dict[tuple[str, bool], ModelStats] = {}
+        self.hedges_launched = 0
+        self.hedges_won = 0
+        self.failovers = 0
+
+    def _stats_for(self, model: str, streaming: bool) -> ModelStats:
+        stats = self._stats.get((model, streaming))
+        if stats is None: stats = self._stats[(model, streaming)] = ModelStats(self.window)
+        return stats
+
+    def _record(self, model: str, streaming: bool, latency: float | None, ok: bool) -> None:
+        self._stats_for(model, streaming).record(latency, ok)
+
+    def record_failure(self, model: str, streaming: bool = True) -> None:
+        # run فقط تا اولین توکن را می‌بیند؛ فراخواننده قطع شدن استریم در ادامه را گزارش می‌کند تا مدلی که وسط پاسخ می‌میرد در صدر نماند
+        self._stats_for(model, streaming).fail_last_success()
+
+    def ranked(self, streaming: bool) -> list[str]:
+        def key(indexed):
+            index, model = indexed
+            stats = self._stats_for(model, streaming)
+            sampled = len(stats.outcomes) >= self.min_samples
+            # مدل پرخطا تا پایان cooldown به انتهای فهرست می‌رود؛ پس از آن دوباره امتحان می‌شود (مثل half-open در CircuitBreaker)
+            unhealthy = stats.error_rate > self.max_error_rate and time.monotonic() - stats.last_failure_at < self.cooldown_seconds
+            # مدل‌هایی که هنوز نمونه کافی ندارند خوش‌بینانه سریع فرض می‌شوند تا حداکثر min_samples بار امتحان شوند
+            p95 = stats.percentile(95) if sampled else None
+            return (unhealthy, p95 if p95 is not None else 0.0, index)
+        return [model for _, model in sorted(enumerate(self.models), key=key)]
+
+    def _hedge_delay(self) -> float | None:
+        return self.hedge_after_seconds if self.hedge_after_seconds > 0 and len(self.models) > 1 else None
+
+    async def _timed(self, model: str, streaming: bool, call):
+        started = time.perf_counter()
+        try: result = await call(model)
+        except asyncio.CancelledError:
+            # بازنده hedge: زمان سپری‌شده کران پایین تأخیر است؛ بدون ثبت آن مدل کند همیشه «بدون نمونه» و در صدر می‌ماند
+            self._record(model, streaming, time.perf_counter() - started, True)
+            raise
+        except NON_FAILOVER_ERRORS: raise
+        except Exception:
+            self._record(model, streaming, None, False)
+            raise
+        self._record(model, streaming, time.perf_counter() - started, True)
+        return result
+
+    async def _race(self, primary: str, backup: str | None, streaming: bool, call, discard, attempted: set):
+        # نتیجه: (model, result)؛ اگر primary از آستانه hedge بگذرد، backup هم شروع می‌شود و اولین پاسخ موفق برنده است.
+        # مدل‌هایی که واقعاً فراخوانی شده‌اند به attempted اضافه می‌شوند تا failover دوباره سراغشان نرود
+        tasks = {asyncio.create_task(self._timed(primary, streaming, call)): primary}
+        attempted.add(primary)
+        winner = None
+        delay = self._hedge_delay() if backup else None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedges_launched += 1
+                    metrics.LLM_HEDGES.inc(result="launched")
+                    logger.info(f"Router: {primary} پس از {delay} ثانیه پاسخ نداد؛ درخواست موازی به {backup} ارسال شد.")
+                    tasks[asyncio.create_task(self._timed(backup, streaming, call))] = backup
+                    attempted.add(backup)
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner, model = task, tasks[task]
+                        if len(tasks) > 1:
+                            won = "backup" if model == backup else "primary"
+                            if model == backup: self.hedges_won += 1
+                            metrics.LLM_HEDGES.inc(result=f"won_{won}")
+                        return model, task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done(): task.cancel()
+            # پاک کردن بازنده‌ها پیش از بازگشت؛ بازنده‌ای که همزمان با برنده تمام شده با discard آزاد می‌شود (مثلاً بستن استریم)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for task in tasks:
+                if task is winner or task.cancelled() or task.exception() is not None or discard is None: continue
+                try: await discard(task.result())
+                except Exception as e: logger.warning(f"Router: خطا در آزادسازی پاسخ بازنده {tasks[task]}: {e}")
+
+    async def run(self, call, streaming: bool = False, model_override: str | None = None, discard=None):
+        # call: async (model) -> result؛ خروجی: (model, result)؛ discard: async (result) برای آزادسازی نتیجه بازنده hedge
+        if model_override:
+            return model_override, await self._timed(model_override, streaming, call)
+        candidates = self.ranked(streaming)
+        attempted: set[str] = set()
+        last_error = None
+        while remaining := [model for model in candidates if model not in attempted]:
+            primary = remaining[0]
+            try:
+                model, result = await self._race(primary, remaining[1] if len(remaining) > 1 else None, streaming, call, discard, attempted)
+                metrics.LLM_ROUTED.inc(model=model)
+                return model, result
+            except NON_FAILOVER_ERRORS: raise
+            except Exception as e:
+                last_error = e
+                following = [model for model in candidates if model not in attempted]
+                if following:
+                    self.failovers += 1
+                    logger.warning(f"Router: مدل {primary} ناموفق بود ({e})؛ تلاش با {following[0]}.")
+        raise last_error
+
+    def stats(self) -> dict:
+        return {"models": {f"{model}{' (stream)' if streaming else ''}": stats.snapshot() for (model, streaming), stats in self._stats.items()},
+                "hedges_launched": self.hedges_launched, "hedges_won": self.hedges_won, "failovers": self.failovers}
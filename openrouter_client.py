@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_KEY_URL = "https://openrouter.ai/api/v1/key"
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+try:
+    import h2  # noqa: F401  (httpx فقط با وجود بسته h2 از HTTP/2 پشتیبانی می‌کند)
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+class OpenRouterError(Exception):
+    pass
+
+
+class CircuitOpenError(OpenRouterError):
+    pass
+
+
+class ClientBusyError(OpenRouterError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED: return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout: return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logger.info("OpenRouter circuit: half-open، ارسال یک درخواست آزمایشی.")
+        # در حالت half-open فقط یک درخواست آزمایشی همزمان مجاز است
+        if self._probe_in_flight: return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED: logger.info("OpenRouter circuit: بسته شد (سرویس در دسترس است).")
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"OpenRouter circuit: باز شد پس از {self._consecutive_failures} خطای متوالی. تا {self.reset_timeout} ثانیه درخواست‌ها فوراً رد می‌شوند.")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class OpenRouterClient:
+    def __init__(self, api_key: str, max_concurrency: int = 8, max_retries: int = 2,
+                 request_timeout: float = 45.0, connect_timeout: float = 5.0, queue_timeout: float = 20.0,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 max_connections: int = 20, keepalive_expiry: float = 60.0,
+                 breaker: CircuitBreaker | None = None):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=keepalive_expiry)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: httpx.AsyncClient | None = None
+        self.in_flight = 0
+
+    async def start(self) -> None:
+        if self._client is not None: return
+        self._client = httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE, timeout=self._timeout, limits=self._limits,
+            headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+        )
+        logger.info(f"کلاینت OpenRouter آماده شد (HTTP/2: {_HTTP2_AVAILABLE}, حداکثر همزمانی: {self.max_concurrency}).")
+
+    async def close(self) -> None:
+        if self._client is None: return
+        await self._client.aclose()
+        self._client = None
+        logger.info("کلاینت OpenRouter بسته شد.")
+
+    async def warm_up(self) -> None:
+        # یک درخواست سبک به همان میزبان، اتصال TLS/HTTP2 را در pool نگه می‌دارد تا اولین سوال کاربر هزینه handshake ندهد
+        if self._client is None: await self.start()
+        resp = await self._client.get(OPENROUTER_KEY_URL)
+        if resp.status_code == 401: logger.error("OpenRouter: کلید API نامعتبر است (401).")
+        else: logger.info(f"OpenRouter: اتصال گرم شد (وضعیت {resp.status_code}, {resp.http_version}).")
+
+    def _backoff_delay(self, attempt: int, retry_after: str | None = None) -> float:
+        if retry_after:
+            try: return min(float(retry_after), self.backoff_max)
+            except ValueError: pass
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _acquire_slot(self) -> None:
+        try: await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise ClientBusyError(f"هیچ اسلات آزادی برای OpenRouter طی {self.queue_timeout} ثانیه پیدا نشد.")
+
+    async def chat_completion(self, body: dict) -> dict:
+        if self._client is None: await self.start()
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("مدار OpenRouter باز است.")
+        try: return await self._post_with_retries(body)
+        except (asyncio.CancelledError, ClientBusyError):
+            self.breaker.release_probe()
+            raise
+
+    async def _post_with_retries(self, body: dict) -> dict:
+        attempt = 0
+        while True:
+            retry_after = None
+            await self._acquire_slot()
+            self.in_flight += 1
+            model, status, started_at = body.get("model", "unknown"), "error", time.perf_counter()
+            try:
+                resp = await self._client.post(OPENROUTER_API_URL, json=body)
+                status = str(resp.status_code)
+                if resp.status_code not in RETRYABLE_STATUS_CODES:
+                    resp.raise_for_status()
+                    data = resp.json()
+                    self.breaker.record_success()
+                    metrics.record_llm_usage(model, data.get("usage"))
+                    return data
+                retry_after = resp.headers.get("Retry-After")
+                error = httpx.HTTPStatusError(f"وضعیت {resp.status_code} از OpenRouter", request=resp.request, response=resp)
+            except httpx.HTTPStatusError as e:
+                # خطاهای 4xx غیرقابل تکرار هستند و نشانه از کار افتادن سرویس نیستند
+                self.breaker.record_success()
+                raise OpenRouterError(str(e)) from e
+            except (httpx.TransportError, ValueError) as e:
+                error = e
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+                metrics.LLM_REQUEST_SECONDS.observe(time.perf_counter() - started_at, model=model, status=status)
+
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise OpenRouterError(f"درخواست OpenRouter پس از {attempt + 1} تلاش ناموفق بود: {error}") from error
+            delay = self._backoff_delay(attempt, retry_after)
+            logger.warning(f"OpenRouter: تلاش {attempt + 1} ناموفق ({error}). تلاش مجدد پس از {delay:.2f} ثانیه.")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stream_chat_completion(self, body: dict):
+        if self._client is None: await self.start()
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("مدار OpenRouter باز است.")
+        try:
+            async for delta in self._stream_with_retries({**body, "stream": True}):
+                yield delta
+        except (asyncio.CancelledError, GeneratorExit, ClientBusyError):
+            self.breaker.release_probe()
+            raise
+
+    async def _stream_with_retries(self, body: dict):
+        attempt = 0
+        while True:
+            retry_after, error, started = None, None, False
+            await self._acquire_slot()
+            self.in_flight += 1
+            model, status, started_at = body.get("model", "unknown"), "error", time.perf_counter()
+            try:
+                async with self._client.stream("POST", OPENROUTER_API_URL, json=body) as resp:
+                    status = str(resp.status_code)
+                    if resp.status_code in RETRYABLE_STATUS_CODES:
+                        retry_after = resp.headers.get("Retry-After")
+                        error = httpx.HTTPStatusError(f"وضعیت {resp.status_code} از OpenRouter", request=resp.request, response=resp)
+                    else:
+                        resp.raise_for_status()
+                        async for line in resp.aiter_lines():
+                            # خطوط خالی و کامنت‌های SSE (مثل ": OPENROUTER PROCESSING") نادیده گرفته می‌شوند
+                            if not line.startswith("data:"): continue
+                            payload = line[5:].strip()
+                            if payload == "[DONE]": break
+                            chunk = json.loads(payload)
+                            if chunk.get("error"): raise OpenRouterError(f"خطای OpenRouter در میانه استریم: {chunk['error']}")
+                            # OpenRouter مصرف توکن را در آخرین chunk استریم می‌فرستد
+                            metrics.record_llm_usage(model, chunk.get("usage"))
+                            choices = chunk.get("choices") or [{}]
+                            delta = (choices[0].get("delta") or {}).get("content")
+                            if delta:
+                                if not started: metrics.LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started_at, model=model)
+                                started = True
+                                yield delta
+                        self.breaker.record_success()
+                        return
+            except httpx.HTTPStatusError as e:
+                self.breaker.record_success()
+                raise OpenRouterError(str(e)) from e
+            except (httpx.TransportError, ValueError) as e:
+                # پس از ارسال اولین توکن، تکرار درخواست متن تکراری تولید می‌کند
+                if started:
+                    self.breaker.record_failure()
+                    raise OpenRouterError(f"استریم OpenRouter نیمه‌کاره قطع شد: {e}") from e
+                error = e
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+                metrics.LLM_REQUEST_SECONDS.observe(time.perf_counter() - started_at, model=model, status=status)
+
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise OpenRouterError(f"استریم OpenRouter پس از {attempt + 1} تلاش ناموفق بود: {error}") from error
+            delay = self._backoff_delay(attempt, retry_after)
+            logger.warning(f"OpenRouter (stream): تلاش {attempt + 1} ناموفق ({error}). تلاش مجدد پس از {delay:.2f} ثانیه.")
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,176 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from telegram import InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import metrics
+import tracing
+from admission import TokenBucket
+from telegram_streaming import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+MAX_FLOOD_WAITS_PER_MESSAGE = 5
+MERGE_SEPARATOR = "\n\n"
+
+
+@dataclass
+class _Outgoing:
+    text: str
+    parse_mode: str | None = None
+    reply_markup: object = None
+    parts: int = 1
+
+
+class _ChatQueue:
+    def __init__(self, bucket: TokenBucket):
+        self.items: deque[_Outgoing] = deque()
+        self.bucket = bucket
+        self.task: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+
+
+class OutboundQueue:
+    # پیام‌های متنی هر چت در صف همان چت می‌مانند و یک worker آن‌ها را می‌فرستد؛ هندلر منتظر ارسال نمی‌ماند.
+    # پیام‌های پشت سر همی که در coalesce_window ثانیه می‌رسند (با parse_mode یکسان) یک پیام می‌شوند و آخرین reply_markup را می‌گیرند.
+    # سقف‌ها: token bucket سراسری (حدود ۳۰ پیام در ثانیه تلگرام) و bucket هر چت؛ RetryAfter همه چت‌ها را تا پایان مهلت متوقف می‌کند.
+    def __init__(self, coalesce_window: float = 0.3, rate_per_second: float = 30.0, burst: int = 10, per_chat_rate: float = 1.0,
+                 per_chat_burst: int = 3, max_attempts: int = 3):
+        self.bot = None
+        self.coalesce_window = coalesce_window
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._chats: dict[int, _ChatQueue] = {}
+        self._resume_at = 0.0
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.flood_waits = 0
+
+    def start(self, bot) -> None:
+        self.bot = bot
+
+    @property
+    def pending(self) -> int:
+        return sum(len(chat.items) for chat in self._chats.values())
+
+    def send(self, chat_id: int, text: str, parse_mode: str | None = None, reply_markup=None) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is None: chat = self._chats[chat_id] = _ChatQueue(TokenBucket(self.per_chat_rate, self.per_chat_burst))
+        chat.items.append(_Outgoing(text, parse_mode, reply_markup))
+        self.queued += 1
+        metrics.OUTBOUND_MESSAGES.inc(result="queued")
+        tracing.event("telegram.queued", chat_id=chat_id)
+        # worker با context خالی اجرا می‌شود تا ارسال‌های آن به trace آپدیتی که اتفاقاً آن را ساخته نسبت داده نشود
+        if chat.task is None: chat.task = asyncio.create_task(self._run(chat_id, chat), name=f"outbound-{chat_id}", context=contextvars.Context())
+
+    def reply(self, update, text: str, parse_mode: str | None = None, reply_markup=None) -> None:
+        self.send(update.effective_chat.id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+
+    async def flush(self, chat_id: int) -> None:
+        # پیش از ارسال مستقیمی که باید بعد از پیام‌های صف‌شده این چت برسد (مثل عکس یا پیام در حال استریم)؛
+        # پیام دیگری به این دسته اضافه نمی‌شود، پس منتظر پایان coalesce_window نمی‌مانیم
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.task is None: return
+        chat.wakeup.set()
+        await asyncio.wait({chat.task})
+
+    async def close(self) -> None:
+        for chat in self._chats.values(): chat.wakeup.set()
+        tasks = [chat.task for chat in self._chats.values() if chat.task is not None]
+        if tasks: await asyncio.wait(tasks)
+        logger.info(f"صف ارسال پیام تخلیه شد: {self.stats()}")
+
+    def _take(self, items: deque) -> _Outgoing:
+        # ادغام پیام‌های متوالی سازگار؛ پیام با دکمه inline باید آخرین بخش بماند چون دکمه‌ها به همان متن تعلق دارند
+        message = items.popleft()
+        while items:
+            following = items[0]
+            if following.parse_mode != message.parse_mode or isinstance(message.reply_markup, InlineKeyboardMarkup): break
+            text = message.text + MERGE_SEPARATOR + following.text
+            if len(text) > MessageLimit.MAX_TEXT_LENGTH: break
+            items.popleft()
+            message = _Outgoing(text, message.parse_mode, following.reply_markup if following.reply_markup is not None else message.reply_markup, message.parts + 1)
+        if message.parts > 1:
+            self.merged += message.parts - 1
+            metrics.OUTBOUND_MESSAGES.inc(message.parts - 1, result="merged")
+        return message
+
+    async def _throttle(self, chat: _ChatQueue) -> None:
+        while True:
+            wait = self._resume_at - time.monotonic()
+            if wait <= 0: wait = chat.bucket.try_consume()
+            if wait <= 0: break
+            await asyncio.sleep(wait)
+        while wait := self._bucket.try_consume(): await asyncio.sleep(wait)
+
+    async def _run(self, chat_id: int, chat: _ChatQueue) -> None:
+        try:
+            try: await asyncio.wait_for(chat.wakeup.wait(), timeout=self.coalesce_window)
+            except asyncio.TimeoutError: pass
+            while chat.items:
+                await self._throttle(chat)
+                message = self._take(chat.items)
+                try: outcome = await self._deliver(chat_id, message)
+                except Exception as e:
+                    logger.error(f"Outbound: خطای پیش‌بینی‌نشده در ارسال به چت {chat_id}: {e}", exc_info=True)
+                    outcome = "failed"
+                if outcome == "sent":
+                    self.sent += 1
+                    metrics.OUTBOUND_MESSAGES.inc(result="sent")
+                    continue
+                if outcome == "blocked":
+                    # کاربر ربات را مسدود کرده است؛ بقیه پیام‌های این چت هم نمی‌رسند
+                    message.parts += len(chat.items)
+                    chat.items.clear()
+                self.failed += message.parts
+                metrics.OUTBOUND_MESSAGES.inc(message.parts, result=outcome)
+        finally:
+            if chat.items: logger.warning(f"Outbound: {len(chat.items)} پیام چت {chat_id} ارسال نشد (worker متوقف شد).")
+            del self._chats[chat_id]
+
+    async def _deliver(self, chat_id: int, message: _Outgoing) -> str:
+        attempt, flood_waits = 0, 0
+        while True:
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=message.text, parse_mode=message.parse_mode, reply_markup=message.reply_markup)
+                return "sent"
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                self.flood_waits += 1
+                flood_waits += 1
+                logger.warning(f"Outbound: RetryAfter {delay} ثانیه برای چت {chat_id}؛ همه ارسال‌ها متوقف شد.")
+                if flood_waits > MAX_FLOOD_WAITS_PER_MESSAGE: return "failed"
+                await asyncio.sleep(max(0.0, self._resume_at - time.monotonic()))
+            except Forbidden: return "blocked"
+            except BadRequest as e:
+                if message.parse_mode is None:
+                    logger.warning(f"Outbound: ارسال به چت {chat_id} رد شد: {e}")
+                    return "failed"
+                # متن ادغام‌شده یا Markdown نامعتبر؛ ارسال به صورت متن ساده
+                logger.info(f"Outbound: رندر {message.parse_mode} برای چت {chat_id} ممکن نبود ({e})، ارسال به صورت متن ساده.")
+                message = _Outgoing(message.text, None, message.reply_markup, message.parts)
+            except TimedOut as e:
+                # ممکن است پیام رسیده باشد؛ تکرار ارسال پیام تکراری می‌سازد
+                logger.warning(f"Outbound: مهلت ارسال به چت {chat_id} تمام شد: {e}")
+                return "failed"
+            except NetworkError as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    logger.warning(f"Outbound: ارسال به چت {chat_id} پس از {attempt} تلاش ناموفق بود: {e}")
+                    return "failed"
+                await asyncio.sleep(min(2 ** attempt, 10))
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "sent": self.sent, "merged": self.merged, "failed": self.failed, "flood_waits": self.flood_waits,
+                "pending": self.pending, "chats": len(self._chats)}
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SqlitePersistence(BasePersistence):
+    # فقط user_data و وضعیت گفتگوها ذخیره می‌شوند؛ user_data هر کاربر تنبل و در اولین آپدیت او بارگذاری می‌شود
+    def __init__(self, path: str, state_enum: type[Enum] | None = None, update_interval: float = 5.0, flush_delay: float = 0.5):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.path = path
+        self.state_enum = state_enum
+        self.flush_delay = flush_delay
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))")
+        self._loaded_users: set[int] = set()
+        self._dirty_users: dict[int, dict | None] = {}
+        self._dirty_conversations: dict[tuple[str, str], object] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+        self.lazy_loads = 0
+
+    # --- رمزگذاری وضعیت گفتگو ---
+    def _encode_state(self, state) -> str:
+        if self.state_enum is not None and isinstance(state, self.state_enum): return json.dumps({"enum": state.name})
+        return json.dumps({"value": state})
+
+    def _decode_state(self, raw: str):
+        data = json.loads(raw)
+        if "enum" in data: return self.state_enum[data["enum"]]
+        return data["value"]
+
+    # --- بارگذاری ---
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        with self._lock: rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        conversations = {}
+        for key, state in rows:
+            try: conversations[tuple(json.loads(key))] = self._decode_state(state)
+            except (KeyError, ValueError) as e: logger.warning(f"Persistence: وضعیت نامعتبر گفتگو '{name}' برای {key} نادیده گرفته شد: {e}")
+        logger.info(f"Persistence: {len(conversations)} وضعیت گفتگو برای '{name}' بارگذاری شد.")
+        return conversations
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users: return
+        self._loaded_users.add(user_id)
+        with self._lock: row = self._conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None: return
+        self.lazy_loads += 1
+        stored = json.loads(row[0])
+        # مقادیری که در همین فرایند نوشته شده‌اند بر داده ذخیره‌شده اولویت دارند
+        for key, value in stored.items(): user_data.setdefault(key, value)
+
+    def stored_user_ids(self) -> list[int]:
+        # همه کاربران ذخیره‌شده، نه فقط آن‌هایی که در این فرایند بارگذاری شده‌اند (برای انتقال کاربران بین workerها)
+        with self._lock: rows = self._conn.execute("SELECT user_id FROM user_data").fetchall()
+        return [row[0] for row in rows]
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # --- ثبت تغییرات (PTB هر update_interval ثانیه فقط موارد تغییرکرده را صدا می‌زند) ---
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush(), name="sqlite-persistence-flush")
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded_users.add(user_id)
+        self._dirty_users[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded_users.discard(user_id)
+        self._dirty_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    def _write_batch(self, users: dict, conversations: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for user_id, data in users.items():
+                    if data is None: self._conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                    else: self._conn.execute("INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)", (user_id, json.dumps(data, ensure_ascii=False, default=str), now))
+                for (name, key), state in conversations.items():
+                    if state is None: self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else: self._conn.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)", (name, key, self._encode_state(state)))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self) -> None:
+        # flushهای همزمان به ترتیب نوشته می‌شوند تا نسخه قدیمی‌تر روی نسخه جدیدتر ننشیند
+        async with self._flush_lock: await self._flush_dirty()
+
+    async def _flush_dirty(self) -> None:
+        if not self._dirty_users and not self._dirty_conversations: return
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        try: await asyncio.to_thread(self._write_batch, users, conversations)
+        except Exception as e:
+            logger.error(f"Persistence: خطا در ذخیره {len(users)} کاربر و {len(conversations)} گفتگو: {e}", exc_info=True)
+            # تغییرات از دست نمی‌روند؛ در flush بعدی دوباره تلاش می‌شود مگر اینکه نسخه جدیدتری رسیده باشد
+            for user_id, data in users.items(): self._dirty_users.setdefault(user_id, data)
+            for key, state in conversations.items(): self._dirty_conversations.setdefault(key, state)
+            return
+        self.flushes += 1
+        self.rows_written += len(users) + len(conversations)
+        logger.debug(f"Persistence: {len(users)} کاربر و {len(conversations)} گفتگو ذخیره شد.")
+
+    def stats(self) -> dict:
+        return {"flushes": self.flushes, "rows_written": self.rows_written, "lazy_loads": self.lazy_loads,
+                "loaded_users": len(self._loaded_users), "pending": len(self._dirty_users) + len(self._dirty_conversations)}
+
+    def close(self) -> None:
+        with self._lock: self._conn.close()
@@ -0,0 +1,101 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import field_ops
+
+logger = logging.getLogger(__name__)
+
+
+class _Unpatchable(Exception):
+    pass
+
+
+def resolve_value(current, value):
+    if isinstance(value, field_ops.Increment):
+        return (current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0) + value.value
+    if isinstance(value, field_ops.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(v for v in value.values if v not in result)
+        return result
+    if isinstance(value, field_ops.ArrayRemove):
+        return [v for v in current if v not in value.values] if isinstance(current, list) else []
+    if value is field_ops.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    return copy.deepcopy(value)
+
+
+def apply_update(data: dict, payload: dict) -> dict:
+    result = copy.deepcopy(data)
+    for key, value in payload.items():
+        # مسیرهای تودرتو (مثل 'a.b') در پروفایل استفاده نمی‌شوند؛ برای اطمینان فقط invalidate می‌کنیم
+        if "." in key: raise _Unpatchable(key)
+        if value is field_ops.DELETE_FIELD: result.pop(key, None)
+        else: result[key] = resolve_value(result.get(key), value)
+    return result
+
+
+class ProfileCache:
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, user_id: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, data = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return copy.deepcopy(data)
+
+    def put(self, user_id: str, data: dict) -> None:
+        try: normalized = apply_update({}, data)
+        except _Unpatchable:
+            self.invalidate(user_id)
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, normalized)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def patch(self, user_id: str, payload: dict) -> None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None: return
+            expires_at, data = entry
+            try: self._entries[user_id] = (expires_at, apply_update(data, payload))
+            except _Unpatchable as e:
+                logger.debug(f"ProfileCache: مقدار {e} قابل اعمال محلی نیست؛ ورودی {user_id} حذف شد.")
+                del self._entries[user_id]
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock: self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock: self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expirations": self.expirations,
+                    "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
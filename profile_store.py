@@ -0,0 +1,269 @@
+import copy
+import logging
+
+import field_ops
+import tracing
+from metrics import storage_call
+from profile_cache import ProfileCache, apply_update
+from storage import ProfileBackend
+from write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SCHEMA_VERSION = 1
+READ_OVERLAY_ATTEMPTS = 3 # خواندن‌های پشت سر هم که با نوشتن write-behind همان کاربر هم‌زمان شده‌اند
+PROFILE_DEFAULT_FIELDS = {'age': None, 'gender': None, 'is_club_member': False, 'points': 0, 'badges': [], 'club_tip_usage_count': 0, 'club_join_date': None, 'name_first_db': None, 'name_last_db': None, 'full_profile_completion_points_awarded': False}
+
+# بک‌اند ذخیره‌سازی در post_init ساخته می‌شود (کلاینت async فایراستور باید داخل حلقه رویداد در حال اجرا ساخته شود)
+_backend: ProfileBackend | None = None
+_cache: ProfileCache | None = None
+# بافر اختیاری write-behind؛ آپدیت‌های ساده پروفایل (نه تراکنش‌ها و ایجاد پروفایل) ادغام و دسته‌ای نوشته می‌شوند
+_write_behind: WriteBehindBuffer | None = None
+# شنونده‌ها پس از هر نوشتن موفق با (user_id, changes, profile_after یا None) صدا زده می‌شوند (مثل جدول امتیازات)
+_listeners: list = []
+
+
+def default_profile_fields() -> dict:
+    return copy.deepcopy(PROFILE_DEFAULT_FIELDS)
+
+
+def _upgrade_to_v1(data: dict) -> dict:
+    # v1: فیلدهای پیش‌فرضی که پروفایل‌های قدیمی ندارند (پیش‌تر در هر خواندن بررسی و نوشته می‌شدند)
+    return {k: v for k, v in default_profile_fields().items() if k not in data}
+
+
+# نسخه مقصد -> تابعی که payload لازم برای رسیدن از نسخه قبلی به آن را برمی‌گرداند
+SCHEMA_UPGRADES = {1: _upgrade_to_v1}
+
+
+def schema_upgrade_payload(data: dict) -> dict:
+    # payload ارتقای پروفایل به PROFILE_SCHEMA_VERSION؛ برای پروفایل به‌روز خالی است (مسیر داغ فقط یک مقایسه عدد)
+    version = data.get('schema_version', 0)
+    if version >= PROFILE_SCHEMA_VERSION: return {}
+    current, payload = data, {}
+    for target in range(version + 1, PROFILE_SCHEMA_VERSION + 1):
+        step = SCHEMA_UPGRADES[target](current)
+        current = apply_update(current, step)
+        payload.update(step)
+    payload['schema_version'] = PROFILE_SCHEMA_VERSION
+    return payload
+
+
+def _upgraded(user_id: str, data: dict) -> dict:
+    # پروفایلی که هنوز با migrate_profiles.py ارتقا نیافته فقط در حافظه ارتقا می‌یابد؛ خواندن هیچ نوشتنی ایجاد نمی‌کند
+    payload = schema_upgrade_payload(data)
+    if not payload: return data
+    logger.debug(f"DB: پروفایل {user_id} با نسخه اسکیما {data.get('schema_version', 0)} در حافظه ارتقا یافت.")
+    return apply_update(data, payload)
+
+
+def configure(backend: ProfileBackend | None, cache: ProfileCache | None = None, write_behind: WriteBehindBuffer | None = None) -> None:
+    global _backend, _cache, _write_behind
+    _backend, _cache, _write_behind = backend, cache, write_behind
+    if write_behind is not None:
+        write_behind.on_failure = _cache_invalidate
+        write_behind.start()
+    logger.info(f"لایه دیتابیس پیکربندی شد (بک‌اند: {backend.name if backend else 'غیرفعال'}{'، write-behind' if write_behind else ''}).")
+
+
+def add_listener(listener) -> None:
+    _listeners.append(listener)
+
+
+def _notify(user_id: str, changes: dict, profile: dict | None = None) -> None:
+    for listener in _listeners:
+        try: listener(user_id, changes, profile)
+        except Exception as e: logger.error(f"DB: خطا در شنونده تغییرات پروفایل {user_id}: {e}", exc_info=True)
+
+
+def is_enabled() -> bool:
+    return _backend is not None
+
+
+def backend_name() -> str | None:
+    return _backend.name if _backend else None
+
+
+def write_behind_enabled() -> bool:
+    return _write_behind is not None
+
+
+async def close() -> None:
+    global _backend, _write_behind
+    if _backend is None: return
+    if _write_behind is not None:
+        # آپدیت‌های بافرشده پیش از بستن بک‌اند نوشته می‌شوند
+        try: await _write_behind.close()
+        except Exception as e: logger.error(f"DB({_backend.name}): خطا در تخلیه write-behind: {e}", exc_info=True)
+        _write_behind = None
+    try: await _backend.close()
+    except Exception as e: logger.error(f"DB({_backend.name}): خطا در بستن بک‌اند: {e}", exc_info=True)
+    _backend = None
+
+
+async def release_user(user_id: str) -> None:
+    # کاربر به فرایند دیگری منتقل می‌شود: نوشتن‌های بافرشده او اکنون ثبت می‌شوند و کش این فرایند دیگر به‌روز نمی‌ماند
+    if _write_behind is not None: await _write_behind.flush_user(user_id)
+    _cache_invalidate(user_id)
+
+
+def _mock_profile(user_id: str, username: str = None, first_name: str = None) -> dict:
+    return {"user_id": user_id, "username": username, "first_name": first_name, **default_profile_fields(), 'schema_version': PROFILE_SCHEMA_VERSION}
+
+
+def _cache_get(user_id: str) -> dict | None:
+    profile = _cache.get(user_id) if _cache is not None else None
+    if profile is not None: tracing.event("profile.cache_hit") # خواندن‌های تکراری پروفایل در یک آپدیت در timeline دیده می‌شوند
+    return profile
+
+
+def _cache_put(user_id: str, data: dict) -> None:
+    if _cache is not None: _cache.put(user_id, data)
+
+
+def _cache_invalidate(user_id: str) -> None:
+    if _cache is not None: _cache.invalidate(user_id)
+
+
+async def _read(user_id: str) -> tuple[dict | None, bool]:
+    # (پروفایل، قابل کش بودن). نوشتن‌های در صف write-behind روی داده بک‌اند اعمال می‌شوند؛ اگر نوشتنی از همین کاربر حین خواندن
+    # در جریان یا ثبت شده باشد، پس از تخلیه او دوباره خوانده می‌شود تا Increment دو بار (یا هیچ بار) شمرده نشود
+    for _ in range(READ_OVERLAY_ATTEMPTS):
+        marker = _write_behind.read_marker() if _write_behind is not None else None
+        with storage_call(_backend.name, "get"): data = await _backend.get(user_id)
+        if data is None: return None, True
+        data = _upgraded(user_id, data)
+        if _write_behind is None: return data, True
+        overlaid = _write_behind.overlay(user_id, data, marker)
+        if overlaid is not None: return overlaid, True
+        await _write_behind.flush_user(user_id)
+    # کاربری که پشت سر هم می‌نویسد: نتیجه تقریبی برگردانده می‌شود ولی در کش نمی‌نشیند
+    return _write_behind.overlay(user_id, data), False
+
+
+async def get_or_create_user_profile(user_id: str, username: str = None, first_name: str = None) -> dict:
+    if _backend is None:
+        logger.warning(f"DB: بک‌اند دیتابیس پیکربندی نشده است. Profile for user {user_id} will be in-memory mock.")
+        return _mock_profile(user_id, username, first_name)
+
+    cached_profile = _cache_get(user_id)
+    if cached_profile is not None: return cached_profile
+    try: user_data, cacheable = await _read(user_id)
+    except Exception as e:
+        logger.error(f"DB({_backend.name}): خطا هنگام get() برای کاربر {user_id}: {e}", exc_info=True)
+        return _mock_profile(user_id, username, first_name)
+
+    if user_data is not None:
+        if cacheable: _cache_put(user_id, user_data)
+        return user_data
+    user_data = {'user_id': user_id, 'username': username, 'first_name': first_name, 'registration_date': field_ops.SERVER_TIMESTAMP, 'last_interaction_date': field_ops.SERVER_TIMESTAMP, **default_profile_fields(), 'schema_version': PROFILE_SCHEMA_VERSION}
+    try:
+        with storage_call(_backend.name, "create"): await _backend.create(user_id, user_data)
+        _cache_put(user_id, user_data)
+    except Exception as e_set: logger.error(f"DB({_backend.name}): خطا ایجاد پروفایل جدید برای کاربر {user_id}: {e_set}")
+    return user_data
+
+
+async def get_user_profile_data(user_id: str) -> dict | None:
+    if _backend is None: return None
+    cached_profile = _cache_get(user_id)
+    if cached_profile is not None: return cached_profile
+    try:
+        user_data, cacheable = await _read(user_id)
+        if user_data is not None:
+            if cacheable: _cache_put(user_id, user_data)
+            return user_data
+    except Exception as e:
+        logger.error(f"DB({_backend.name}): خطا خواندن پروفایل {user_id}: {e}", exc_info=True)
+    return None
+
+
+async def update_user_profile_data(user_id: str, data_to_update: dict) -> None:
+    if _backend is None: return
+    data_to_update['last_updated_date'] = field_ops.SERVER_TIMESTAMP
+    if _write_behind is not None:
+        _write_behind.add(user_id, data_to_update)
+        if _cache is not None: _cache.patch(user_id, data_to_update)
+        _notify(user_id, data_to_update)
+        logger.debug(f"DB({_backend.name}): آپدیت پروفایل {user_id} با {data_to_update} در صف write-behind قرار گرفت.")
+        return
+    try:
+        with storage_call(_backend.name, "update"): await _backend.update(user_id, data_to_update)
+        if _cache is not None: _cache.patch(user_id, data_to_update)
+        _notify(user_id, data_to_update)
+        logger.info(f"DB({_backend.name}): پروفایل {user_id} با {data_to_update} آپدیت شد.")
+    except Exception as e:
+        if _cache is not None: _cache.invalidate(user_id)
+        logger.error(f"DB({_backend.name}): خطا آپدیت پروفایل {user_id} با {data_to_update}: {e}", exc_info=True)
+
+
+async def update_many_user_profiles(updates: dict[str, dict]) -> None:
+    # چند آپدیت مستقل در یک batch (فایراستور) یا یک تراکنش (SQLite)؛ در صورت خطا کش همه کاربران دسته باطل می‌شود
+    if _backend is None or not updates: return
+    updates = {user_id: {**data, 'last_updated_date': field_ops.SERVER_TIMESTAMP} for user_id, data in updates.items()}
+    if _write_behind is not None:
+        for user_id, data in updates.items():
+            _write_behind.add(user_id, data)
+            if _cache is not None: _cache.patch(user_id, data)
+            _notify(user_id, data)
+        return
+    try:
+        with storage_call(_backend.name, "update_many"): await _backend.update_many(updates)
+    except Exception:
+        if _cache is not None:
+            for user_id in updates: _cache.invalidate(user_id)
+        raise
+    for user_id, data in updates.items():
+        if _cache is not None: _cache.patch(user_id, data)
+        _notify(user_id, data)
+    logger.info(f"DB({_backend.name}): {len(updates)} پروفایل در یک دسته آپدیت شد.")
+
+
+def build_transaction_write(user_id: str, existing: dict | None, mutate, create_fields: dict | None = None) -> tuple[dict, dict, dict, bool]:
+    # بخش خالص تراکنش که بین مسیر async و sync مشترک است؛ mutate ممکن است در تلاش مجدد تراکنش چند بار اجرا شود
+    is_create = existing is None
+    if is_create:
+        current = {'user_id': user_id, **(create_fields or {})}
+        for key, val in default_profile_fields().items(): current.setdefault(key, val)
+        current['schema_version'] = PROFILE_SCHEMA_VERSION
+        upgrade = {}
+    else:
+        upgrade = schema_upgrade_payload(existing)
+        current = apply_update(existing, upgrade) if upgrade else dict(existing)
+    payload = mutate(copy.deepcopy(current)) or {}
+    if is_create:
+        write_data = {**current, 'registration_date': field_ops.SERVER_TIMESTAMP, 'last_interaction_date': field_ops.SERVER_TIMESTAMP, **payload}
+    else:
+        # پروفایل قدیمی که به هر حال نوشته می‌شود، همین‌جا ارتقای اسکیما را هم ثبت می‌کند
+        write_data = {**upgrade, **payload, 'last_updated_date': field_ops.SERVER_TIMESTAMP} if payload else {}
+    return current, payload, write_data, is_create
+
+
+async def run_profile_transaction(user_id: str, mutate, create_fields: dict | None = None) -> dict | None:
+    if _backend is None: return None
+
+    def _build(existing: dict | None):
+        current, payload, write_data, is_create = build_transaction_write(user_id, existing, mutate, create_fields)
+        return write_data, is_create, (current, write_data if is_create else payload)
+
+    # تراکنش باید آخرین داده را بخواند؛ آپدیت‌های بافرشده همین کاربر اول نوشته می‌شوند
+    if _write_behind is not None: await _write_behind.flush_user(user_id)
+    marker = _write_behind.read_marker() if _write_behind is not None else None
+    try:
+        with storage_call(_backend.name, "transaction"): current, applied = await _backend.run_transaction(user_id, _build)
+    except Exception:
+        if _cache is not None: _cache.invalidate(user_id)
+        raise
+    committed = apply_update(current, applied)
+    # آپدیت‌هایی که حین تراکنش رسیده‌اند
+    profile_after = _write_behind.overlay(user_id, committed, marker) if _write_behind is not None else committed
+    if profile_after is not None:
+        _cache_put(user_id, profile_after)
+        _notify(user_id, applied, profile_after)
+    else:
+        # نوشتنی از write-behind هم‌زمان با تراکنش ثبت شد و معلوم نیست تراکنش آن را دیده یا نه؛ کش خالی و شنونده‌ها فقط تغییرات را می‌گیرند
+        _cache_invalidate(user_id)
+        _notify(user_id, applied)
+        profile_after = _write_behind.overlay(user_id, committed)
+    logger.info(f"DB({_backend.name}): تراکنش پروفایل {user_id} با {applied} ثبت شد.")
+    return profile_after
@@ -0,0 +1,94 @@
+import logging
+from dataclasses import dataclass, field
+
+import field_ops
+import profile_store
+from profile_cache import apply_update
+
+logger = logging.getLogger(__name__)
+
+POINTS_FOR_JOINING_CLUB = 50
+POINTS_FOR_FULL_PROFILE_COMPLETION = 35 # امتیاز برای تکمیل نام، نام خانوادگی، سن و جنسیت
+
+BADGE_CLUB_MEMBER = "عضو باشگاه تافته 🏅"
+BADGE_FULL_PROFILE = "پروفایل طلایی ✨"
+BADGE_HEALTH_EXPLORER = "کاشف سلامت 🧭"
+CLUB_TIP_BADGE_THRESHOLD = 3
+
+REASON_FULL_PROFILE = "تکمیل پروفایل (نام، سن و جنسیت)"
+REASON_CLUB_JOIN = "عضویت در باشگاه مشتریان"
+
+EVENT_PROFILE_COMPLETED = "profile_completed"
+EVENT_NAME_EDITED = "name_edited"
+EVENT_CLUB_JOINED = "club_joined"
+EVENT_HEALTH_TIP_USED = "health_tip_used"
+
+FULL_PROFILE_FIELDS = ("name_first_db", "name_last_db", "age", "gender")
+
+
+@dataclass
+class RewardResult:
+    profile: dict
+    points_awarded: list[tuple[int, str]] = field(default_factory=list)
+    badges_awarded: list[str] = field(default_factory=list)
+
+    @property
+    def total_points(self) -> int:
+        return self.profile.get('points', 0)
+
+
+def evaluate_event(event: str, profile: dict, data: dict | None = None) -> tuple[dict, list[tuple[int, str]], list[str]]:
+    # همه قوانین یک رویداد روی یک snapshot ارزیابی می‌شوند و خروجی مقادیر نهایی است (نه Increment)، چون داخل تراکنش خوانده شده‌اند
+    updates, points, badges = {}, [], []
+    if event in (EVENT_PROFILE_COMPLETED, EVENT_NAME_EDITED):
+        updates.update(data or {})
+        after = {**profile, **updates}
+        if all(after.get(k) for k in FULL_PROFILE_FIELDS) and not after.get('full_profile_completion_points_awarded', False):
+            updates['full_profile_completion_points_awarded'] = True
+            points.append((POINTS_FOR_FULL_PROFILE_COMPLETION, REASON_FULL_PROFILE))
+            badges.append(BADGE_FULL_PROFILE)
+    elif event == EVENT_CLUB_JOINED:
+        updates.update({"is_club_member": True, "club_join_date": field_ops.SERVER_TIMESTAMP})
+        points.append((POINTS_FOR_JOINING_CLUB, REASON_CLUB_JOIN))
+        badges.append(BADGE_CLUB_MEMBER)
+    elif event == EVENT_HEALTH_TIP_USED:
+        updates['club_tip_usage_count'] = (profile.get('club_tip_usage_count') or 0) + 1
+        if updates['club_tip_usage_count'] >= CLUB_TIP_BADGE_THRESHOLD:
+            badges.append(BADGE_HEALTH_EXPLORER)
+    else:
+        raise ValueError(f"رویداد ناشناخته برای موتور امتیازدهی: {event}")
+
+    if points:
+        updates['points'] = (profile.get('points') or 0) + sum(p for p, _ in points)
+    current_badges = list(profile.get('badges') or [])
+    badges = [b for b in badges if b not in current_badges]
+    if badges:
+        updates['badges'] = current_badges + badges
+    return updates, points, badges
+
+
+async def _bump_tip_usage(user_id: str) -> RewardResult | None:
+    # مسیر سریع write-behind: وقتی نشان از قبل گرفته شده، این رویداد فقط یک شمارنده است و Increment بدون خواندن کافی است
+    profile = await profile_store.get_user_profile_data(user_id)
+    if profile is None or BADGE_HEALTH_EXPLORER not in (profile.get('badges') or []): return None
+    changes = {'club_tip_usage_count': field_ops.Increment(1)}
+    await profile_store.update_user_profile_data(user_id, changes)
+    return RewardResult(apply_update(profile, changes))
+
+
+async def apply_event(user_id: str, event: str, data: dict | None = None, create_fields: dict | None = None) -> RewardResult | None:
+    if event == EVENT_HEALTH_TIP_USED and profile_store.write_behind_enabled():
+        result = await _bump_tip_usage(user_id)
+        if result is not None: return result
+    outcome = {}
+
+    def _mutate(profile: dict) -> dict:
+        updates, points, badges = evaluate_event(event, profile, data)
+        outcome.update(points=points, badges=badges)
+        return updates
+
+    profile_after = await profile_store.run_profile_transaction(user_id, _mutate, create_fields)
+    if profile_after is None: return None
+    result = RewardResult(profile_after, outcome.get('points', []), outcome.get('badges', []))
+    logger.info(f"رویداد '{event}' برای کاربر {user_id}: امتیاز {result.points_awarded}, نشان‌ها {result.badges_awarded}, مجموع {result.total_points}.")
+    return result
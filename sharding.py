@@ -0,0 +1,564 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.error import NetworkError, RetryAfter
+from telegram.ext import Application, ConversationHandler, TypeHandler
+
+import metrics
+from checkpoint import load_checkpoint, save_checkpoint
+from telegram_streaming import retry_after_seconds
+from web_server import SECRET_TOKEN_HEADER
+
+logger = logging.getLogger(__name__)
+
+SHARD_SECRET_HEADER = "X-Tafteh-Shard-Secret"
+UPDATE_PATH = "/internal/update"
+HANDOFF_EXPORT_PATH = "/internal/handoff/export"
+HANDOFF_IMPORT_PATH = "/internal/handoff/import"
+USERS_PATH = "/internal/users"
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # هر گره replicas نقطه روی حلقه دارد؛ افزودن یا حذف یک گره فقط مالک کاربران حدود 1/N حلقه را عوض می‌کند
+    def __init__(self, nodes=(), replicas: int = 160):
+        self.replicas = replicas
+        self.nodes: set[str] = set()
+        self._points: list[int] = []
+        self._owners: dict[int, str] = {}
+        for node in nodes: self.add(node)
+
+    def add(self, node: str) -> None:
+        if node in self.nodes: return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if point in self._owners: continue # برخورد hash؛ نقطه متعلق به گره قبلی می‌ماند
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node: str) -> None:
+        if node not in self.nodes: return
+        self.nodes.discard(node)
+        self._points = [p for p in self._points if self._owners[p] != node]
+        self._owners = {p: self._owners[p] for p in self._points}
+
+    def copy(self) -> "HashRing":
+        return HashRing(self.nodes, self.replicas)
+
+    def node_for(self, key) -> str | None:
+        if not self._points: return None
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._owners[self._points[i]]
+
+
+def routing_user_id(payload: dict) -> int | None:
+    # همان کلید UserOrderedUpdateProcessor: فرستنده آپدیت، وگرنه چت؛ بدون ساختن شیء Update
+    fields = [value for key, value in payload.items() if key != "update_id" and isinstance(value, dict)]
+    for value in fields:
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user: return user["id"]
+    for value in fields:
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat: return chat["id"]
+    return None
+
+
+# --- سمت worker ---
+
+def encode_state(state, state_enum=None) -> dict:
+    if state_enum is not None and isinstance(state, state_enum): return {"enum": state.name}
+    return {"value": state}
+
+
+def decode_state(raw: dict, state_enum=None):
+    if "enum" in raw: return state_enum[raw["enum"]]
+    return raw["value"]
+
+
+class HandoffBarrier:
+    # در update_queue قرار می‌گیرد؛ UserOrderedUpdateProcessor آن را با ordering_key پشت آپدیت‌های در جریان همان کاربر اجرا می‌کند
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.ordering_key = ("user", user_id)
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class WorkerHandoff:
+    # خروج کاربر از این worker: پس از پایان آپدیت‌های قبلی او، user_data و وضعیت گفتگوهایش برداشته، از persistence حذف و برگردانده می‌شود.
+    # ورود: همان داده در user_data و ConversationHandler این worker نوشته می‌شود. release_user(str(user_id)) کش‌های فرایند (مثل پروفایل) را خالی می‌کند؛
+    # شناسه رشته‌ای است چون profile_store، write-behind و کش پروفایل کاربران را با str(user.id) نگه می‌دارند.
+    def __init__(self, application: Application, state_enum=None, release_user=None, timeout: float = 60.0):
+        self.application = application
+        self.state_enum = state_enum
+        self.release_user = release_user
+        self.timeout = timeout
+        self.exported = 0
+        self.imported = 0
+
+    def install(self) -> None:
+        self.application.add_handler(TypeHandler(HandoffBarrier, self._export_barrier), group=-100)
+
+    def _conversation_handlers(self) -> list[ConversationHandler]:
+        return [h for handlers in self.application.handlers.values() for h in handlers if isinstance(h, ConversationHandler) and h.per_user and h.name]
+
+    async def export(self, user_id: int) -> dict:
+        barrier = HandoffBarrier(user_id)
+        await self.application.update_queue.put(barrier)
+        return await asyncio.wait_for(barrier.future, timeout=self.timeout)
+
+    async def _export_barrier(self, barrier: HandoffBarrier, context) -> None:
+        # wait_for در export پس از timeout آینده را لغو کرده است؛ وضعیت نباید برداشته شود چون کسی منتظر آن نیست
+        if barrier.future.done(): return
+        try: state = await self._take(barrier.user_id)
+        except Exception as e:
+            logger.error(f"Handoff: برداشتن وضعیت کاربر {barrier.user_id} ناموفق بود: {e}", exc_info=True)
+            if not barrier.future.done(): barrier.future.set_exception(e)
+            return
+        if not barrier.future.done(): barrier.future.set_result(state)
+
+    async def _take(self, user_id: int) -> dict:
+        application = self.application
+        # user_data تنبل بارگذاری می‌شود؛ کاربری که از شروع این فرایند پیامی نداده فقط در دیتابیس است
+        if application.persistence: await application.persistence.refresh_user_data(user_id, application.user_data[user_id])
+        user_data = dict(application.user_data.get(user_id, {}))
+        conversations = {}
+        for handler in self._conversation_handlers():
+            # _conversations خصوصی است، اما تنها جای وضعیت گفتگوی یک کاربر در PTB است؛ pop در TrackingDict برای persistence ثبت می‌شود
+            for key in [k for k in handler._conversations if k[-1] == user_id]:
+                conversations.setdefault(handler.name, []).append([list(key), encode_state(handler._conversations.pop(key), self.state_enum)])
+        application.drop_user_data(user_id)
+        if self.release_user: await self.release_user(str(user_id))
+        if application.persistence:
+            await application.update_persistence()
+            await application.persistence.flush()
+        self.exported += 1
+        return {"user_id": user_id, "user_data": user_data, "conversations": conversations}
+
+    async def import_state(self, state: dict) -> None:
+        application = self.application
+        user_id = state["user_id"]
+        if state.get("user_data"):
+            application.user_data[user_id].update(state["user_data"])
+            application.mark_data_for_update_persistence(user_ids=user_id)
+        handlers = {h.name: h for h in self._conversation_handlers()}
+        for name, entries in (state.get("conversations") or {}).items():
+            handler = handlers.get(name)
+            if handler is None:
+                logger.warning(f"Handoff: گفتگوی '{name}' در این worker نیست؛ وضعیت کاربر {user_id} نادیده گرفته شد.")
+                continue
+            for key, raw in entries: handler._conversations[tuple(key)] = decode_state(raw, self.state_enum)
+        if application.persistence:
+            await application.update_persistence()
+            await application.persistence.flush()
+        self.imported += 1
+
+    def user_ids(self) -> list[int]:
+        user_ids = set(self.application.user_data)
+        for handler in self._conversation_handlers(): user_ids.update(key[-1] for key in handler._conversations)
+        persistence = self.application.persistence
+        if persistence is not None and hasattr(persistence, "stored_user_ids"): user_ids.update(persistence.stored_user_ids())
+        return sorted(user_ids)
+
+    def stats(self) -> dict:
+        return {"exported": self.exported, "imported": self.imported}
+
+
+def _authorized(request: Request, secret: str) -> bool:
+    return hmac.compare_digest(request.headers.get(SHARD_SECRET_HEADER, ""), secret)
+
+
+def _json_response(data: dict) -> Response:
+    # user_data همان مقادیری را دارد که persistence با default=str ذخیره می‌کند
+    return Response(json.dumps(data, ensure_ascii=False, default=str), media_type="application/json")
+
+
+def worker_routes(handoff: WorkerHandoff, secret: str) -> list[Route]:
+    async def export_user(request: Request) -> Response:
+        if not _authorized(request, secret): return Response(status_code=403)
+        user_id = int((await request.json())["user_id"])
+        return _json_response(await handoff.export(user_id))
+
+    async def import_user(request: Request) -> Response:
+        if not _authorized(request, secret): return Response(status_code=403)
+        await handoff.import_state(await request.json())
+        return Response()
+
+    async def list_users(request: Request) -> Response:
+        if not _authorized(request, secret): return Response(status_code=403)
+        return JSONResponse({"users": handoff.user_ids()})
+
+    return [Route(HANDOFF_EXPORT_PATH, export_user, methods=["POST"]), Route(HANDOFF_IMPORT_PATH, import_user, methods=["POST"]),
+            Route(USERS_PATH, list_users)]
+
+
+# --- سمت dispatcher ---
+
+class LocalWorkerPool:
+    # workerهای همین ماشین: زیرفرایند `python main.py` با BOT_MODE=worker؛ env_for(name, index) فایل‌های وضعیت جدای هر worker را می‌دهد
+    def __init__(self, script: str, host: str = "127.0.0.1", base_port: int = 8081, env_for=None, ready_timeout: float = 120.0):
+        self.script = script
+        self.host = host
+        self.base_port = base_port
+        self.env_for = env_for
+        self.ready_timeout = ready_timeout
+        self._processes: dict[str, asyncio.subprocess.Process] = {}
+        self._indexes: dict[str, int] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._processes
+
+    def _index(self, name: str) -> int:
+        if name not in self._indexes: self._indexes[name] = max(self._indexes.values(), default=-1) + 1
+        return self._indexes[name]
+
+    async def spawn(self, name: str) -> str:
+        index = self._index(name)
+        port = self.base_port + index
+        env = {**os.environ, **(self.env_for(name, index) if self.env_for else {}), "BOT_MODE": "worker", "WEB_HOST": self.host, "PORT": str(port)}
+        process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=env)
+        self._processes[name] = process
+        url = f"http://{self.host}:{port}"
+        try: await self._wait_ready(name, url, process)
+        except BaseException:
+            await self.stop(name)
+            raise
+        logger.info(f"Sharding: worker '{name}' (pid {process.pid}) روی {url} آماده است.")
+        return url
+
+    async def _wait_ready(self, name: str, url: str, process: asyncio.subprocess.Process) -> None:
+        deadline = asyncio.get_running_loop().time() + self.ready_timeout
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            while True:
+                if process.returncode is not None: raise RuntimeError(f"worker '{name}' با کد {process.returncode} خارج شد.")
+                try:
+                    if (await client.get(f"{url}/readyz")).status_code == 200: return
+                except httpx.HTTPError: pass
+                if asyncio.get_running_loop().time() > deadline: raise TimeoutError(f"worker '{name}' در {self.ready_timeout} ثانیه آماده نشد.")
+                await asyncio.sleep(0.5)
+
+    async def stop(self, name: str, timeout: float = 30.0) -> None:
+        process = self._processes.pop(name, None)
+        if process is None or process.returncode is not None: return
+        # SIGTERM: uvicorn سرور را می‌بندد و worker صف ارسال و persistence را تخلیه می‌کند
+        process.terminate()
+        try: await asyncio.wait_for(process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Sharding: worker '{name}' در {timeout} ثانیه خارج نشد و kill شد.")
+            process.kill()
+            await process.wait()
+
+    async def close(self) -> None:
+        await asyncio.gather(*(self.stop(name) for name in list(self._processes)))
+
+
+class RebalanceInProgress(Exception):
+    pass
+
+
+class ShardDispatcher:
+    # هر آپدیت با hash سازگار شناسه کاربر به یک worker فرستاده می‌شود؛ آپدیت‌های یک کاربر پشت قفل همان کاربر و به ترتیب رسیدن
+    # فرستاده می‌شوند (worker پیش از پاسخ 200 آپدیت را در صف گذاشته است). با افزودن یا تخلیه worker، حلقه قبلی نگه داشته می‌شود:
+    # کاربری که مالکش عوض شده پیش از اولین آپدیت بعدی‌اش منتقل می‌شود و پیمایش پس‌زمینه بقیه کاربران workerهای مبدأ را منتقل می‌کند.
+    def __init__(self, secret: str, state_path: str | None = None, pool: LocalWorkerPool | None = None, replicas: int = 160,
+                 request_timeout: float = 30.0, handoff_timeout: float = 90.0, max_attempts: int = 3):
+        self.secret = secret
+        self.state_path = state_path
+        self.pool = pool
+        self.request_timeout = request_timeout
+        # export منتظر پایان آپدیت در جریان کاربر (مثلاً پاسخ LLM) می‌ماند؛ باید از timeout خود worker (WorkerHandoff.timeout) بیشتر باشد
+        self.handoff_timeout = handoff_timeout
+        self.max_attempts = max_attempts
+        self.urls: dict[str, str] = {}
+        self.ring = HashRing(replicas=replicas)
+        self._previous: HashRing | None = None
+        self._sources: list[str] = []
+        self._draining: set[str] = set()
+        self._migrated: set[int] = set()
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {}
+        self._rebalance_lock = asyncio.Lock()
+        self._rebalance_task: asyncio.Task | None = None
+        self._client: httpx.AsyncClient | None = None
+        self.forwarded = 0
+        self.failed = 0
+        self.handoffs = 0
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.ring.nodes)
+
+    async def start(self, nodes: dict[str, str | None]) -> None:
+        # nodes: نام -> URL (None = worker محلی که pool می‌سازد). اگر چینش ذخیره‌شده اجرای قبلی فرق داشته باشد، وضعیت کاربران
+        # workerهای قبلی با همان سازوکار افزودن/تخلیه به مالک جدید منتقل می‌شود
+        self._client = httpx.AsyncClient(timeout=self.request_timeout)
+        saved = load_checkpoint(self.state_path).get("nodes", {}) if self.state_path else {}
+        # workerهای محلی اجرای قبلی دوباره ساخته می‌شوند تا وضعیت کاربرانشان خوانده شود
+        all_nodes = {**{name: (None if self.pool is not None else url) for name, url in saved.items()}, **nodes}
+        self.urls = dict(zip(all_nodes, await asyncio.gather(*(self._resolve(name, url) for name, url in all_nodes.items()))))
+        self.ring = HashRing(nodes, self.ring.replicas)
+        if saved and set(saved) != set(nodes):
+            logger.info(f"Sharding: چینش قبلی {sorted(saved)} بود؛ کاربران به چینش جدید {sorted(nodes)} منتقل می‌شوند.")
+            self._previous = HashRing(saved, self.ring.replicas)
+            self._sources = sorted(saved)
+            self._draining = set(saved) - set(nodes)
+            self.schedule_rebalance()
+        self._save()
+        logger.info(f"Sharding: dispatcher با {len(nodes)} worker شروع شد: {self.urls}")
+
+    async def _resolve(self, name: str, url: str | None) -> str:
+        if url: return url
+        if self.pool is None: raise ValueError(f"worker '{name}' آدرس ندارد و worker محلی ساخته نمی‌شود.")
+        return await self.pool.spawn(name)
+
+    def _save(self) -> None:
+        if not self.state_path: return
+        # چینش حلقه (شامل workerهای در حال تخلیه تا پایان انتقال) برای اجرای بعدی
+        nodes = {name: url for name, url in self.urls.items() if name in self.ring.nodes or name in self._draining}
+        try: save_checkpoint(self.state_path, {"nodes": nodes, "ring": sorted(self.ring.nodes)})
+        except OSError as e: logger.warning(f"Sharding: ذخیره '{self.state_path}' ناموفق بود: {e}")
+
+    # --- مسیریابی ---
+    @asynccontextmanager
+    async def _user_lock(self, user_id: int):
+        lock = self._locks.get(user_id)
+        if lock is None: lock = self._locks[user_id] = asyncio.Lock()
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        try:
+            async with lock: yield
+        finally:
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+                del self._locks[user_id]
+
+    async def dispatch(self, payload: dict) -> None:
+        user_id = routing_user_id(payload)
+        if user_id is None:
+            await self._forward(self.ring.node_for(0), payload)
+            return
+        async with self._user_lock(user_id):
+            await self._forward(await self._owner(user_id), payload)
+
+    async def poll(self, bot, timeout: int = 30) -> None:
+        # حالت polling: dispatcher خودش getUpdates می‌گیرد؛ دسته بعدی پس از رسیدن (یا شکست نهایی) همه آپدیت‌های این دسته گرفته می‌شود
+        offset = None
+        while True:
+            try: updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                await asyncio.sleep(retry_after_seconds(e))
+                continue
+            except NetworkError as e:
+                logger.warning(f"Sharding: getUpdates ناموفق بود: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not updates: continue
+            # کاربران مختلف موازی؛ قفل هر کاربر ترتیب آپدیت‌های خودش را در دسته نگه می‌دارد
+            results = await asyncio.gather(*(self.dispatch(update.to_dict()) for update in updates), return_exceptions=True)
+            for update, result in zip(updates, results):
+                if isinstance(result, Exception): logger.error(f"Sharding: آپدیت {update.update_id} به worker نرسید و کنار گذاشته شد: {result}")
+            offset = updates[-1].update_id + 1
+
+    async def _owner(self, user_id: int) -> str:
+        node = self.ring.node_for(user_id)
+        previous = self._previous
+        if previous is None or user_id in self._migrated: return node
+        source = previous.node_for(user_id)
+        if source != node: await self._handoff(user_id, source, node)
+        self._migrated.add(user_id)
+        return node
+
+    async def _request(self, node: str, path: str, body: dict | None = None, timeout: float | None = None) -> dict:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                url = self.urls[node] + path
+                headers = {SHARD_SECRET_HEADER: self.secret}
+                timeout = timeout or self.request_timeout
+                if body is None: response = await self._client.get(url, headers=headers, timeout=timeout)
+                else: response = await self._client.post(url, content=json.dumps(body, ensure_ascii=False, default=str), headers={**headers, "Content-Type": "application/json"},
+                                                         timeout=timeout)
+                response.raise_for_status()
+                return response.json() if response.content else {}
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # 4xx (جز 429) با تکرار درست نمی‌شود
+                if isinstance(e, httpx.HTTPStatusError) and 400 <= e.response.status_code < 500 and e.response.status_code != 429: raise
+                if attempt >= self.max_attempts: raise
+                logger.warning(f"Sharding: درخواست {path} به worker '{node}' ناموفق بود (تلاش {attempt}): {e}")
+                await asyncio.sleep(min(2 ** (attempt - 1), 5))
+
+    async def _forward(self, node: str, payload: dict) -> None:
+        # worker آپدیت را از مسیر وب‌هوک خودش با توکن مخفی shard می‌پذیرد
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await self._client.post(self.urls[node] + UPDATE_PATH, json=payload, headers={SECRET_TOKEN_HEADER: self.secret})
+                response.raise_for_status()
+                self.forwarded += 1
+                metrics.SHARD_FORWARDS.inc(node=node, result="ok")
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    metrics.SHARD_FORWARDS.inc(node=node, result="failed")
+                    raise
+                logger.warning(f"Sharding: ارسال آپدیت {payload.get('update_id')} به worker '{node}' ناموفق بود (تلاش {attempt}): {e}")
+                await asyncio.sleep(min(2 ** (attempt - 1), 5))
+
+    async def _handoff(self, user_id: int, source: str, target: str) -> None:
+        state = await self._request(source, HANDOFF_EXPORT_PATH, {"user_id": user_id}, timeout=self.handoff_timeout)
+        if not state.get("user_data") and not state.get("conversations"): return
+        try: await self._request(target, HANDOFF_IMPORT_PATH, state)
+        except Exception:
+            # وضعیت از مبدأ برداشته شده است؛ برای از دست نرفتن به همان worker برمی‌گردد و انتقال بعداً دوباره امتحان می‌شود
+            metrics.SHARD_HANDOFFS.inc(result="failed")
+            await self._request(source, HANDOFF_IMPORT_PATH, state)
+            raise
+        self.handoffs += 1
+        metrics.SHARD_HANDOFFS.inc(result="ok")
+        logger.info(f"Sharding: کاربر {user_id} از '{source}' به '{target}' منتقل شد.")
+
+    # --- تغییر چینش ---
+    async def add_node(self, name: str, url: str | None = None) -> None:
+        async with self._rebalance_lock:
+            if self._previous is not None: raise RebalanceInProgress("انتقال قبلی هنوز تمام نشده است.")
+            if name in self.urls: raise ValueError(f"worker '{name}' از قبل وجود دارد.")
+            self.urls[name] = await self._resolve(name, url)
+            ring = self.ring.copy()
+            ring.add(name)
+            self._begin(ring, sources=sorted(self.ring.nodes))
+
+    async def drain_node(self, name: str, force: bool = False) -> None:
+        # force: worker از دسترس خارج است؛ بدون انتقال وضعیت حذف می‌شود و کاربرانش از نو شروع می‌کنند
+        async with self._rebalance_lock:
+            if self._previous is not None: raise RebalanceInProgress("انتقال قبلی هنوز تمام نشده است.")
+            if name not in self.ring.nodes: raise ValueError(f"worker '{name}' در حلقه نیست.")
+            if len(self.ring.nodes) == 1: raise ValueError("آخرین worker را نمی‌توان تخلیه کرد.")
+            ring = self.ring.copy()
+            ring.remove(name)
+            if force:
+                self.ring = ring
+                await self._retire(name)
+                self._save()
+                logger.warning(f"Sharding: worker '{name}' بدون انتقال وضعیت حذف شد.")
+                return
+            self._draining.add(name)
+            self._begin(ring, sources=[name])
+
+    def _begin(self, ring: HashRing, sources: list[str]) -> None:
+        self._previous, self.ring, self._sources, self._migrated = self.ring, ring, sources, set()
+        self._save()
+        logger.info(f"Sharding: حلقه به {sorted(ring.nodes)} تغییر کرد؛ انتقال کاربران از {sources} شروع شد.")
+        self.schedule_rebalance()
+
+    def schedule_rebalance(self) -> None:
+        # درخواست مدیریتی منتظر پیمایش نمی‌ماند؛ پیشرفت در stats دیده می‌شود
+        if self._rebalance_task is None or self._rebalance_task.done():
+            self._rebalance_task = asyncio.create_task(self._run_rebalance(), name="shard-rebalance")
+
+    async def _run_rebalance(self) -> None:
+        try: await self.rebalance()
+        except Exception as e: logger.error(f"Sharding: انتقال کاربران متوقف شد؛ حلقه قبلی برای انتقال تنبل می‌ماند و rebalance دوباره قابل اجراست: {e}", exc_info=True)
+
+    async def rebalance(self) -> None:
+        # پیمایش کاربران workerهای مبدأ؛ در صورت خطا حلقه قبلی می‌ماند (انتقال تنبل ادامه دارد) و rebalance دوباره قابل اجراست
+        async with self._rebalance_lock:
+            if self._previous is None: return
+            for source in list(self._sources):
+                user_ids = (await self._request(source, USERS_PATH)).get("users", [])
+                for user_id in user_ids:
+                    async with self._user_lock(user_id): await self._owner(user_id)
+                self._sources.remove(source)
+            for name in list(self._draining): await self._retire(name)
+            moved = len(self._migrated)
+            self._previous, self._migrated = None, set()
+            self._save()
+            logger.info(f"Sharding: انتقال کاربران تمام شد ({moved} کاربر بررسی شد، حلقه: {sorted(self.ring.nodes)}).")
+
+    async def _retire(self, name: str) -> None:
+        self._draining.discard(name)
+        self.urls.pop(name, None)
+        if self.pool is not None and name in self.pool: await self.pool.stop(name)
+
+    async def close(self) -> None:
+        if self._rebalance_task and not self._rebalance_task.done(): self._rebalance_task.cancel()
+        if self._client is not None: await self._client.aclose()
+        if self.pool is not None: await self.pool.close()
+        logger.info(f"آمار dispatcher: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {"nodes": sorted(self.ring.nodes), "urls": dict(self.urls), "rebalancing": self._previous is not None, "pending_sources": list(self._sources),
+                "forwarded": self.forwarded, "failed": self.failed, "handoffs": self.handoffs, "users_in_flight": len(self._pending)}
+
+
+def build_dispatcher_app(dispatcher: ShardDispatcher, webhook_path: str | None = None, secret_token: str | None = None,
+                         metrics_registry: metrics.Registry | None = None) -> Starlette:
+    # وب‌هوک تلگرام (در حالت webhook) و مدیریت workerها: GET /shards، POST /shards/add {name, url?}، POST /shards/drain {name, force?}، POST /shards/rebalance
+    async def health_check(request: Request) -> Response:
+        return PlainTextResponse('dispatcher ربات تلگرام تافته فعال است!')
+
+    async def liveness(request: Request) -> Response:
+        return PlainTextResponse("ok")
+
+    async def readiness(request: Request) -> Response:
+        return JSONResponse({"ready": dispatcher.ready, "shards": dispatcher.stats()}, status_code=200 if dispatcher.ready else 503)
+
+    async def metrics_endpoint(request: Request) -> Response:
+        return Response(metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
+
+    async def telegram_webhook(request: Request) -> Response:
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            logger.warning(f"درخواست وب‌هوک با توکن مخفی نامعتبر از {request.client.host if request.client else 'unknown'} رد شد.")
+            return Response(status_code=403)
+        try: payload = await request.json()
+        except json.JSONDecodeError:
+            return Response(status_code=400)
+        if not dispatcher.ready: return Response(status_code=503)
+        # پاسخ غیر 200 باعث می‌شود تلگرام همین آپدیت را بعداً دوباره بفرستد
+        try: await dispatcher.dispatch(payload)
+        except Exception as e:
+            logger.error(f"Sharding: آپدیت {payload.get('update_id')} به worker نرسید: {e}")
+            return Response(status_code=503)
+        return Response()
+
+    async def shards_status(request: Request) -> Response:
+        if not _authorized(request, dispatcher.secret): return Response(status_code=403)
+        return JSONResponse(dispatcher.stats())
+
+    async def shards_change(request: Request) -> Response:
+        if not _authorized(request, dispatcher.secret): return Response(status_code=403)
+        action = request.path_params["action"]
+        if action not in ("add", "drain", "rebalance"): return Response(status_code=404)
+        body = await request.json() if action != "rebalance" else {}
+        try:
+            if action == "add": await dispatcher.add_node(str(body["name"]), body.get("url"))
+            elif action == "drain": await dispatcher.drain_node(str(body["name"]), force=bool(body.get("force")))
+            else: dispatcher.schedule_rebalance()
+        except KeyError: return JSONResponse({"error": "name لازم است."}, status_code=400)
+        except RebalanceInProgress as e: return JSONResponse({"error": str(e)}, status_code=409)
+        except ValueError as e: return JSONResponse({"error": str(e)}, status_code=400)
+        return JSONResponse(dispatcher.stats(), status_code=202)
+
+    routes = [Route("/", health_check), Route("/healthz", liveness), Route("/readyz", readiness), Route("/shards", shards_status),
+              Route("/shards/{action:str}", shards_change, methods=["POST"])]
+    if metrics_registry is not None: routes.append(Route("/metrics", metrics_endpoint))
+    if webhook_path: routes.append(Route(webhook_path, telegram_webhook, methods=["POST"]))
+    return Starlette(routes=routes)
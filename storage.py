@@ -0,0 +1,319 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import field_ops
+from profile_cache import apply_update
+
+logger = logging.getLogger(__name__)
+
+USERS_COLLECTION = "users"
+FIRESTORE_BATCH_LIMIT = 500
+WARMUP_DOCUMENT_ID = "__warmup__"
+
+
+class DocumentNotFound(LookupError):
+    pass
+
+
+def init_firebase():
+    # در thread جدا اجرا می‌شود: import و ساخت credentials و کلاینت فایراستور چند صد میلی‌ثانیه CPU و I/O می‌گیرد
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    try:
+        cred_path_render = os.getenv("FIREBASE_CREDENTIALS_PATH", "/etc/secrets/firebase-service-account-key.json")
+        cred_path_local = "firebase-service-account-key.json"
+        cred_path = cred_path_render if os.path.exists(cred_path_render) else cred_path_local
+        if not os.path.exists(cred_path):
+            logger.warning(f"فایل کلید Firebase در مسیر '{cred_path}' یافت نشد.")
+            return None
+        cred = credentials.Certificate(cred_path)
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        client = firestore.client()
+        logger.info("Firebase Admin SDK با موفقیت مقداردهی اولیه شد.")
+        return client
+    except Exception as e:
+        logger.error(f"خطای بحرانی در مقداردهی اولیه Firebase: {e}", exc_info=True)
+        return None
+
+
+def _to_firestore(data: dict) -> dict:
+    # firebase_admin فقط وقتی بک‌اند فایراستور ساخته شود import می‌شود (بیش از نیم ثانیه در شروع برنامه)
+    from google.cloud.firestore_v1 import transforms
+
+    converted = {}
+    for key, value in data.items():
+        if value is field_ops.SERVER_TIMESTAMP: value = transforms.SERVER_TIMESTAMP
+        elif value is field_ops.DELETE_FIELD: value = transforms.DELETE_FIELD
+        elif isinstance(value, field_ops.Increment): value = transforms.Increment(value.value)
+        elif isinstance(value, field_ops.ArrayUnion): value = transforms.ArrayUnion(value.values)
+        elif isinstance(value, field_ops.ArrayRemove): value = transforms.ArrayRemove(value.values)
+        converted[key] = value
+    return converted
+
+
+def _page_query(collection, limit: int, start_after: str | None, where: dict | None = None):
+    # مرتب‌سازی بر اساس شناسه سند؛ کلاینت فایراستور رشته را برای '__name__' به DocumentReference تبدیل می‌کند
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    query = collection
+    for field, value in (where or {}).items(): query = query.where(filter=FieldFilter(field, "==", value))
+    query = query.order_by("__name__").limit(limit)
+    return query.start_after({"__name__": start_after}) if start_after is not None else query
+
+
+class ProfileBackend:
+    # قرارداد مشترک بک‌اندها: داده‌ها dict هستند و مقادیر نوشتنی می‌توانند عملیات field_ops باشند
+    # (SERVER_TIMESTAMP, Increment, ArrayUnion, ArrayRemove, DELETE_FIELD)؛ هر بک‌اند آن‌ها را اتمیک اعمال می‌کند
+    name = "base"
+
+    async def get(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+    async def create(self, user_id: str, data: dict) -> None:
+        raise NotImplementedError
+
+    async def update(self, user_id: str, data: dict) -> None:
+        # مثل Firestore: اگر سند وجود نداشته باشد DocumentNotFound (یا خطای معادل) رخ می‌دهد
+        raise NotImplementedError
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        raise NotImplementedError
+
+    async def run_transaction(self, user_id: str, build):
+        # build: (existing: dict | None) -> (write_data, is_create, result)؛ ممکن است در تلاش مجدد چند بار اجرا شود
+        raise NotImplementedError
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        # صفحه‌ای از پروفایل‌ها به ترتیب user_id (برای ابزارهای دسته‌ای مثل migrate_profiles.py)؛ where فقط شرط تساوی فیلدهاست
+        raise NotImplementedError
+
+    async def warm_up(self) -> None:
+        # پیش از پذیرش آپدیت‌ها صدا زده می‌شود تا اتصال و احراز هویت هزینه اولین کاربر نشود
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class FirestoreBackend(ProfileBackend):
+    name = "firestore"
+
+    def __init__(self, async_db):
+        self._db = async_db
+
+    def _ref(self, user_id: str):
+        return self._db.collection(USERS_COLLECTION).document(user_id)
+
+    async def get(self, user_id: str) -> dict | None:
+        snapshot = await self._ref(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def create(self, user_id: str, data: dict) -> None:
+        await self._ref(user_id).set(_to_firestore(data))
+
+    async def update(self, user_id: str, data: dict) -> None:
+        await self._ref(user_id).update(_to_firestore(data))
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        items = list(updates.items())
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = self._db.batch()
+            for user_id, data in items[start:start + FIRESTORE_BATCH_LIMIT]: batch.update(self._ref(user_id), _to_firestore(data))
+            await batch.commit()
+
+    async def run_transaction(self, user_id: str, build):
+        from firebase_admin import firestore_async
+
+        user_ref = self._ref(user_id)
+
+        @firestore_async.async_transactional
+        async def _txn(transaction):
+            snapshot = await user_ref.get(transaction=transaction)
+            write_data, is_create, result = build(snapshot.to_dict() if snapshot.exists else None)
+            if is_create: transaction.set(user_ref, _to_firestore(write_data))
+            elif write_data: transaction.update(user_ref, _to_firestore(write_data))
+            return result
+
+        return await _txn(self._db.transaction())
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        query = _page_query(self._db.collection(USERS_COLLECTION), limit, start_after, where)
+        return [(snapshot.id, snapshot.to_dict()) async for snapshot in query.stream()]
+
+    async def warm_up(self) -> None:
+        # یک خواندن سبک کانال gRPC و توکن دسترسی را آماده می‌کند
+        await self._ref(WARMUP_DOCUMENT_ID).get()
+
+
+class FirestoreSyncBackend(ProfileBackend):
+    # مسیر sync فایراستور (وقتی FIRESTORE_ASYNC_ENABLED خاموش است)؛ هر فراخوانی در یک thread جدا اجرا می‌شود
+    name = "firestore_sync"
+
+    def __init__(self, db):
+        self._db = db
+
+    def _ref(self, user_id: str):
+        return self._db.collection(USERS_COLLECTION).document(user_id)
+
+    def _get_sync(self, user_id: str) -> dict | None:
+        snapshot = self._ref(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def get(self, user_id: str) -> dict | None:
+        return await asyncio.to_thread(self._get_sync, user_id)
+
+    async def create(self, user_id: str, data: dict) -> None:
+        await asyncio.to_thread(self._ref(user_id).set, _to_firestore(data))
+
+    async def update(self, user_id: str, data: dict) -> None:
+        await asyncio.to_thread(self._ref(user_id).update, _to_firestore(data))
+
+    def _update_many_sync(self, items: list) -> None:
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = self._db.batch()
+            for user_id, data in items[start:start + FIRESTORE_BATCH_LIMIT]: batch.update(self._ref(user_id), _to_firestore(data))
+            batch.commit()
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        await asyncio.to_thread(self._update_many_sync, list(updates.items()))
+
+    def _run_transaction_sync(self, user_id: str, build):
+        from firebase_admin import firestore
+
+        user_ref = self._ref(user_id)
+
+        @firestore.transactional
+        def _txn(transaction):
+            snapshot = user_ref.get(transaction=transaction)
+            write_data, is_create, result = build(snapshot.to_dict() if snapshot.exists else None)
+            if is_create: transaction.set(user_ref, _to_firestore(write_data))
+            elif write_data: transaction.update(user_ref, _to_firestore(write_data))
+            return result
+
+        return _txn(self._db.transaction())
+
+    async def run_transaction(self, user_id: str, build):
+        return await asyncio.to_thread(self._run_transaction_sync, user_id, build)
+
+    def _list_page_sync(self, limit: int, start_after: str | None, where: dict | None) -> list[tuple[str, dict]]:
+        query = _page_query(self._db.collection(USERS_COLLECTION), limit, start_after, where)
+        return [(snapshot.id, snapshot.to_dict()) for snapshot in query.stream()]
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        return await asyncio.to_thread(self._list_page_sync, limit, start_after, where)
+
+    async def warm_up(self) -> None:
+        await asyncio.to_thread(self._get_sync, WARMUP_DOCUMENT_ID)
+
+
+def _json_default(value):
+    if isinstance(value, datetime): return {"$datetime": value.isoformat()}
+    raise TypeError(f"نوع {type(value).__name__} در بک‌اند SQLite قابل ذخیره نیست.")
+
+
+def _json_object_hook(obj: dict):
+    if len(obj) == 1 and "$datetime" in obj: return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+class SqliteBackend(ProfileBackend):
+    # هر پروفایل یک سطر JSON است؛ sentinelها با apply_update داخل یک تراکنش BEGIN IMMEDIATE اعمال می‌شوند،
+    # پس Increment و ArrayUnion بین چند نوشتن همزمان (حتی از چند فرایند) اتمیک می‌مانند
+    name = "sqlite"
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+        logger.info(f"بک‌اند SQLite پروفایل‌ها در '{path}' آماده شد.")
+
+    def _load(self, user_id: str) -> dict | None:
+        row = self._conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0], object_hook=_json_object_hook) if row else None
+
+    def _store(self, user_id: str, data: dict) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO profiles (user_id, data, updated_at) VALUES (?, ?, ?)",
+                           (user_id, json.dumps(data, ensure_ascii=False, default=_json_default), time.time()))
+
+    def _in_transaction(self, work):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _get_sync(self, user_id: str) -> dict | None:
+        with self._lock: return self._load(user_id)
+
+    def _update_one(self, user_id: str, data: dict) -> None:
+        existing = self._load(user_id)
+        if existing is None: raise DocumentNotFound(f"پروفایل {user_id} وجود ندارد.")
+        self._store(user_id, apply_update(existing, data))
+
+    def _update_many_sync(self, updates: dict[str, dict]) -> None:
+        # همه نوشتن‌های دسته در یک تراکنش و یک fsync ثبت می‌شوند؛ سند ناموجود کل دسته را برمی‌گرداند (مثل batch فایراستور)
+        def work():
+            for user_id, data in updates.items(): self._update_one(user_id, data)
+        self._in_transaction(work)
+
+    def _run_transaction_sync(self, user_id: str, build):
+        def work():
+            existing = self._load(user_id)
+            write_data, is_create, result = build(existing)
+            if is_create: self._store(user_id, apply_update({}, write_data))
+            elif write_data: self._store(user_id, apply_update(existing, write_data))
+            return result
+        return self._in_transaction(work)
+
+    async def get(self, user_id: str) -> dict | None:
+        return await asyncio.to_thread(self._get_sync, user_id)
+
+    async def create(self, user_id: str, data: dict) -> None:
+        await asyncio.to_thread(self._in_transaction, lambda: self._store(user_id, apply_update({}, data)))
+
+    async def update(self, user_id: str, data: dict) -> None:
+        await asyncio.to_thread(self._in_transaction, lambda: self._update_one(user_id, data))
+
+    async def update_many(self, updates: dict[str, dict]) -> None:
+        if updates: await asyncio.to_thread(self._update_many_sync, updates)
+
+    async def run_transaction(self, user_id: str, build):
+        return await asyncio.to_thread(self._run_transaction_sync, user_id, build)
+
+    def _list_page_sync(self, limit: int, start_after: str | None, where: dict | None) -> list[tuple[str, dict]]:
+        # json_extract مقدار true/false را 1/0 برمی‌گرداند که با bool پایتون برابر است
+        conditions, params = ["user_id > ?"], [start_after if start_after is not None else ""]
+        for field, value in (where or {}).items():
+            conditions.append("json_extract(data, ?) = ?")
+            params.extend([f"$.{field}", value])
+        with self._lock:
+            rows = self._conn.execute(f"SELECT user_id, data FROM profiles WHERE {' AND '.join(conditions)} ORDER BY user_id LIMIT ?",
+                                      (*params, limit)).fetchall()
+        return [(user_id, json.loads(data, object_hook=_json_object_hook)) for user_id, data in rows]
+
+    async def list_page(self, limit: int, start_after: str | None = None, where: dict | None = None) -> list[tuple[str, dict]]:
+        return await asyncio.to_thread(self._list_page_sync, limit, start_after, where)
+
+    async def warm_up(self) -> None:
+        await asyncio.to_thread(self._get_sync, WARMUP_DOCUMENT_ID)
+
+    def count(self) -> int:
+        with self._lock: return self._conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+
+    async def close(self) -> None:
+        with self._lock: self._conn.close()
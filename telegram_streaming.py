@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import re
+import time
+
+from telegram import Message
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+STREAM_CURSOR = " ▌"
+
+
+def to_telegram_markdown(text: str) -> str:
+    # مدل‌ها Markdown استاندارد تولید می‌کنند؛ حالت Markdown قدیمی تلگرام فقط *bold* و _italic_ را می‌شناسد
+    text = re.sub(r"^#{1,6}\s*(.+)$", r"*\1*", text, flags=re.MULTILINE)
+    text = text.replace("**", "*").replace("__", "_")
+    return text
+
+
+def split_for_telegram(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0: cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+async def send_markdown_reply(message: Message, text: str, reply_markup=None) -> None:
+    for part in split_for_telegram(text):
+        try: await message.reply_text(to_telegram_markdown(part), parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+        except BadRequest: await message.reply_text(part, reply_markup=reply_markup)
+
+
+class ProgressiveMessage:
+    def __init__(self, message: Message, min_interval: float = 1.5, min_new_chars: int = 20):
+        self.message = message
+        self.min_interval = min_interval
+        self.min_new_chars = min_new_chars
+        self._shown_text = message.text or ""
+        self._next_edit_at = 0.0
+        self.edit_count = 0
+
+    async def _edit(self, text: str, parse_mode: str | None = None) -> bool:
+        try:
+            await self.message.edit_text(text, parse_mode=parse_mode)
+            self._shown_text = text
+            self.edit_count += 1
+            return True
+        except RetryAfter as e:
+            # محدودیت ویرایش تلگرام: تا پایان زمان انتظار ویرایش میانی انجام نمی‌شود
+            self._next_edit_at = time.monotonic() + retry_after_seconds(e)
+            logger.warning(f"ویرایش پیام استریم محدود شد. تلاش بعدی پس از {e.retry_after} ثانیه.")
+        except BadRequest as e:
+            if "not modified" in str(e).lower(): return True
+            if parse_mode: raise
+            logger.warning(f"ویرایش پیام استریم ناموفق: {e}")
+        except TelegramError as e:
+            logger.warning(f"ویرایش پیام استریم ناموفق: {e}")
+        return False
+
+    async def update(self, partial_text: str) -> None:
+        now = time.monotonic()
+        if now < self._next_edit_at: return
+        if len(partial_text) - len(self._shown_text) < self.min_new_chars: return
+        preview = partial_text[: MessageLimit.MAX_TEXT_LENGTH - len(STREAM_CURSOR)] + STREAM_CURSOR
+        self._next_edit_at = now + self.min_interval
+        await self._edit(preview)
+
+    async def finalize(self, final_text: str, reply_markup=None) -> None:
+        parts = split_for_telegram(final_text)
+        first, rest = parts[0], parts[1:]
+        # ویرایش نهایی نباید به خاطر محدودیت نرخ از دست برود
+        wait = self._next_edit_at - time.monotonic()
+        if wait > 0: await asyncio.sleep(min(wait, 5.0))
+        try: ok = await self._edit(to_telegram_markdown(first), parse_mode=ParseMode.MARKDOWN)
+        except BadRequest as e:
+            logger.info(f"رندر Markdown پاسخ ممکن نبود ({e})، ارسال به صورت متن ساده.")
+            ok = await self._edit(first)
+        bot, chat_id = self.message.get_bot(), self.message.chat_id
+        if not ok: await bot.send_message(chat_id=chat_id, text=first)
+        for part in rest:
+            try: await bot.send_message(chat_id=chat_id, text=to_telegram_markdown(part), parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            except BadRequest: await bot.send_message(chat_id=chat_id, text=part, reply_markup=reply_markup)
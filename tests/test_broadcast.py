@@ -0,0 +1,55 @@
+import asyncio
+import shutil
+from collections import Counter
+
+from broadcast import Broadcaster
+from storage import SqliteBackend
+
+
+class RecordingBot:
+    # در ارسال شماره crash_at از فایل checkpoint کپی گرفته و فرایند «کشته» می‌شود (آنچه روی دیسک است همان چیزی است که می‌ماند)
+    def __init__(self, checkpoint_path: str, crash_at: int | None = None):
+        self.checkpoint_path = checkpoint_path
+        self.crash_at = crash_at
+        self.sent = Counter()
+        self.crashed = asyncio.Event()
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if self.crashed.is_set(): await asyncio.Event().wait() # فرایند مرده است؛ ارسال دیگری انجام نمی‌شود
+        self.sent[chat_id] += 1
+        if sum(self.sent.values()) == self.crash_at:
+            shutil.copyfile(self.checkpoint_path, f"{self.checkpoint_path}.crash")
+            self.crashed.set()
+            await asyncio.Event().wait()
+        await asyncio.sleep(0)
+
+
+def test_resume_after_crash_only_repeats_in_flight_sends(tmp_path):
+    async def scenario():
+        checkpoint_path = str(tmp_path / "broadcast.json")
+        backend = SqliteBackend(str(tmp_path / "profiles.sqlite3"))
+        members = [str(1000 + i) for i in range(30)]
+        for user_id in members: await backend.create(user_id, {"is_club_member": True})
+        options = dict(rate_per_second=1000, burst=1000, per_chat_interval=0, workers=2, page_size=50)
+
+        bot = RecordingBot(checkpoint_path, crash_at=12)
+        first = Broadcaster(bot, backend, checkpoint_path, **options)
+        first.start("hello")
+        await bot.crashed.wait()
+        await asyncio.sleep(0.05)
+        first._task.cancel() # finally در _run دیگر مهم نیست؛ checkpoint لحظه crash برگردانده می‌شود
+        await asyncio.gather(first._task, return_exceptions=True)
+        shutil.copyfile(f"{checkpoint_path}.crash", checkpoint_path)
+
+        bot.crash_at = None
+        bot.crashed = asyncio.Event()
+        second = Broadcaster(bot, backend, checkpoint_path, **options)
+        assert second.resume() is not None
+        state = await second.wait()
+        assert state["completed"]
+        assert set(bot.sent) == {int(user_id) for user_id in members}
+        duplicates = sum(count - 1 for count in bot.sent.values())
+        assert duplicates <= options["workers"]
+        await backend.close()
+
+    asyncio.run(scenario())
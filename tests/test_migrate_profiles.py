@@ -0,0 +1,36 @@
+import asyncio
+
+import migrate_profiles
+from storage import SqliteBackend
+
+
+class FailingBackend(SqliteBackend):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.failing: set[str] = set()
+
+    async def run_transaction(self, user_id, build):
+        if user_id in self.failing: raise ConnectionError("transaction aborted")
+        return await super().run_transaction(user_id, build)
+
+
+def test_failed_profiles_are_retried_on_resume(tmp_path):
+    async def scenario():
+        checkpoint_path = str(tmp_path / "checkpoint.json")
+        backend = FailingBackend(str(tmp_path / "profiles.sqlite3"))
+        for i in range(5): await backend.create(f"u{i}", {"user_id": f"u{i}"})
+        backend.failing = {"u1"}
+
+        first = await migrate_profiles.migrate(backend, page_size=2, checkpoint_path=checkpoint_path)
+        assert first["failed_user_ids"] == ["u1"] and first["failed"] == 1
+        assert not first["completed"]
+        assert "schema_version" not in await backend.get("u1")
+
+        backend.failing = set()
+        second = await migrate_profiles.migrate(backend, page_size=2, checkpoint_path=checkpoint_path)
+        assert second["failed_user_ids"] == [] and second["completed"]
+        assert second["upgraded"] == 5
+        assert (await backend.get("u1"))["schema_version"] == migrate_profiles.profile_store.PROFILE_SCHEMA_VERSION
+        await backend.close()
+
+    asyncio.run(scenario())
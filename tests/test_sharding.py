@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler
+from telegram.request import BaseRequest
+
+import field_ops
+import profile_store
+from persistence import SqlitePersistence
+from profile_cache import ProfileCache
+from sharding import WorkerHandoff
+from storage import SqliteBackend
+from update_processor import UserOrderedUpdateProcessor
+from write_behind import WriteBehindBuffer
+
+USER_ID = 42
+CONVERSATION = "main_conversation"
+
+
+class OfflineRequest(BaseRequest):
+    # فقط getMe (برای initialize) پاسخ داده می‌شود؛ انتقال کاربر هیچ درخواستی به Bot API نمی‌فرستد
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        return 200, json.dumps({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Tafteh", "username": "tafteh_test_bot"}}).encode()
+
+
+async def _noop(update, context):
+    return ConversationHandler.END
+
+
+async def start_worker(persistence_path: str):
+    application = (ApplicationBuilder().token("1:test").request(OfflineRequest()).updater(None)
+                   .concurrent_updates(UserOrderedUpdateProcessor(4)).persistence(SqlitePersistence(persistence_path, update_interval=3600)).build())
+    application.add_handler(ConversationHandler(entry_points=[CommandHandler("start", _noop)], states={}, fallbacks=[], name=CONVERSATION, persistent=True))
+    handoff = WorkerHandoff(application, release_user=profile_store.release_user, timeout=10)
+    handoff.install()
+    await application.initialize()
+    await application.start()
+    return application, handoff
+
+
+async def stop_worker(application) -> None:
+    await application.stop()
+    await application.shutdown()
+    application.persistence.close()
+
+
+def _conversation_handler(application) -> ConversationHandler:
+    return next(h for handlers in application.handlers.values() for h in handlers if isinstance(h, ConversationHandler))
+
+
+def test_handoff_flushes_write_behind_and_moves_state(tmp_path):
+    async def scenario():
+        # هر دو worker یک دیتابیس پروفایل مشترک دارند؛ write-behind و کش پروفایل فقط در worker مبدأ فعال است
+        backend = SqliteBackend(str(tmp_path / "profiles.sqlite3"))
+        cache = ProfileCache()
+        write_behind = WriteBehindBuffer(backend, interval=3600)
+        profile_store.configure(backend, cache=cache, write_behind=write_behind)
+        source, source_handoff = await start_worker(str(tmp_path / "source.sqlite3"))
+        target, target_handoff = await start_worker(str(tmp_path / "target.sqlite3"))
+        try:
+            await backend.create(str(USER_ID), {"user_id": str(USER_ID), "points": 10})
+            assert (await profile_store.get_user_profile_data(str(USER_ID)))["points"] == 10
+            await profile_store.update_user_profile_data(str(USER_ID), {"points": field_ops.Increment(5)})
+            assert write_behind.pending_users == 1
+            source.user_data[USER_ID]["age_asked"] = True
+            _conversation_handler(source)._conversations[(USER_ID, USER_ID)] = 3
+
+            state = await source_handoff.export(USER_ID)
+
+            # نوشتن بافرشده پیش از تحویل ثبت شده و worker مبدأ پروفایل کهنه‌ای در کش ندارد
+            assert write_behind.pending_users == 0
+            assert (await backend.get(str(USER_ID)))["points"] == 15
+            assert cache.get(str(USER_ID)) is None
+            assert USER_ID not in source.user_data
+            assert (USER_ID, USER_ID) not in _conversation_handler(source)._conversations
+            assert USER_ID not in source.persistence.stored_user_ids()
+
+            # وضعیت از مسیر HTTP به صورت JSON منتقل می‌شود
+            await target_handoff.import_state(json.loads(json.dumps(state)))
+            assert target.user_data[USER_ID] == {"age_asked": True}
+            assert _conversation_handler(target)._conversations[(USER_ID, USER_ID)] == 3
+            assert USER_ID in target.persistence.stored_user_ids()
+
+            # نوشتن worker مقصد با تخلیه بعدی worker مبدأ بازنویسی نمی‌شود
+            await backend.update(str(USER_ID), {"points": field_ops.Increment(1)})
+            await write_behind.flush()
+            assert (await backend.get(str(USER_ID)))["points"] == 16
+        finally:
+            await stop_worker(source)
+            await stop_worker(target)
+            await profile_store.close()
+            profile_store.configure(None)
+
+    asyncio.run(scenario())
@@ -0,0 +1,27 @@
+import asyncio
+
+from tip_pool import HealthTipPool
+
+
+def test_rotate_spends_llm_calls_only_in_proportion_to_served_tips():
+    async def scenario():
+        calls = []
+
+        async def generator(count):
+            calls.append(count)
+            return [f"نکته سلامتی شماره {len(calls)}-{i} از دسته تولیدشده" for i in range(count)]
+
+        pool = HealthTipPool(generator, ["fallback tip long enough"], target_size=4, batch_size=2, similarity_threshold=1.1) # حذف نکته‌های مشابه در این تست خاموش است
+        assert await pool.rotate() # استخر خالی: پر شدن اولیه
+        for _ in range(5): assert not await pool.rotate() # بدون ترافیک هیچ فراخوانی
+        assert len(calls) == 1
+
+        await pool.get_tip("u1")
+        assert await pool.rotate() # استخر در حال استفاده هنوز به target_size نرسیده
+        await pool.get_tip("u1")
+        assert not await pool.rotate() # استخر پر و کمتر از batch_size نکته سرو شده
+        await pool.get_tip("u2")
+        assert await pool.rotate() # batch_size نکته سرو شده: قدیمی‌ترین نکته‌ها جای خود را می‌دهند
+        assert len(calls) == 3 and pool.stats()["evicted"] > 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+import asyncio
+
+import field_ops
+import profile_store
+from profile_cache import ProfileCache
+from storage import SqliteBackend
+from write_behind import WriteBehindBuffer
+
+
+class FlakyBackend(SqliteBackend):
+    # نوشتن‌ها تا زمان down_until (یا همیشه) خطا می‌دهند؛ commit_gate اجازه می‌دهد نوشتن پس از ثبت در دیتابیس نگه داشته شود
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.down_until = 0.0
+        self.commit_gate: asyncio.Event | None = None
+
+    def _check(self) -> None:
+        if asyncio.get_running_loop().time() < self.down_until: raise ConnectionError("backend unavailable")
+
+    async def update(self, user_id, data):
+        self._check()
+        await super().update(user_id, data)
+
+    async def update_many(self, updates):
+        self._check()
+        await super().update_many(updates)
+        if self.commit_gate is not None: await self.commit_gate.wait()
+
+
+def test_close_retries_transient_outage_without_dropping(tmp_path):
+    async def scenario():
+        backend = FlakyBackend(str(tmp_path / "profiles.sqlite3"))
+        await backend.create("1", {"points": 0})
+        buffer = WriteBehindBuffer(backend, interval=3600, max_attempts=3, drain_timeout=10)
+        buffer.add("1", {"points": field_ops.Increment(5)})
+        backend.down_until = asyncio.get_running_loop().time() + 1.0
+        await buffer.close()
+        assert (await backend.get("1"))["points"] == 5
+        assert buffer.stats()["dropped"] == 0
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_undeliverable_writes_are_spilled_and_restored(tmp_path):
+    async def scenario():
+        spill_path = str(tmp_path / "spill.jsonl")
+        backend = FlakyBackend(str(tmp_path / "profiles.sqlite3"))
+        await backend.create("1", {"points": 0, "badges": []})
+        buffer = WriteBehindBuffer(backend, interval=3600, spill_path=spill_path, drain_timeout=0.3)
+        buffer.add("1", {"points": field_ops.Increment(5), "badges": field_ops.ArrayUnion(["a"]), "last_updated_date": field_ops.SERVER_TIMESTAMP})
+        buffer.add("1", {"badges": field_ops.ArrayRemove(["a"])}) # نسل دوم
+        backend.down_until = float("inf")
+        await buffer.close()
+        assert buffer.stats()["spilled"] == 2 and buffer.stats()["dropped"] == 0
+
+        backend.down_until = 0.0
+        restarted = WriteBehindBuffer(backend, interval=3600, spill_path=spill_path)
+        restarted.start()
+        assert restarted.pending_users == 1
+        await restarted.close()
+        profile = await backend.get("1")
+        assert profile["points"] == 5 and profile["badges"] == [] and "last_updated_date" in profile
+        assert not (tmp_path / "spill.jsonl").exists()
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_read_during_committed_flush_does_not_count_increment_twice(tmp_path):
+    async def scenario():
+        backend = FlakyBackend(str(tmp_path / "profiles.sqlite3"))
+        await backend.create("1", {"points": 10})
+        cache = ProfileCache()
+        buffer = WriteBehindBuffer(backend, interval=3600)
+        profile_store.configure(backend, cache=cache, write_behind=buffer)
+        try:
+            await profile_store.update_user_profile_data("1", {"points": field_ops.Increment(5)})
+            cache.invalidate("1")
+            # دسته در دیتابیس ثبت شده ولی flush هنوز تمام نشده (نوشتن در جریان است) که خواندن از بک‌اند انجام می‌شود
+            backend.commit_gate = asyncio.Event()
+            flush = asyncio.create_task(buffer.flush())
+            while (await backend.get("1"))["points"] != 15: await asyncio.sleep(0.01)
+            read = asyncio.create_task(profile_store.get_user_profile_data("1"))
+            await asyncio.sleep(0.05)
+            backend.commit_gate.set()
+            await flush
+            assert (await read)["points"] == 15
+            assert cache.get("1")["points"] == 15
+        finally:
+            await profile_store.close()
+            profile_store.configure(None)
+
+    asyncio.run(scenario())
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import random
+import re
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION_RE = re.compile(r"[\W_]+", re.UNICODE)
+_LIST_PREFIX_RE = re.compile(r"^\s*(?:[-*•]+|[0-9۰-۹]+[.)\-:]|[0-9۰-۹]+\s*[-–])\s*")
+
+
+def normalize_tip(text: str) -> str:
+    text = text.replace("ي", "ی").replace("ك", "ک").replace("‌", " ")
+    return _PUNCTUATION_RE.sub(" ", text).strip()
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    compact = normalize_tip(text).replace(" ", "")
+    return {compact[i:i + size] for i in range(max(1, len(compact) - size + 1))}
+
+
+def parse_tip_lines(raw: str) -> list[str]:
+    tips = []
+    for line in raw.splitlines():
+        line = _LIST_PREFIX_RE.sub("", line).strip().strip("*_\"'«»").strip()
+        if len(line) >= 15: tips.append(line)
+    return tips
+
+
+class HealthTipPool:
+    def __init__(self, generator, fallback_tips: list[str], target_size: int = 40, batch_size: int = 10,
+                 similarity_threshold: float = 0.6, recent_per_user: int = 20, max_tracked_users: int = 50000):
+        # generator: async (count) -> list[str]
+        self.generator = generator
+        self.fallback_tips = list(fallback_tips)
+        self.target_size = target_size
+        self.batch_size = batch_size
+        self.similarity_threshold = similarity_threshold
+        self.recent_per_user = recent_per_user
+        self.max_tracked_users = max_tracked_users
+        self._tips: deque[tuple[str, set]] = deque(maxlen=target_size)
+        self._served: OrderedDict[str, deque] = OrderedDict()
+        self._refill_lock = asyncio.Lock()
+        self.generated = 0
+        self.duplicates_dropped = 0
+        self.fallbacks_served = 0
+        self.evicted = 0
+        self.rotations_skipped = 0
+        self._served_since_refill = 0
+
+    def __len__(self) -> int:
+        return len(self._tips)
+
+    def _is_near_duplicate(self, shingles: set) -> bool:
+        for _, existing in self._tips:
+            union = len(shingles | existing)
+            if union and len(shingles & existing) / union >= self.similarity_threshold: return True
+        return False
+
+    def add_tips(self, tips: list[str]) -> int:
+        added = 0
+        for tip in tips:
+            shingles = _shingles(tip)
+            if self._is_near_duplicate(shingles):
+                self.duplicates_dropped += 1
+                continue
+            # استخر پر: deque با maxlen قدیمی‌ترین نکته را کنار می‌گذارد
+            if len(self._tips) == self._tips.maxlen: self.evicted += 1
+            self._tips.append((tip, shingles))
+            added += 1
+        self.generated += added
+        return added
+
+    async def refill(self) -> int:
+        if self._refill_lock.locked():
+            # درخواست‌های همزمان منتظر همان یک پر کردن می‌مانند
+            async with self._refill_lock: return 0
+        async with self._refill_lock:
+            try: tips = await self.generator(self.batch_size)
+            except Exception as e:
+                logger.error(f"خطا در تولید دسته نکات سلامتی: {e}", exc_info=True)
+                return 0
+            self._served_since_refill = 0
+            added = self.add_tips(tips or [])
+            logger.info(f"استخر نکات سلامتی: {added} نکته جدید اضافه شد (اندازه: {len(self._tips)}/{self.target_size}).")
+            return added
+
+    async def rotate(self) -> bool:
+        # کار دوره‌ای: دسته تازه (که قدیمی‌ترین نکته‌ها را کنار می‌گذارد) فقط به نسبت مصرف تولید می‌شود؛ یعنی وقتی از دسته قبلی دست‌کم
+        # batch_size نکته سرو شده، یا استخر در حال استفاده هنوز به target_size نرسیده، یا استخر خالی است (اولین اجرا).
+        # فرایند یا worker بی‌ترافیک پس از پر شدن اولیه هیچ فراخوانی LLM ندارد و هزینه با تعداد workerها چند برابر نمی‌شود.
+        served = self._served_since_refill
+        if self._tips and (served == 0 or (served < self.batch_size and len(self._tips) >= self.target_size)):
+            self.rotations_skipped += 1
+            return False
+        await self.refill()
+        return True
+
+    def _pick(self, user_id: str) -> str | None:
+        if not self._tips: return None
+        served = self._served.get(user_id)
+        if served is None:
+            served = deque(maxlen=self.recent_per_user)
+            self._served[user_id] = served
+            if len(self._served) > self.max_tracked_users: self._served.popitem(last=False)
+        else: self._served.move_to_end(user_id)
+        # چند انتخاب تصادفی با هزینه ثابت؛ اگر همه تکراری بودند، تکراری بودن پذیرفته می‌شود
+        tip = None
+        for _ in range(5):
+            tip = self._tips[random.randrange(len(self._tips))][0]
+            if tip not in served: break
+        served.append(tip)
+        self._served_since_refill += 1
+        return tip
+
+    async def get_tip(self, user_id: str) -> str:
+        tip = self._pick(user_id)
+        if tip is None:
+            await self.refill()
+            tip = self._pick(user_id)
+        if tip is None:
+            self.fallbacks_served += 1
+            logger.warning("استخر نکات سلامتی خالی است و تولید نکته ممکن نشد؛ استفاده از لیست ثابت.")
+            return random.choice(self.fallback_tips)
+        return tip
+
+    def stats(self) -> dict:
+        return {"size": len(self._tips), "generated": self.generated, "duplicates_dropped": self.duplicates_dropped, "fallbacks_served": self.fallbacks_served, "evicted": self.evicted, "rotations_skipped": self.rotations_skipped}
@@ -0,0 +1,143 @@
+import cProfile
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("tafteh_trace", default=None)
+
+
+class Trace:
+    def __init__(self, handler: str, update_id: int | None, user_id: int | None):
+        self.handler = handler
+        self.update_id = update_id
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.spans: list[dict] = []
+
+    def add(self, name: str, started: float, duration: float, attrs: dict) -> None:
+        # span‌هایی که پس از پایان آپدیت تمام می‌شوند (taskهای پس‌زمینه) جزو timeline نیستند
+        if self.duration is not None: return
+        self.spans.append({"name": name, "start_ms": round((started - self.started) * 1000, 1), "duration_ms": round(duration * 1000, 1), **attrs})
+
+    def to_dict(self) -> dict:
+        counts: dict[str, int] = {}
+        for span in self.spans: counts[span["name"]] = counts.get(span["name"], 0) + 1
+        return {"event": "slow_update", "handler": self.handler, "update_id": self.update_id, "user_id": self.user_id,
+                "duration_ms": round(self.duration * 1000, 1), "error": self.error, "span_counts": counts, "spans": self.spans}
+
+
+def current() -> Trace | None:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try: yield
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally: trace.add(name, started, time.perf_counter() - started, attrs)
+
+
+def event(name: str, **attrs) -> None:
+    trace = _current.get()
+    if trace is not None: trace.add(name, time.perf_counter(), 0.0, attrs)
+
+
+class UpdateTracer:
+    # هر هندلر یک timeline از span‌ها می‌سازد (خواندن/نوشتن پروفایل، LLM، درخواست‌های Bot API)؛ آپدیت‌های کندتر از slow_seconds
+    # به صورت JSON لاگ می‌شوند. درصدی از آپدیت‌ها (profile_sample_rate) با cProfile اجرا می‌شوند و اگر کند بودند dump آن ذخیره می‌شود.
+    # cProfile کل thread را می‌بیند، پس dump کارهای همزمان آپدیت‌های دیگر را هم دارد؛ در هر لحظه فقط یک آپدیت پروفایل می‌شود.
+    def __init__(self, slow_seconds: float = 3.0, profile_sample_rate: float = 0.0, profile_dir: str = "profiles", max_profiles: int = 50):
+        self.slow_seconds = slow_seconds
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self._profiling = False
+        self.traced = 0
+        self.slow = 0
+        self.profiles_written = 0
+
+    def wrap(self, callback, name: str | None = None):
+        name = name or getattr(callback, "__name__", "unknown")
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            user = getattr(update, "effective_user", None)
+            trace = Trace(name, getattr(update, "update_id", None), user.id if user else None)
+            token = _current.set(trace)
+            profiler = self._maybe_profiler()
+            try: return await callback(update, context)
+            except BaseException as e:
+                trace.error = type(e).__name__
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    self._profiling = False
+                _current.reset(token)
+                self._finish(trace, profiler)
+
+        return wrapper
+
+    def _maybe_profiler(self) -> cProfile.Profile | None:
+        if self._profiling or not self.profile_sample_rate or random.random() >= self.profile_sample_rate: return None
+        profiler = cProfile.Profile()
+        try: profiler.enable()
+        except ValueError: return None # پروفایلر دیگری فعال است
+        self._profiling = True
+        return profiler
+
+    def _finish(self, trace: Trace, profiler: cProfile.Profile | None) -> None:
+        trace.duration = time.perf_counter() - trace.started
+        self.traced += 1
+        if trace.duration < self.slow_seconds: return
+        self.slow += 1
+        record = trace.to_dict()
+        if profiler is not None: record["profile"] = self._dump(trace, profiler)
+        logger.warning(json.dumps(record, ensure_ascii=False, default=str))
+
+    def _dump(self, trace: Trace, profiler: cProfile.Profile) -> str | None:
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{trace.update_id}-{trace.handler}.prof")
+            profiler.dump_stats(path)
+            self.profiles_written += 1
+            # فقط max_profiles فایل آخر نگه داشته می‌شود
+            dumps = sorted(os.path.join(self.profile_dir, f) for f in os.listdir(self.profile_dir) if f.endswith(".prof"))
+            for old in dumps[:-self.max_profiles]: os.remove(old)
+            return path
+        except OSError as e:
+            logger.warning(f"Tracing: ذخیره پروفایل آپدیت {trace.update_id} ناموفق بود: {e}")
+            return None
+
+    def stats(self) -> dict:
+        return {"traced": self.traced, "slow": self.slow, "profiles_written": self.profiles_written, "slow_seconds": self.slow_seconds}
+
+
+class TracingRateLimiter(BaseRateLimiter):
+    # از نقطه اتصال rate limiter در PTB فقط برای ثبت span هر درخواست Bot API استفاده می‌شود؛ هیچ درخواستی معطل نمی‌شود
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        with span(f"telegram.{endpoint}"): return await callback(*args, **kwargs)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def _ordering_key(update: object):
+    # اشیای داخلی صف (مثل HandoffBarrier در sharding.py) کلید خودشان را دارند
+    if not isinstance(update, Update): return getattr(update, "ordering_key", None)
+    if update.effective_user: return ("user", update.effective_user.id)
+    if update.effective_chat: return ("chat", update.effective_chat.id)
+    return None
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    # آپدیت‌های کاربران مختلف همزمان اجرا می‌شوند و آپدیت‌های یک کاربر به ترتیب رسیدن، یکی‌یکی (user_data و وضعیت گفتگو سازگار می‌ماند).
+    # سمافور BaseUpdateProcessor فقط سقف آپدیت‌های در جریان (حافظه) است؛ سقف اجرای همزمان با سمافور جداگانه‌ای
+    # پس از قفل کاربر گرفته می‌شود تا آپدیت‌هایی که پشت قفل کاربر خودشان منتظرند جای اجرای دیگران را نگیرند.
+    # ترتیب: PTB برای هر آپدیت به ترتیب صف یک task می‌سازد و ثبت در قفل FIFO کاربر پیش از اولین await انجام می‌شود.
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int | None = None):
+        super().__init__(max(max_pending_updates or max_concurrent_updates * 32, max_concurrent_updates))
+        self.concurrency_limit = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        self._pending: dict[tuple, int] = {}
+        self.active = 0
+        self.waiting = 0
+        self.processed = 0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = _ordering_key(update)
+        if key is None:
+            async with self._running: await self._run(coroutine)
+            return
+        lock = self._locks.get(key)
+        if lock is None: lock = self._locks[key] = asyncio.Lock()
+        self._pending[key] = self._pending.get(key, 0) + 1
+        self.waiting += 1
+        started = False
+        try:
+            async with lock:
+                async with self._running:
+                    started = True
+                    self.waiting -= 1
+                    await self._run(coroutine)
+        finally:
+            if not started:
+                # لغو پیش از اجرا (خاموشی)؛ coroutine هرگز await نشده و باید بسته شود
+                self.waiting -= 1
+                coroutine.close()
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                del self._locks[key]
+
+    async def _run(self, coroutine) -> None:
+        self.active += 1
+        try: await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._pending: logger.warning(f"UpdateProcessor: {sum(self._pending.values())} آپدیت هنگام خاموشی هنوز در جریان بود.")
+
+    def stats(self) -> dict:
+        return {"limit": self.concurrency_limit, "active": self.active, "waiting": self.waiting, "users_in_flight": len(self._pending), "processed": self.processed}
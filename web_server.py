@@ -0,0 +1,62 @@
+import hmac
+import json
+import logging
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def build_web_app(application: Application, webhook_path: str | None = None, secret_token: str | None = None, readiness_checks: dict | None = None,
+                  metrics_registry: metrics.Registry | None = None, extra_routes: list | None = None) -> Starlette:
+    readiness_checks = readiness_checks or {}
+
+    async def health_check(request: Request) -> Response:
+        return PlainTextResponse('ربات تلگرام تافته فعال است!')
+
+    async def liveness(request: Request) -> Response:
+        return PlainTextResponse("ok")
+
+    async def readiness(request: Request) -> Response:
+        checks = {"application": application.running}
+        for name, check in readiness_checks.items():
+            try: checks[name] = bool(check())
+            except Exception as e:
+                logger.warning(f"بررسی آمادگی '{name}' با خطا مواجه شد: {e}")
+                checks[name] = False
+        return JSONResponse({"ready": all(checks.values()), "checks": checks}, status_code=200 if all(checks.values()) else 503)
+
+    async def metrics_endpoint(request: Request) -> Response:
+        return Response(metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
+
+    async def telegram_webhook(request: Request) -> Response:
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            logger.warning(f"درخواست وب‌هوک با توکن مخفی نامعتبر از {request.client.host if request.client else 'unknown'} رد شد.")
+            return Response(status_code=403)
+        try: payload = await request.json()
+        except json.JSONDecodeError:
+            return Response(status_code=400)
+        # تلگرام فقط منتظر 200 است؛ پردازش آپدیت در صف Application و خارج از این درخواست انجام می‌شود
+        await application.update_queue.put(Update.de_json(payload, application.bot))
+        return Response()
+
+    routes = [Route("/", health_check), Route("/healthz", liveness), Route("/readyz", readiness)]
+    if metrics_registry is not None: routes.append(Route("/metrics", metrics_endpoint))
+    if webhook_path: routes.append(Route(webhook_path, telegram_webhook, methods=["POST"]))
+    routes.extend(extra_routes or ())
+    return Starlette(routes=routes)
+
+
+def build_server(web_app: Starlette, host: str, port: int) -> uvicorn.Server:
+    config = uvicorn.Config(web_app, host=host, port=port, log_level="warning", access_log=False, lifespan="off")
+    return uvicorn.Server(config)
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+import field_ops
+import metrics
+from profile_cache import apply_update, resolve_value
+from storage import DocumentNotFound
+
+logger = logging.getLogger(__name__)
+
+_OPS = (field_ops.Increment, field_ops.ArrayUnion, field_ops.ArrayRemove)
+
+
+class _Conflict(Exception):
+    pass
+
+
+def _is_plain(value) -> bool:
+    return not isinstance(value, _OPS) and value is not field_ops.SERVER_TIMESTAMP and value is not field_ops.DELETE_FIELD
+
+
+def _merge_value(old, new):
+    # ترکیب دو نوشتن پشت سر هم روی یک فیلد به یک نوشتن معادل؛ اگر ممکن نباشد _Conflict (نوشتن دوم در نسل بعدی می‌ماند)
+    if _is_plain(new) or new is field_ops.SERVER_TIMESTAMP or new is field_ops.DELETE_FIELD: return new
+    if _is_plain(old): return resolve_value(old, new) # مقدار قطعی + عملیات = مقدار قطعی
+    if isinstance(new, field_ops.Increment) and isinstance(old, field_ops.Increment): return field_ops.Increment(old.value + new.value)
+    if isinstance(new, field_ops.ArrayUnion) and isinstance(old, field_ops.ArrayUnion):
+        return field_ops.ArrayUnion(old.values + [v for v in new.values if v not in old.values])
+    if isinstance(new, field_ops.ArrayRemove) and isinstance(old, field_ops.ArrayRemove):
+        return field_ops.ArrayRemove(old.values + [v for v in new.values if v not in old.values])
+    raise _Conflict()
+
+
+def _encode_value(value):
+    # عملیات field_ops در فایل spill به شکل JSON نگه داشته می‌شوند تا پس از راه‌اندازی دوباره همان معنا را داشته باشند
+    if value is field_ops.SERVER_TIMESTAMP or value is field_ops.DELETE_FIELD: return {"$op": value.name}
+    if isinstance(value, field_ops.Increment): return {"$op": "Increment", "value": value.value}
+    if isinstance(value, (field_ops.ArrayUnion, field_ops.ArrayRemove)): return {"$op": type(value).__name__, "values": value.values}
+    if isinstance(value, datetime): return {"$datetime": value.isoformat()}
+    raise TypeError(f"نوع {type(value).__name__} در فایل spill قابل ذخیره نیست.")
+
+
+def _decode_value(obj: dict):
+    op = obj.get("$op")
+    if op in ("SERVER_TIMESTAMP", "DELETE_FIELD"): return getattr(field_ops, op)
+    if op == "Increment": return field_ops.Increment(obj["value"])
+    if op in ("ArrayUnion", "ArrayRemove"): return getattr(field_ops, op)(obj["values"])
+    if len(obj) == 1 and "$datetime" in obj: return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+def _is_missing(error: Exception) -> bool:
+    # سند حذف‌شده (DocumentNotFound یا NotFound فایراستور با کد ۴۰۴) با تلاش دوباره درست نمی‌شود و spill نمی‌شود
+    return isinstance(error, DocumentNotFound) or getattr(error, "code", None) == 404
+
+
+def merge_payloads(first: dict, second: dict) -> dict | None:
+    merged = dict(first)
+    try:
+        for key, value in second.items(): merged[key] = _merge_value(first[key], value) if key in first else value
+    except _Conflict: return None
+    return merged
+
+
+class WriteBehindBuffer:
+    # آپدیت‌های پروفایل هر کاربر در حافظه ادغام می‌شوند و هر interval ثانیه (یا با رسیدن به max_batch کاربر) با update_many بک‌اند
+    # (batch فایراستور / یک تراکنش SQLite) نوشته می‌شوند. هر کاربر لیستی از «نسل‌ها» دارد: نوشتنی که با قبلی قابل ادغام نیست
+    # (مثل ArrayRemove پس از ArrayUnion) نسل جدید می‌سازد و نسل‌ها به ترتیب نوشته می‌شوند.
+    # نوشتنی که پس از max_attempts تلاش (یا تا پایان drain_timeout در خاموشی) ثبت نشود در spill_path ذخیره و در start بعدی دوباره صف می‌شود.
+    def __init__(self, backend, interval: float = 1.0, max_batch: int = 200, max_attempts: int = 3, spill_path: str | None = None, drain_timeout: float = 30.0):
+        self.backend = backend
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.spill_path = spill_path
+        self.drain_timeout = drain_timeout
+        self._pending: dict[str, list[dict]] = {}
+        self._first_queued_at: dict[str, float] = {}
+        self._attempts: dict[str, int] = {}
+        self._in_flight: dict[str, dict] = {} # نسلی که همین حالا در حال نوشتن است؛ add جدید به آن ادغام نمی‌شود
+        # شمارنده دسته‌های پایان‌یافته و کاربران آخرین دسته‌ها؛ overlay با آن خواندن‌های هم‌زمان با نوشتن همان کاربر را تشخیص می‌دهد
+        self._settled = 0
+        self._recent_batches: deque[tuple[int, frozenset]] = deque(maxlen=256)
+        self._draining = False
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.on_failure = None # (user_id) -> None؛ برای باطل کردن کش پس از نوشتن ناموفق
+        self.writes_in = 0
+        self.writes_out = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.restored = 0
+        self.max_batch_seen = 0
+        self.max_lag = 0.0
+
+    @property
+    def pending_users(self) -> int:
+        return len(self._pending.keys() | self._in_flight.keys())
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._restore_spill()
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="profile-write-behind")
+
+    def add(self, user_id: str, data: dict) -> None:
+        self.writes_in += 1
+        generations = self._pending.get(user_id)
+        if generations is None:
+            self._pending[user_id] = [dict(data)]
+            self._first_queued_at[user_id] = time.monotonic()
+        else:
+            merged = merge_payloads(generations[-1], data)
+            if merged is None: generations.append(dict(data))
+            else: generations[-1] = merged
+        if len(self._pending) >= self.max_batch: self._wakeup.set()
+
+    def read_marker(self) -> int:
+        # پیش از خواندن از بک‌اند گرفته و به overlay داده می‌شود
+        return self._settled
+
+    def overlay(self, user_id: str, data: dict, marker: int | None = None) -> dict | None:
+        # داده خوانده‌شده از بک‌اند هنوز نوشتن‌های در صف را ندارد. اگر نوشتن همین کاربر در جریان است یا حین خواندن ثبت شده،
+        # معلوم نیست خواندن آن را دیده یا نه (Increment دو بار یا هیچ بار شمرده می‌شد)؛ None یعنی نتیجه قابل اعتماد نیست.
+        # بدون marker فقط نوشتن‌های در صف اعمال می‌شوند.
+        if marker is not None and (user_id in self._in_flight or self._settled_since(user_id, marker)): return None
+        for payload in self._pending.get(user_id, ()): data = apply_update(data, payload)
+        return data
+
+    def _settled_since(self, user_id: str, marker: int) -> bool:
+        if self._settled == marker: return False
+        # تاریخچه دسته‌ها به marker نمی‌رسد: محتاطانه فرض می‌شود نوشتن این کاربر هم بوده است
+        if not self._recent_batches or self._recent_batches[0][0] > marker + 1: return True
+        return any(seq > marker and user_id in user_ids for seq, user_ids in self._recent_batches)
+
+    async def _run(self) -> None:
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            try: await self.flush()
+            except Exception as e: logger.error(f"WriteBehind: خطا در flush دوره‌ای: {e}", exc_info=True)
+
+    async def flush_user(self, user_id: str) -> None:
+        # پیش از تراکنش روی همین کاربر صدا زده می‌شود تا تراکنش داده به‌روز بخواند
+        if user_id in self._pending or user_id in self._in_flight: await self.flush(only={user_id})
+
+    async def flush(self, only: set | None = None) -> None:
+        async with self._flush_lock:
+            while True:
+                # نسل اول همه کاربران در یک دسته؛ نسل‌های بعدی در دورهای بعدی همین حلقه
+                user_ids = [u for u in self._pending if only is None or u in only][:self.max_batch]
+                if not user_ids: return
+                now = time.monotonic()
+                queued_at = {u: self._first_queued_at[u] for u in user_ids}
+                lag = now - min(queued_at.values())
+                # نسل اول پیش از await از صف برداشته می‌شود تا add همزمان در نسل بعدی بنشیند و با نوشتن این دسته گم نشود
+                batch = self._in_flight = {u: self._pending[u].pop(0) for u in user_ids}
+                for user_id in user_ids:
+                    if self._pending[user_id]: self._first_queued_at[user_id] = now
+                    else:
+                        del self._pending[user_id]
+                        del self._first_queued_at[user_id]
+                dropped_before, spilled_before, written = self.dropped, self.spilled, set()
+                try: written = await self._write(batch)
+                finally:
+                    self._in_flight = {}
+                    self._settled += 1
+                    self._recent_batches.append((self._settled, frozenset(user_ids)))
+                    for user_id in user_ids:
+                        if user_id in written: self._attempts.pop(user_id, None)
+                        else:
+                            # ناموفق (یا flush لغو شده): نسل به ابتدای صف برمی‌گردد تا ترتیب نوشتن‌ها حفظ شود
+                            self._pending.setdefault(user_id, []).insert(0, batch[user_id])
+                            self._first_queued_at[user_id] = queued_at[user_id]
+                self.flushes += 1
+                self.writes_out += len(written) - (self.dropped - dropped_before) - (self.spilled - spilled_before)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                self.max_lag = max(self.max_lag, lag)
+                metrics.WRITE_BEHIND_BATCH_SIZE.observe(len(batch))
+                metrics.WRITE_BEHIND_LAG_SECONDS.observe(lag)
+                if len(written) < len(batch): return # باقی‌مانده در flush بعدی دوباره تلاش می‌شود
+
+    async def _write(self, batch: dict[str, dict]) -> set:
+        try:
+            with metrics.storage_call(self.backend.name, "write_behind"): await self.backend.update_many(batch)
+            return set(batch)
+        except Exception as e:
+            # یک سند مشکل‌دار (مثلاً حذف‌شده) نباید کل دسته را برای همیشه متوقف کند
+            logger.warning(f"WriteBehind: نوشتن دسته‌ای {len(batch)} پروفایل ناموفق بود ({e})؛ تلاش تک‌تک.")
+        written = set()
+        for user_id, data in batch.items():
+            try:
+                with metrics.storage_call(self.backend.name, "write_behind"): await self.backend.update(user_id, data)
+                written.add(user_id)
+            except Exception as e:
+                # در تخلیه خاموشی تلاش‌ها شمرده نمی‌شوند؛ close تا drain_timeout با فاصله دوباره تلاش می‌کند و باقی‌مانده را spill می‌کند
+                if self._draining and not _is_missing(e): continue
+                self._attempts[user_id] = self._attempts.get(user_id, 0) + 1
+                if self._attempts[user_id] < self.max_attempts and not _is_missing(e): continue
+                written.add(user_id) # از صف خارج می‌شود
+                if _is_missing(e) or not self._spill({user_id: [data]}):
+                    logger.error(f"WriteBehind: آپدیت پروفایل {user_id} پس از {self._attempts[user_id]} تلاش کنار گذاشته شد: {data} ({e})")
+                    self.dropped += 1
+                else: logger.warning(f"WriteBehind: آپدیت پروفایل {user_id} پس از {self._attempts[user_id]} تلاش در '{self.spill_path}' ذخیره شد ({e}).")
+                self._attempts.pop(user_id, None)
+                if self.on_failure: self.on_failure(user_id)
+        return written
+
+    def _spill(self, generations: dict[str, list[dict]]) -> bool:
+        # خط به خط (user_id، payload) به انتهای فایل اضافه می‌شود؛ ترتیب نسل‌های هر کاربر حفظ می‌شود
+        if not self.spill_path: return False
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for user_id, payloads in generations.items():
+                    for data in payloads: f.write(json.dumps({"user_id": user_id, "data": data}, ensure_ascii=False, default=_encode_value) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except (OSError, TypeError) as e:
+            logger.error(f"WriteBehind: نوشتن فایل spill '{self.spill_path}' ناموفق بود: {e}")
+            return False
+        self.spilled += sum(len(payloads) for payloads in generations.values())
+        return True
+
+    def _restore_spill(self) -> None:
+        # نوشتن‌های spill‌شده اجرای قبلی پیش از هر add تازه به صف برمی‌گردند؛ اگر دوباره ثبت نشوند دوباره spill می‌شوند
+        if not self.spill_path or not os.path.exists(self.spill_path): return
+        try:
+            with open(self.spill_path, encoding="utf-8") as f: entries = [json.loads(line, object_hook=_decode_value) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.error(f"WriteBehind: خواندن فایل spill '{self.spill_path}' ناموفق بود؛ فایل دست نخورد: {e}")
+            return
+        for entry in entries: self.add(entry["user_id"], entry["data"])
+        os.remove(self.spill_path)
+        self.restored += len(entries)
+        logger.warning(f"WriteBehind: {len(entries)} آپدیت ثبت‌نشده از '{self.spill_path}' دوباره در صف قرار گرفت.")
+
+    async def close(self) -> None:
+        # تخلیه پیش از بستن بک‌اند: خطای گذرای بک‌اند (مثلاً حین deploy) با فاصله رو به افزایش تا drain_timeout دوباره تلاش می‌شود
+        # و چیزی کنار گذاشته نمی‌شود؛ آنچه تا پایان مهلت ثبت نشود spill می‌شود
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+        deadline = time.monotonic() + self.drain_timeout
+        delay = 0.1
+        self._draining = True
+        try:
+            while self._pending:
+                await self.flush()
+                remaining = deadline - time.monotonic()
+                if not self._pending or remaining <= 0: break
+                logger.warning(f"WriteBehind: {len(self._pending)} کاربر هنوز تخلیه نشده‌اند؛ تلاش دوباره پس از {min(delay, remaining):.1f} ثانیه.")
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, 5.0)
+        finally: self._draining = False
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            self._first_queued_at.clear()
+            if self._spill(pending): logger.warning(f"WriteBehind: آپدیت‌های {len(pending)} کاربر تا پایان مهلت تخلیه ثبت نشدند و در '{self.spill_path}' ذخیره شدند.")
+            else:
+                self.dropped += sum(len(payloads) for payloads in pending.values())
+                logger.error(f"WriteBehind: آپدیت‌های {len(pending)} کاربر تا پایان مهلت تخلیه ثبت نشدند و کنار گذاشته شدند: {pending}")
+        logger.info(f"WriteBehind: تخلیه شد. {self.stats()}")
+
+    def stats(self) -> dict:
+        return {"pending_users": self.pending_users, "writes_in": self.writes_in, "writes_out": self.writes_out, "coalesced": self.writes_in - self.writes_out - self.dropped - self.spilled - sum(len(g) for g in self._pending.values()),
+                "flushes": self.flushes, "max_batch": self.max_batch_seen, "max_lag": round(self.max_lag, 3), "dropped": self.dropped, "spilled": self.spilled, "restored": self.restored}